@@ -0,0 +1,368 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+from PIL import Image
+from crypto.keys import SeededKeys, block_params, block_permutation
+from crypto.operations import encrypt, decrypt, new_secret
+from crypto.transforms import (
+    apply_intensity_modulation,
+    undo_intensity_modulation,
+    permute,
+    undo_permute,
+    apply_rotation_and_flipping,
+    undo_rotation_and_flipping,
+    apply_negative_positive,
+    undo_negative_positive,
+)
+from graphic.io import convert_and_stack_ycbcr, restore_from_stacked_ycbcr
+from graphic.operations import pad_to_block_size, divide_into_blocks, merge_blocks
+from graphic.utils import open_jpeg, open_jpeg_ycbcr, save_jpeg
+from main import encrypt_image, decrypt_image
+
+
+SIZES = {
+    "vga": (640, 480),
+    "hd": (1280, 720),
+    "fhd": (1920, 1080),
+    "12mp": (4000, 3000),
+    "24mp": (6000, 4000),
+    "50mp": (8660, 5774),
+    "100mp": (12240, 8160),
+}
+PERCENTILES = (50, 90, 99)
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """Smooth colour field plus sensor-like noise, reproducible from ``seed``."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (max(height // 32, 2), max(width // 32, 2), 3), dtype=np.uint8)
+    img = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+    img += rng.normal(0, 4, img.shape).astype(np.int16)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+class StageTimer:
+    """Wall time and traced peak memory of each named stage of one run."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.times: Dict[str, float] = {}
+        self.peaks: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+        if self.trace_memory:
+            self.peaks[name] = max(self.peaks.get(name, 0), tracemalloc.get_traced_memory()[1] - base)
+
+
+# The staged pipelines mirror encrypt_image / decrypt_image step by step so
+# each step can be timed on its own; the end-to-end numbers come from the
+# real functions.
+def staged_encrypt(path: Path, ops_flag: int, jpeg_quality: int, out_path: Path,
+                   timer: StageTimer, seeded: bool = False):
+    with timer.stage("decode"):
+        img = open_jpeg_ycbcr(str(path))
+    with timer.stage("convert_and_stack_ycbcr"):
+        stacked = convert_and_stack_ycbcr(img)
+    with timer.stage("pad_divide"):
+        blocks = divide_into_blocks(pad_to_block_size(stacked))
+
+    secret = new_secret() if seeded else None
+    params = indices = None
+    if seeded:
+        with timer.stage("key_streams"):
+            params = block_params(secret, 0, len(blocks))
+            indices = block_permutation(secret, 0, len(blocks)) if ops_flag & 0b0010 else None
+
+    if ops_flag & 0b0001:
+        with timer.stage("apply_intensity_modulation"):
+            blocks, _ = apply_intensity_modulation(blocks, params.xor_draws if seeded else None)
+    if ops_flag & 0b0010:
+        with timer.stage("permute"):
+            blocks, _ = permute(blocks, indices)
+    if ops_flag & 0b0100:
+        with timer.stage("apply_rotation_and_flipping"):
+            blocks, _ = apply_rotation_and_flipping(blocks, params.rf_values if seeded else None)
+    if ops_flag & 0b1000:
+        with timer.stage("apply_negative_positive"):
+            blocks, _ = apply_negative_positive(blocks, params.np_flags if seeded else None)
+
+    with timer.stage("merge"):
+        encrypted_img = merge_blocks(blocks, stacked.shape)
+    with timer.stage("encode"):
+        save_jpeg(str(out_path), encrypted_img, jpeg_quality)
+
+
+def staged_decrypt(path: Path, key, out_path: Path, timer: StageTimer):
+    if isinstance(key, SeededKeys):
+        with timer.stage("key_streams"):
+            key = key.expand()
+
+    with timer.stage("decode"):
+        encrypted = open_jpeg(str(path), as_array=True)
+    with timer.stage("pad_divide"):
+        blocks = divide_into_blocks(pad_to_block_size(encrypted))
+
+    if key.np_flags is not None:
+        with timer.stage("undo_negative_positive"):
+            blocks = undo_negative_positive(blocks, key.np_flags)
+    if key.rf_values is not None:
+        with timer.stage("undo_rotation_and_flipping"):
+            blocks = undo_rotation_and_flipping(blocks, key.rf_values)
+    if key.indices is not None:
+        with timer.stage("undo_permute"):
+            blocks = undo_permute(blocks, key.indices)
+    if key.xor_keys is not None:
+        with timer.stage("undo_intensity_modulation"):
+            blocks = undo_intensity_modulation(blocks, key.xor_keys)
+
+    with timer.stage("merge"):
+        merged = merge_blocks(blocks, encrypted.shape)
+    with timer.stage("restore_from_stacked_ycbcr"):
+        decrypted_img = restore_from_stacked_ycbcr(merged, mode="YCbCr")
+    with timer.stage("encode"):
+        save_jpeg(str(out_path), decrypted_img)
+
+
+def _summary(samples: List[float], megapixels: float) -> Dict[str, float]:
+    samples = np.asarray(samples)
+    summary = {f"p{p}_s": float(np.percentile(samples, p)) for p in PERCENTILES}
+    summary["mean_s"] = float(samples.mean())
+    summary["mp_per_s"] = megapixels / summary["p50_s"] if summary["p50_s"] > 0 else float("inf")
+    return summary
+
+
+def _measure(run: Callable[[StageTimer], Any], repeat: int) -> Tuple[List[StageTimer], StageTimer, int]:
+    timers = []
+    for _ in range(repeat):
+        timer = StageTimer()
+        start = time.perf_counter()
+        run(timer)
+        timer.times["total"] = time.perf_counter() - start
+        timers.append(timer)
+
+    # One extra traced run: tracemalloc slows allocations, so it is kept out of the timings.
+    tracemalloc.start()
+    try:
+        memory = StageTimer(trace_memory=True)
+        run(memory)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return timers, memory, peak
+
+
+def _report(timers: List[StageTimer], memory: StageTimer, peak: int, megapixels: float) -> Dict[str, Any]:
+    stages = {}
+    for name in timers[0].times:
+        stages[name] = _summary([t.times[name] for t in timers], megapixels)
+        stages[name]["peak_bytes"] = peak if name == "total" else memory.peaks.get(name, 0)
+    return stages
+
+
+def bench_case(path: Path, size: str, ops_flag: int, jpeg_quality: int, repeat: int,
+               seeded: bool = False) -> List[Dict[str, Any]]:
+    width, height = Image.open(path).size
+    megapixels = width * height / 1e6
+    staged_out = path.with_name(f"{path.stem}_staged_{ops_flag}_q{jpeg_quality}.jpg")
+    keys = []
+
+    def encrypt_end_to_end(timer):
+        key, encrypted_path = encrypt_image(path, ops_flag, jpeg_quality, seeded=seeded)
+        keys.append((key, encrypted_path))
+
+    def decrypt_end_to_end(timer):
+        decrypt_image(keys[-1][1], ops_flag, keys[-1][0], jpeg_quality)
+
+    def encrypt_staged(timer):
+        staged_encrypt(path, ops_flag, jpeg_quality, staged_out, timer, seeded)
+
+    def decrypt_staged(timer):
+        staged_decrypt(keys[-1][1], keys[-1][0], staged_out, timer)
+
+    results = []
+    for direction, end_to_end, staged in (("encrypt", encrypt_end_to_end, encrypt_staged),
+                                          ("decrypt", decrypt_end_to_end, decrypt_staged)):
+        total = _report(*_measure(end_to_end, repeat), megapixels)["total"]
+        stages = _report(*_measure(staged, repeat), megapixels)
+        stages.pop("total")
+        results.append({
+            "size": size, "width": width, "height": height, "megapixels": megapixels,
+            "ops": ops_flag, "jq": jpeg_quality, "key_mode": "seeded" if seeded else "legacy",
+            "direction": direction, "total": total, "stages": stages,
+        })
+    return results
+
+
+def bench_threads(path: Path, size: str, ops_flag: int, thread_counts: List[int], repeat: int,
+                  seeded: bool = False) -> List[Dict[str, Any]]:
+    """Time encrypt / decrypt of one image's block tensor at every thread count."""
+    img = open_jpeg_ycbcr(str(path))
+    megapixels = img.width * img.height / 1e6
+    blocks = divide_into_blocks(pad_to_block_size(convert_and_stack_ycbcr(img)))
+    secret = new_secret() if seeded else None
+    encrypted, key = encrypt(blocks.copy(), ops_flag, secret)
+    work, out = np.empty_like(blocks), np.empty_like(blocks)
+
+    results = []
+    for direction, source in (("encrypt", blocks), ("decrypt", encrypted)):
+        baseline = None
+        for threads in thread_counts:
+            samples = []
+            for _ in range(repeat):
+                # Both use their input as scratch space when out is given.
+                np.copyto(work, source)
+                start = time.perf_counter()
+                if direction == "encrypt":
+                    encrypt(work, ops_flag, secret, out=out, threads=threads)
+                else:
+                    decrypt(work, key, out=out, threads=threads)
+                samples.append(time.perf_counter() - start)
+
+            total = _summary(samples, megapixels)
+            baseline = baseline or total["p50_s"]
+            results.append({
+                "size": size, "width": img.width, "height": img.height, "megapixels": megapixels,
+                "ops": ops_flag, "key_mode": "seeded" if seeded else "legacy", "direction": direction,
+                "threads": threads, "total": total, "speedup": baseline / total["p50_s"],
+            })
+    return results
+
+
+def _metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "args": vars(args),
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float) -> List[str]:
+    """Describe every case whose p50 total got slower than the baseline by more than ``threshold``."""
+    def case(r):
+        return (r["size"], r["ops"], r["jq"], r["key_mode"], r["direction"])
+
+    previous = {case(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get(case(r))
+        if old is None:
+            continue
+        before, after = old["total"]["p50_s"], r["total"]["p50_s"]
+        if after > before * (1 + threshold):
+            regressions.append(f"{'/'.join(map(str, case(r)))}: {before:.4f}s -> {after:.4f}s "
+                               f"(+{(after / before - 1) * 100:.1f}%)")
+    return regressions
+
+
+def _int_list(text: str) -> List[int]:
+    values = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = map(int, part.split("-"))
+            values.extend(range(first, last + 1))
+        else:
+            values.append(int(part))
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the encryption pipeline")
+    parser.add_argument("--sizes", default="vga,fhd,12mp",
+                        help=f"Comma-separated presets from {', '.join(SIZES)} or WIDTHxHEIGHT")
+    parser.add_argument("--ops", type=_int_list, default=list(range(16)),
+                        help="Operation bitmasks, e.g. 0-15 or 3,12,15")
+    parser.add_argument("--jq", type=_int_list, default=[75, 90, 100],
+                        help="JPEG qualities, e.g. 75,90,100")
+    parser.add_argument("-km", choices=["legacy", "seeded"], default="legacy",
+                        help="Key mode to benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs per case")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic images")
+    parser.add_argument("-o", "--output", type=Path, default=Path("benchmark.json"),
+                        help="JSON results file")
+    parser.add_argument("--compare", type=Path, metavar="BASELINE",
+                        help="Previous results file; exit non-zero on regressions")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Allowed slowdown against the baseline (0.10 = 10%%)")
+    parser.add_argument("--threads", type=_int_list, metavar="COUNTS",
+                        help="Instead of the ops/jq matrix, time the block transforms of each "
+                             "image at these thread counts, e.g. 1,2,4,8,16")
+    args = parser.parse_args()
+
+    if args.threads:
+        scaling = []
+        with tempfile.TemporaryDirectory() as work_dir:
+            for size in args.sizes.split(","):
+                width, height = SIZES[size] if size in SIZES else map(int, size.split("x"))
+                path = Path(work_dir) / f"{size}.jpg"
+                synthetic_image(width, height, args.seed).save(path, quality=95)
+
+                for ops_flag in args.ops:
+                    for result in bench_threads(path, size, ops_flag, args.threads, args.repeat,
+                                                args.km == "seeded"):
+                        scaling.append(result)
+                        total = result["total"]
+                        print(f"{size:>6} ops={ops_flag:<2} {result['direction']:<7} threads={result['threads']:<2} "
+                              f"p50={total['p50_s']:.4f}s {total['mp_per_s']:.2f} MP/s "
+                              f"speedup={result['speedup']:.2f}x")
+
+        args.output.write_text(json.dumps({"meta": _metadata(args), "scaling": scaling}, indent=2, default=str))
+        print(f"Results written to {args.output}")
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes.split(","):
+            width, height = SIZES[size] if size in SIZES else map(int, size.split("x"))
+            path = Path(work_dir) / f"{size}.jpg"
+            synthetic_image(width, height, args.seed).save(path, quality=95)
+
+            for ops_flag in args.ops:
+                for jpeg_quality in args.jq:
+                    for result in bench_case(path, size, ops_flag, jpeg_quality, args.repeat,
+                                             args.km == "seeded"):
+                        results.append(result)
+                        total = result["total"]
+                        print(f"{size:>6} ops={ops_flag:<2} jq={jpeg_quality:<3} {result['direction']:<7} "
+                              f"p50={total['p50_s']:.4f}s p99={total['p99_s']:.4f}s "
+                              f"{total['mp_per_s']:.2f} MP/s peak={total['peak_bytes'] / 2**20:.1f} MiB")
+
+    args.output.write_text(json.dumps({"meta": _metadata(args), "results": results}, indent=2, default=str))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text())["results"], args.threshold)
+        for line in regressions:
+            print(f"Regression {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
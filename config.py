@@ -9,3 +9,6 @@ ENCRYPTED_DIR = Path("encrypted_images")
 DECRYPTED_DIR = Path("decrypted_images")
 UPLOADED_DIR = Path("uploaded_images")
 UPLOADED_DECRYPTED_DIR = Path("uploaded_decrypted_images")
+KEY_ARCHIVE = ENCRYPTED_DIR / "keys.jfek"
+BATCH_MANIFEST = ENCRYPTED_DIR / "manifest.json"
+EVALUATION_CACHE = Path("evaluation_cache.sqlite")
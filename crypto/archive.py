@@ -0,0 +1,285 @@
+import io
+import os
+import pickle
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Tuple, Union
+import numpy as np
+from crypto.keys import TransformKeys, SeededKeys, SequenceKeys, FrameKeys
+
+
+MAGIC = b"JFEK"
+VERSION = 1
+KIND_TRANSFORM = 0
+KIND_SEEDED = 1
+KIND_SEQUENCE = 2
+KIND_FRAME = 3
+TILED = 0b10000
+SUBSAMPLED = 0b100000
+SUBSAMPLING_CODES = {"4:2:2": 1, "4:2:0": 2}
+
+# ID of a frame sequence's SequenceKeys record; the FrameKeys of the i-th
+# written frame is stored under frame_id(i). Failed frames are not written,
+# so i and the frame's source index can differ.
+SEQUENCE_ID = "#sequence"
+
+Key = Union[TransformKeys, SeededKeys, SequenceKeys, FrameKeys]
+
+# magic, version, kind, field mask, num_blocks, id length, payload length
+HEADER = struct.Struct("<4sHBBIIQ")
+ALIGN = 8
+
+
+def frame_id(index: int) -> str:
+    return f"#frame{index}"
+
+
+def _padded(size: int) -> int:
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _pack_nibbles(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.uint8)
+    if len(values) % 2:
+        values = np.append(values, np.uint8(0))
+    return values[0::2] | (values[1::2] << 4)
+
+
+def _unpack_nibbles(packed: np.ndarray, count: int) -> np.ndarray:
+    values = np.empty(len(packed) * 2, dtype=np.uint8)
+    values[0::2] = packed & 0x0F
+    values[1::2] = packed >> 4
+    return values[:count]
+
+
+def _xor_values(xor_keys) -> np.ndarray:
+    xor_keys = np.asarray(xor_keys, dtype=np.uint8)
+    return xor_keys[:, 0, 0] if xor_keys.ndim == 3 else xor_keys
+
+
+def _layout_section(key: Union[TransformKeys, SeededKeys, SequenceKeys]) -> bytes:
+    return np.array([SUBSAMPLING_CODES[key.subsampling], *key.source_size], dtype=np.uint32).tobytes()
+
+
+def _sections(key: Key) -> Tuple[int, int, int, list]:
+    kind, fields, num_blocks, sections = _transform_sections(key)
+    if getattr(key, "subsampling", None):
+        fields |= SUBSAMPLED
+        sections.append(_layout_section(key))
+    return kind, fields, num_blocks, sections
+
+
+def _transform_sections(key: Key) -> Tuple[int, int, int, list]:
+    if isinstance(key, SeededKeys):
+        fields = key.ops_flag
+        sections = [key.secret.to_bytes(16, "little")]
+        if key.low_variance is not None:
+            sections.append(key.low_variance)
+        if key.tile_blocks:
+            fields |= TILED
+            sections.append(np.uint64(key.tile_blocks).tobytes())
+        return KIND_SEEDED, fields, key.num_blocks, sections
+    if isinstance(key, SequenceKeys):
+        fields = key.ops_flag
+        sections = [key.secret.to_bytes(16, "little"), np.array(key.geometry, dtype=np.uint32).tobytes()]
+        if key.tile_blocks:
+            fields |= TILED
+            sections.append(np.uint64(key.tile_blocks).tobytes())
+        return KIND_SEQUENCE, fields, key.num_blocks, sections
+    if isinstance(key, FrameKeys):
+        sections = [np.uint64(key.index).tobytes()]
+        if key.low_variance is None:
+            return KIND_FRAME, 0, key.num_blocks, sections
+        return KIND_FRAME, 0b0001, key.num_blocks, sections + [key.low_variance]
+
+    fields, num_blocks, sections = 0, 0, []
+    if key.xor_keys is not None:
+        xor = _xor_values(key.xor_keys)
+        fields, num_blocks = fields | 0b0001, len(xor)
+        sections.append(_pack_nibbles(xor).tobytes())
+    if key.indices is not None:
+        indices = np.asarray(key.indices, dtype=np.uint32)
+        fields, num_blocks = fields | 0b0010, len(indices)
+        sections.append(indices.tobytes())
+    if key.rf_values is not None:
+        rf_values = np.asarray(key.rf_values, dtype=np.uint8).reshape(-1, 2)
+        fields, num_blocks = fields | 0b0100, len(rf_values)
+        sections.append(_pack_nibbles(
+            rf_values[:, 0] | (rf_values[:, 1] << 2)).tobytes())
+    if key.np_flags is not None:
+        np_flags = np.asarray(key.np_flags, dtype=bool)
+        fields, num_blocks = fields | 0b1000, len(np_flags)
+        sections.append(np.packbits(np_flags).tobytes())
+
+    return KIND_TRANSFORM, fields, num_blocks, sections
+
+
+def encode_key(key: Key, image_id: str = "") -> bytes:
+    """Serialize a key into one packed, 8-byte aligned archive record."""
+    kind, fields, num_blocks, sections = _sections(key)
+    id_bytes = image_id.encode("utf-8")
+
+    payload = b"".join(s + b"\0" * (_padded(len(s)) - len(s))
+                       for s in sections)
+    header = HEADER.pack(MAGIC, VERSION, kind, fields,
+                         num_blocks, len(id_bytes), len(payload))
+    id_field = id_bytes + b"\0" * (_padded(len(id_bytes)) - len(id_bytes))
+
+    return header + id_field + payload
+
+
+def _read_header(buffer, offset: int) -> Tuple[int, int, int, str, int, int]:
+    magic, version, kind, fields, num_blocks, id_len, payload_len = HEADER.unpack_from(
+        buffer, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a key record at offset {offset}")
+
+    id_start = offset + HEADER.size
+    image_id = bytes(buffer[id_start:id_start + id_len]).decode("utf-8")
+    payload_start = id_start + _padded(id_len)
+
+    return kind, fields, num_blocks, image_id, payload_start, payload_len
+
+
+def decode_key(buffer, offset: int = 0) -> Key:
+    """Decode the record at ``offset``; ``buffer`` may be bytes or a memmap."""
+    kind, fields, num_blocks, _, pos, _ = _read_header(buffer, offset)
+
+    def take(size: int) -> np.ndarray:
+        nonlocal pos
+        section = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=pos)
+        pos += _padded(size)
+        return section
+
+    if kind == KIND_SEEDED:
+        secret = int.from_bytes(take(16).tobytes(), "little")
+        low_variance = take((num_blocks + 7) // 8).tobytes() if fields & 0b0001 else None
+        tile_blocks = int(take(8).view(np.uint64)[0]) if fields & TILED else None
+        key = SeededKeys(secret=secret, num_blocks=num_blocks, ops_flag=fields & 0b1111,
+                         low_variance=low_variance, tile_blocks=tile_blocks)
+        if fields & SUBSAMPLED:
+            _read_layout(key, take(12))
+        return key
+    if kind == KIND_SEQUENCE:
+        secret = int.from_bytes(take(16).tobytes(), "little")
+        geometry = tuple(int(v) for v in take(8).view(np.uint32))
+        tile_blocks = int(take(8).view(np.uint64)[0]) if fields & TILED else None
+        key = SequenceKeys(secret=secret, geometry=geometry, num_blocks=num_blocks,
+                           ops_flag=fields & 0b1111, tile_blocks=tile_blocks)
+        if fields & SUBSAMPLED:
+            _read_layout(key, take(12))
+        return key
+    if kind == KIND_FRAME:
+        index = int(take(8).view(np.uint64)[0])
+        low_variance = take((num_blocks + 7) // 8).tobytes() if fields & 0b0001 else None
+        return FrameKeys(index=index, num_blocks=num_blocks, low_variance=low_variance)
+
+    xor_keys = indices = rf_values = np_flags = None
+    if fields & 0b0001:
+        xor_keys = _unpack_nibbles(take((num_blocks + 1) // 2), num_blocks)
+    if fields & 0b0010:
+        indices = take(num_blocks * 4).view(np.uint32)
+    if fields & 0b0100:
+        codes = _unpack_nibbles(take((num_blocks + 1) // 2), num_blocks)
+        rf_values = np.stack([codes & 3, codes >> 2], axis=1).astype(np.int64)
+    if fields & 0b1000:
+        np_flags = np.unpackbits(take((num_blocks + 7) // 8), count=num_blocks).astype(bool)
+
+    key = TransformKeys(
+        xor_keys=xor_keys,
+        indices=indices,
+        rf_values=rf_values,
+        np_flags=np_flags
+    )
+    if fields & SUBSAMPLED:
+        _read_layout(key, take(12))
+    return key
+
+
+def _read_layout(key: Union[TransformKeys, SeededKeys, SequenceKeys], section: np.ndarray) -> None:
+    code, height, width = (int(v) for v in section.view(np.uint32))
+    key.subsampling = {v: k for k, v in SUBSAMPLING_CODES.items()}[code]
+    key.source_size = (height, width)
+
+
+class _KeyUnpickler(pickle.Unpickler):
+    # Only what legacy key pickles reference; anything else is refused.
+    allowed = {
+        ("crypto.keys", "TransformKeys"),
+        ("crypto.keys", "SeededKeys"),
+        ("numpy", "ndarray"),
+        ("numpy", "dtype"),
+        ("numpy.core.multiarray", "_reconstruct"),
+        ("numpy._core.multiarray", "_reconstruct"),
+        ("numpy.core.multiarray", "scalar"),
+        ("numpy._core.multiarray", "scalar"),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a key")
+        return super().find_class(module, name)
+
+
+def load_legacy_key(data: bytes) -> Union[TransformKeys, SeededKeys]:
+    return _KeyUnpickler(io.BytesIO(data)).load()
+
+
+class KeyArchive:
+    """Append-only file of key records, indexed by image ID and read via np.memmap."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._index: Dict[str, int] = {}
+        self._size = 0
+        self._mmap = None
+        self._scan()
+
+    def _buffer(self):
+        size = self.path.stat().st_size
+        if self._mmap is None or len(self._mmap) != size:
+            self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return self._mmap
+
+    def _scan(self) -> None:
+        if not self.path.is_file() or self.path.stat().st_size == 0:
+            return
+
+        buffer = self._buffer()
+        offset = self._size
+        while offset < len(buffer):
+            _, _, _, image_id, payload_start, payload_len = _read_header(
+                buffer, offset)
+            self._index[image_id] = offset
+            offset = payload_start + payload_len
+        self._size = offset
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getitem__(self, image_id: str) -> Key:
+        return decode_key(self._buffer(), self._index[image_id])
+
+    def ids(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def items(self) -> Iterator[Tuple[str, Key]]:
+        for image_id in self._index:
+            yield image_id, self[image_id]
+
+    def append(self, image_id: str, key: Key) -> None:
+        self.extend([(image_id, key)])
+
+    def extend(self, items: Iterable[Tuple[str, Key]]) -> None:
+        with open(self.path, "ab") as f:
+            for image_id, key in items:
+                offset = f.tell()
+                f.write(encode_key(key, image_id))
+                self._index[image_id] = offset
+            f.flush()
+            os.fsync(f.fileno())
+            self._size = f.tell()
+        self._mmap = None
@@ -0,0 +1,147 @@
+from typing import List, Optional, Sequence, Tuple, Union
+import numpy as np
+from crypto.keys import TransformKeys, SeededKeys, block_params, block_permutation, xor_values
+from crypto.operations import new_secret
+from crypto.transforms import (
+    _xor,
+    undo_intensity_modulation,
+    permute,
+    apply_rotation_and_flipping,
+    undo_rotation_and_flipping,
+    apply_negative_positive,
+    undo_negative_positive,
+    low_variance_mask,
+    legacy_params,
+)
+from instrumentation import stage
+
+
+Keys = Union[TransformKeys, SeededKeys]
+
+
+def _seeded_params(secret: int, num_blocks: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    params = block_params(secret, 0, num_blocks)
+    return (params.xor_draws, block_permutation(secret, 0, num_blocks),
+            params.rf_values, params.np_flags)
+
+
+def pack_blocks(blocks: Union[np.ndarray, Sequence[np.ndarray]],
+                offsets: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Normalize a (B, N, 8, 8) tensor, a packed (total, 8, 8) array with offsets,
+    or a list of (N_i, 8, 8) arrays to a packed array and its B + 1 offsets."""
+    if isinstance(blocks, np.ndarray) and blocks.ndim == 4:
+        b, n = blocks.shape[:2]
+        return blocks.reshape(b * n, *blocks.shape[2:]), np.arange(b + 1) * n
+    if offsets is not None:
+        return blocks, np.asarray(offsets)
+
+    sizes = [len(b) for b in blocks]
+    return np.concatenate(blocks), np.concatenate([[0], np.cumsum(sizes)])
+
+
+def encrypt_batch(blocks: Union[np.ndarray, Sequence[np.ndarray]], ops_flag: int = 0b1111,
+                  offsets: Optional[Sequence[int]] = None, seeded: bool = False,
+                  out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, List[Keys]]:
+    """Encrypt many images' blocks in one vectorized pass.
+
+    ``blocks`` is a stacked (B, N, 8, 8) tensor, a packed (total, 8, 8) array
+    with ``offsets`` (image i owns blocks offsets[i]:offsets[i + 1]), or a list
+    of per-image block arrays. Each image gets the key ``encrypt`` would have
+    given it; the result has the packed shape, or (B, N, 8, 8) for a tensor.
+    """
+    shape = blocks.shape if isinstance(blocks, np.ndarray) else None
+    flat, offsets = pack_blocks(blocks, offsets)
+    sizes = np.diff(offsets)
+    secrets = [new_secret() for _ in sizes] if seeded else [None] * len(sizes)
+
+    with stage("batch_params", blocks=len(flat)):
+        params = [_seeded_params(secret, int(n)) if seeded else legacy_params(int(n))
+                  for secret, n in zip(secrets, sizes)]
+        xor_draws, indices, rf_values, np_flags = (
+            np.concatenate(column) if len(column) else np.empty(0) for column in zip(*params))
+
+    buffer = out.reshape(flat.shape) if out is not None else None
+    temp = flat
+    xor_keys = low_variance = None
+    if ops_flag & 0b0001:
+        with stage("intensity_modulation", blocks=len(flat)):
+            low_variance = low_variance_mask(temp)
+            xor_keys = xor_values(xor_draws, low_variance)
+            temp = _xor(temp, xor_keys, out=buffer)
+    if ops_flag & 0b0010:
+        with stage("permute", blocks=len(flat)):
+            gather = indices + np.repeat(offsets[:-1], sizes)
+            # A gather cannot run in place, so it lands in whichever buffer is free.
+            temp, _ = permute(temp, gather, out=None if buffer is None or temp is buffer else buffer)
+    if ops_flag & 0b0100:
+        with stage("rotation_and_flipping", blocks=len(flat)):
+            temp, _ = apply_rotation_and_flipping(temp, rf_values, out=buffer)
+    if ops_flag & 0b1000:
+        with stage("negative_positive", blocks=len(flat)):
+            temp, _ = apply_negative_positive(temp, np_flags, out=buffer)
+
+    if buffer is not None and temp is not buffer:
+        np.copyto(buffer, temp)
+        temp = buffer
+
+    keys = []
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if seeded:
+            keys.append(SeededKeys(
+                secret=secrets[i], num_blocks=int(stop - start), ops_flag=ops_flag,
+                low_variance=np.packbits(low_variance[start:stop]).tobytes() if ops_flag & 0b0001 else None))
+        else:
+            keys.append(TransformKeys(
+                xor_keys=xor_keys[start:stop] if ops_flag & 0b0001 else None,
+                indices=params[i][1] if ops_flag & 0b0010 else None,
+                rf_values=params[i][2] if ops_flag & 0b0100 else None,
+                np_flags=params[i][3] if ops_flag & 0b1000 else None,
+            ))
+
+    if out is not None:
+        return out, keys
+    return (temp.reshape(shape) if shape is not None and len(shape) == 4 else temp), keys
+
+
+def decrypt_batch(blocks: Union[np.ndarray, Sequence[np.ndarray]], keys: Sequence[Keys],
+                  offsets: Optional[Sequence[int]] = None,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Undo ``encrypt_batch`` (or per-image ``encrypt``) for a batch at once.
+
+    All keys must use the same operations; ``blocks`` takes the same layouts
+    as in ``encrypt_batch``.
+    """
+    shape = blocks.shape if isinstance(blocks, np.ndarray) else None
+    flat, offsets = pack_blocks(blocks, offsets)
+    keys = [key.expand() if isinstance(key, SeededKeys) else key for key in keys]
+
+    fields = ("np_flags", "rf_values", "indices", "xor_keys")
+    present = {f for f in fields if getattr(keys[0], f) is not None} if keys else set()
+    if any({f for f in fields if getattr(key, f) is not None} != present for key in keys):
+        raise ValueError("All keys in a batch must use the same operations")
+
+    def column(field):
+        return np.concatenate([np.asarray(getattr(key, field)) for key in keys])
+
+    buffer = out.reshape(flat.shape) if out is not None else None
+    temp = flat
+    if "np_flags" in present:
+        temp = undo_negative_positive(temp, column("np_flags"), out=buffer)
+    if "rf_values" in present:
+        temp = undo_rotation_and_flipping(
+            temp, np.concatenate([np.asarray(k.rf_values).reshape(-1, 2) for k in keys]), out=buffer)
+    if "indices" in present:
+        gather = column("indices") + np.repeat(offsets[:-1], np.diff(offsets))
+        unpermuted = np.empty_like(temp) if buffer is None or temp is buffer else buffer
+        unpermuted[gather] = temp
+        temp = unpermuted
+    if "xor_keys" in present:
+        xor = np.concatenate([np.asarray(k.xor_keys, dtype=np.uint8).reshape(len(k.xor_keys), -1)[:, 0]
+                              for k in keys])
+        temp = undo_intensity_modulation(temp, xor, out=buffer)
+
+    if buffer is not None:
+        if temp is not buffer:
+            np.copyto(buffer, temp)
+        return out
+    return temp.reshape(shape) if shape is not None and len(shape) == 4 else temp
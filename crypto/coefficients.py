@@ -0,0 +1,146 @@
+import numpy as np
+from typing import Optional, Tuple
+from config import BLOCK_SIZE
+from crypto.keys import TransformKeys, block_params, block_permutation
+from crypto.transforms import permute, draw_rf_values, draw_np_flags, _rotate_and_flip
+from graphic.coefficients import JpegCoefficients
+
+
+def _dct_matrix() -> np.ndarray:
+    u, x = np.meshgrid(np.arange(BLOCK_SIZE), np.arange(BLOCK_SIZE), indexing="ij")
+    matrix = np.cos((2 * x + 1) * u * np.pi / (2 * BLOCK_SIZE)) * np.sqrt(2 / BLOCK_SIZE)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def _coefficient_maps(inverse: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """Signed coefficient permutation equivalent to each pixel rotate/flip code.
+
+    Rotations transpose the coefficient grid and flips negate odd
+    frequencies, so every code maps to a permutation plus signs; they are
+    derived here by pushing the DCT basis through the pixel transform.
+    """
+    dct = _dct_matrix()
+    basis = dct.T @ np.eye(BLOCK_SIZE**2).reshape(-1, BLOCK_SIZE, BLOCK_SIZE) @ dct
+    sources = np.empty((12, BLOCK_SIZE**2), dtype=np.int64)
+    signs = np.empty((12, BLOCK_SIZE**2), dtype=np.int64)
+
+    for code in range(12):
+        rf_values = np.tile(divmod(code, 3), (len(basis), 1))
+        transformed = dct @ _rotate_and_flip(basis, rf_values, inverse=inverse) @ dct.T
+        mapping = np.rint(transformed.reshape(len(basis), -1)).astype(np.int64)
+        sources[code] = np.abs(mapping).argmax(axis=0)
+        signs[code] = mapping[sources[code], np.arange(BLOCK_SIZE**2)]
+
+    return sources, signs
+
+
+_FORWARD_MAPS = _coefficient_maps(inverse=False)
+_INVERSE_MAPS = _coefficient_maps(inverse=True)
+
+
+def rotate_and_flip_coefficients(blocks: np.ndarray, rf_values, inverse: bool = False) -> np.ndarray:
+    sources, signs = _INVERSE_MAPS if inverse else _FORWARD_MAPS
+    rf_values = np.asarray(rf_values).reshape(-1, 2)
+    codes = rf_values[:, 0] * 3 + rf_values[:, 1]
+
+    flat = blocks.reshape(len(blocks), -1)
+    transformed = np.empty_like(flat)
+    for code in np.unique(codes):
+        selected = codes == code
+        transformed[selected] = flat[selected][:, sources[code]] * signs[code]
+
+    return transformed.reshape(blocks.shape)
+
+
+def negate_coefficients(blocks: np.ndarray, np_flags, dc_offsets: np.ndarray) -> np.ndarray:
+    # 255 - x is -(x - 128) - 1 after the level shift, i.e. all coefficients
+    # negated and the DC term lowered by 8 (in quantization steps). The map
+    # q -> -q - r is its own inverse.
+    np_flags = np.asarray(np_flags, dtype=bool)
+    transformed = blocks.copy()
+    transformed[np_flags] = -blocks[np_flags]
+    transformed[np_flags, 0, 0] -= dc_offsets[np_flags]
+
+    return transformed
+
+
+def _symmetrize_quant_tables(jpeg: JpegCoefficients) -> None:
+    # A transposed block needs the transposed table. Requantize once to
+    # max(Q, Q^T) so that every later rotation is exact.
+    symmetric = {tq: np.maximum(table, table.T) for tq, table in jpeg.quant_tables.items()}
+    for component in jpeg.components:
+        table, target = jpeg.quant_tables[component.tq], symmetric[component.tq]
+        if not np.array_equal(table, target):
+            component.coefficients = np.rint(
+                component.coefficients * table / target).astype(component.coefficients.dtype)
+    jpeg.quant_tables.update(symmetric)
+
+
+def _gather(jpeg: JpegCoefficients) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    blocks = np.concatenate([c.coefficients.reshape(-1, BLOCK_SIZE, BLOCK_SIZE)
+                             for c in jpeg.components])
+    sizes = [c.coefficients.shape[0] * c.coefficients.shape[1] for c in jpeg.components]
+    offsets = np.cumsum([0] + sizes)
+    dc_offsets = np.repeat([int(np.rint(8 / jpeg.quant_table(c)[0, 0])) for c in jpeg.components], sizes)
+
+    return blocks, offsets, dc_offsets
+
+
+def _scatter(jpeg: JpegCoefficients, blocks: np.ndarray, offsets: np.ndarray) -> None:
+    for component, start, stop in zip(jpeg.components, offsets[:-1], offsets[1:]):
+        component.coefficients = blocks[start:stop].reshape(component.coefficients.shape)
+
+
+def encrypt_coefficients(jpeg: JpegCoefficients, ops_flag: int = 0b1110,
+                         secret: Optional[int] = None) -> TransformKeys:
+    """Encrypt the blocks of ``jpeg`` in place, without leaving the DCT domain.
+
+    The permutation stays within each component, since components differ in
+    size and quantization.
+    """
+    if ops_flag & 0b0001:
+        raise ValueError("Intensity modulation (XOR) only exists in the pixel domain")
+    if ops_flag & 0b0100:
+        _symmetrize_quant_tables(jpeg)
+
+    blocks, offsets, dc_offsets = _gather(jpeg)
+    params = block_params(secret, 0, len(blocks)) if secret is not None else None
+    indices = rf_values = np_flags = None
+
+    if ops_flag & 0b0010:
+        indices = np.concatenate([
+            start + (block_permutation(secret, start, stop) if params is not None
+                     else np.asarray(permute(blocks[start:stop])[1]))
+            for start, stop in zip(offsets[:-1], offsets[1:])])
+        blocks = blocks[indices]
+    if ops_flag & 0b0100:
+        rf_values = params.rf_values if params is not None else draw_rf_values(len(blocks))
+        blocks = rotate_and_flip_coefficients(blocks, rf_values)
+    if ops_flag & 0b1000:
+        np_flags = params.np_flags if params is not None else draw_np_flags(len(blocks))
+        blocks = negate_coefficients(blocks, np_flags, dc_offsets)
+
+    _scatter(jpeg, blocks, offsets)
+
+    return TransformKeys(
+        xor_keys=None,
+        indices=indices,
+        rf_values=rf_values,
+        np_flags=np_flags
+    )
+
+
+def decrypt_coefficients(jpeg: JpegCoefficients, keys: TransformKeys) -> None:
+    blocks, offsets, dc_offsets = _gather(jpeg)
+
+    if keys.np_flags is not None:
+        blocks = negate_coefficients(blocks, keys.np_flags, dc_offsets)
+    if keys.rf_values is not None:
+        blocks = rotate_and_flip_coefficients(blocks, keys.rf_values, inverse=True)
+    if keys.indices is not None:
+        unpermuted = np.empty_like(blocks)
+        unpermuted[np.asarray(keys.indices)] = blocks
+        blocks = unpermuted
+
+    _scatter(jpeg, blocks, offsets)
@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+from typing import Optional, Tuple
+import numpy as np
 
 
 @dataclass
@@ -7,3 +9,145 @@ class TransformKeys:
     rf_values: list
     np_flags: list
     xor_keys: list
+    # Chroma layout of the stacked image ("4:2:2" / "4:2:0") and the source
+    # (height, width); None for the full-resolution Y|Cb|Cr layout.
+    subsampling: Optional[str] = None
+    source_size: Optional[Tuple[int, int]] = None
+
+
+PARAMS_STREAM = 0
+PERMUTATION_STREAM = 1
+FRAME_STREAM = 2
+
+
+@dataclass
+class BlockParams:
+    xor_draws: np.ndarray
+    rf_values: np.ndarray
+    np_flags: np.ndarray
+
+
+@dataclass
+class SeededKeys:
+    """Per-image secret from which every block's parameters are regenerated."""
+    secret: int
+    num_blocks: int
+    ops_flag: int
+    low_variance: Optional[bytes] = None
+    # Blocks per tile when the permutation is confined to tiles (tiled mode).
+    tile_blocks: Optional[int] = None
+    subsampling: Optional[str] = None
+    source_size: Optional[Tuple[int, int]] = None
+
+    def expand(self, start: int = 0, stop: Optional[int] = None) -> TransformKeys:
+        """Regenerate the keys of blocks ``start`` to ``stop``, indices relative to ``start``."""
+        stop = self.num_blocks if stop is None else stop
+        params = block_params(self.secret, start, stop)
+        xor_keys = indices = rf_values = np_flags = None
+
+        if self.ops_flag & 0b0001:
+            low_variance = np.unpackbits(
+                np.frombuffer(self.low_variance, dtype=np.uint8), count=stop).astype(bool)
+            xor_keys = xor_values(params.xor_draws, low_variance[start:])
+        if self.ops_flag & 0b0010:
+            indices = self.permutation(start, stop)
+        if self.ops_flag & 0b0100:
+            rf_values = params.rf_values
+        if self.ops_flag & 0b1000:
+            np_flags = params.np_flags
+
+        return TransformKeys(
+            xor_keys=xor_keys,
+            indices=indices,
+            rf_values=rf_values,
+            np_flags=np_flags
+        )
+
+    def permutation(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        stop = self.num_blocks if stop is None else stop
+        tile_blocks = self.tile_blocks or self.num_blocks
+        if start % tile_blocks or (stop % tile_blocks and stop != self.num_blocks):
+            raise ValueError(
+                f"Block range {start}:{stop} does not fall on tile boundaries")
+
+        indices = np.empty(stop - start, dtype=np.int64)
+        for tile_start in range(start, stop, tile_blocks):
+            tile_stop = min(tile_start + tile_blocks, stop)
+            indices[tile_start - start:tile_stop - start] = (
+                tile_start - start + block_permutation(self.secret, tile_start, tile_stop))
+
+        return indices
+
+
+@dataclass
+class SequenceKeys:
+    """Secret and block layout shared by the frames of a sequence.
+
+    Frame ``i`` of the source is encrypted under ``frame_secret(secret, i)``,
+    so per frame only that index and, with intensity modulation, the
+    low-variance bits are stored (see FrameKeys).
+    """
+    secret: int
+    # (width, height) of every frame.
+    geometry: Tuple[int, int]
+    num_blocks: int
+    ops_flag: int
+    tile_blocks: Optional[int] = None
+    subsampling: Optional[str] = None
+    source_size: Optional[Tuple[int, int]] = None
+
+    def frame(self, index: int, low_variance: Optional[bytes] = None) -> SeededKeys:
+        return SeededKeys(secret=frame_secret(self.secret, index), num_blocks=self.num_blocks,
+                          ops_flag=self.ops_flag, low_variance=low_variance, tile_blocks=self.tile_blocks,
+                          subsampling=self.subsampling, source_size=self.source_size)
+
+
+@dataclass
+class FrameKeys:
+    """Source index of one written sequence frame and its low-variance bits
+    (packed, one per block; None without intensity modulation)."""
+    index: int
+    num_blocks: int
+    low_variance: Optional[bytes] = None
+
+
+def _philox(secret: int, stream: int, counter: int = 0) -> np.random.Philox:
+    key = np.random.SeedSequence(secret, spawn_key=(stream,)).generate_state(2, np.uint64)
+    return np.random.Philox(key=key, counter=counter)
+
+
+def _raw_stream(secret: int, stream: int, start: int, stop: int) -> np.ndarray:
+    # Philox yields four 64-bit words per counter value, so block i lives at
+    # counter i // 4, word i % 4 and any range can be generated independently.
+    skip = start % 4
+    return _philox(secret, stream, start // 4).random_raw(stop - start + skip)[skip:]
+
+
+def frame_secret(secret: int, frame: int) -> int:
+    """Secret of frame ``frame`` of a sequence encrypted under ``secret``."""
+    words = np.random.SeedSequence(secret, spawn_key=(FRAME_STREAM, frame)).generate_state(2, np.uint64)
+    return int(words[0]) | int(words[1]) << 64
+
+
+def block_params(secret: int, start: int, stop: int) -> BlockParams:
+    """Regenerate the per-block parameters of blocks ``start`` to ``stop``."""
+    raw = _raw_stream(secret, PARAMS_STREAM, start, stop)
+
+    rf_values = np.empty((len(raw), 2), dtype=np.int64)
+    rf_values[:, 0] = raw & 3
+    rf_values[:, 1] = ((raw >> np.uint64(32)) * np.uint64(3)) >> np.uint64(32)
+
+    return BlockParams(
+        xor_draws=((raw >> np.uint64(8)) & np.uint64(15)).astype(np.uint8),
+        rf_values=rf_values,
+        np_flags=(raw & np.uint64(4)) != 0,
+    )
+
+
+def block_permutation(secret: int, start: int, stop: int) -> np.ndarray:
+    """Permutation of the blocks ``start`` to ``stop`` among themselves."""
+    return np.argsort(_raw_stream(secret, PERMUTATION_STREAM, start, stop), kind="stable")
+
+
+def xor_values(xor_draws: np.ndarray, low_variance: np.ndarray) -> np.ndarray:
+    return (xor_draws & np.where(low_variance, 3, 15)).astype(np.uint8)
@@ -1,6 +1,8 @@
 import base64
-import pickle
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from typing import List, Optional, Tuple, Union
 from crypto.transforms import (
     apply_intensity_modulation,
     undo_intensity_modulation,
@@ -10,51 +12,327 @@ from crypto.transforms import (
     undo_rotation_and_flipping,
     apply_negative_positive,
     undo_negative_positive,
+    low_variance_mask,
+    legacy_params,
 )
-from crypto.keys import TransformKeys
+from crypto.keys import TransformKeys, SeededKeys, BlockParams, block_params, block_permutation, xor_values
+from crypto.archive import MAGIC, encode_key, decode_key, load_legacy_key
+from instrumentation import stage
 
 
-def encrypt(blocks: np.ndarray, ops_flag: bool = 0b1111) -> np.ndarray:
-    xor_keys = indices = rf_values = np_flags = None
+def new_secret() -> int:
+    return secrets.randbits(128)
+
+
+def _buffers(blocks: np.ndarray, out: Optional[np.ndarray], permuted: bool):
+    # With out given, blocks doubles as scratch space: element-wise steps run
+    # in place and only the (un)permutation moves data into the other buffer,
+    # ordered so that the result lands in out.
+    if out is None:
+        return None, None
+    return (blocks, out) if permuted else (out, out)
+
+
+# Below this many blocks per chunk, starting threads costs more than it saves.
+MIN_CHUNK_BLOCKS = 16384
+
+
+def _chunk_ranges(num_blocks: int, threads: int) -> List[Tuple[int, int]]:
+    size = max(-(-num_blocks // threads), MIN_CHUNK_BLOCKS)
+    return [(start, min(start + size, num_blocks)) for start in range(0, num_blocks, size)]
+
+
+def _map_chunks(pool: ThreadPoolExecutor, fn, ranges: List[Tuple[int, int]]) -> None:
+    for future in [pool.submit(fn, start, stop) for start, stop in ranges]:
+        future.result()
+
+
+def inverse_permutation(indices) -> np.ndarray:
+    indices = np.asarray(indices)
+    inverse = np.empty(len(indices), dtype=np.int64)
+    inverse[indices] = np.arange(len(indices))
+    return inverse
+
+
+def encrypt(blocks: np.ndarray, ops_flag: bool = 0b1111, secret: Optional[int] = None,
+            out: Optional[np.ndarray] = None, block_offset: int = 0, threads: int = 1) -> np.ndarray:
+    """Encrypt (N, 8, 8) uint8 ``blocks``; returns the encrypted blocks and their key.
+
+    With ``out`` no new block arrays are allocated: ``blocks`` doubles as
+    scratch space and may be overwritten, and the result is written to
+    ``out``. Pass a copy to keep the input.
+    """
+    # block_offset places blocks as one tile of a larger seeded image.
+    if threads > 1 and len(blocks) >= 2 * MIN_CHUNK_BLOCKS:
+        return _encrypt_chunked(blocks, ops_flag, secret, out, block_offset, threads)
+
+    stop = block_offset + len(blocks)
+    seeded = secret is not None
+    if seeded:
+        params = block_params(secret, block_offset, stop)
+    else:
+        xor_draws, permutation, rf_draws, np_draws = legacy_params(len(blocks))
+        params = BlockParams(xor_draws=xor_draws, rf_values=rf_draws, np_flags=np_draws)
+    xor_keys = indices = rf_values = np_flags = low_variance = None
+    before, after = _buffers(blocks, out, ops_flag & 0b0010)
     temp = blocks
+    n = len(blocks)
 
     if ops_flag & 0b0001:
-        temp, xor_keys = apply_intensity_modulation(temp)
+        with stage("intensity_modulation", blocks=n):
+            if seeded:
+                low_variance = np.packbits(low_variance_mask(temp)).tobytes()
+            temp, xor_keys = apply_intensity_modulation(temp, params.xor_draws, out=before)
     if ops_flag & 0b0010:
-        temp, indices = permute(temp)
+        with stage("permute", blocks=n):
+            temp, indices = permute(
+                temp, block_permutation(secret, block_offset, stop) if seeded else permutation, out=after)
     if ops_flag & 0b0100:
-        temp, rf_values = apply_rotation_and_flipping(temp)
+        with stage("rotation_and_flipping", blocks=n):
+            temp, rf_values = apply_rotation_and_flipping(temp, params.rf_values, out=after)
     if ops_flag & 0b1000:
-        temp, np_flags = apply_negative_positive(temp)
+        with stage("negative_positive", blocks=n):
+            temp, np_flags = apply_negative_positive(temp, params.np_flags, out=after)
+
+    if out is not None and temp is not out:
+        np.copyto(out, temp)
+        temp = out
 
-    keys = TransformKeys(
-        xor_keys=xor_keys,
-        indices=indices,
-        rf_values=rf_values,
-        np_flags=np_flags
-    )
+    if seeded:
+        keys = SeededKeys(secret=secret, num_blocks=len(blocks),
+                          ops_flag=ops_flag, low_variance=low_variance)
+    else:
+        keys = TransformKeys(
+            xor_keys=xor_keys,
+            indices=indices,
+            rf_values=rf_values,
+            np_flags=np_flags
+        )
 
     return temp, keys
 
 
-def decrypt(transformed_blocks: np.ndarray, keys: TransformKeys) -> np.ndarray:
+def decrypt(transformed_blocks: np.ndarray, keys: Union[TransformKeys, SeededKeys],
+            out: Optional[np.ndarray] = None, threads: int = 1) -> np.ndarray:
+    """Decrypt (N, 8, 8) uint8 ``transformed_blocks`` with ``keys``.
+
+    As with encrypt(), with ``out`` the input is scratch space that may be
+    overwritten, and the result is written to ``out``.
+    """
+    if threads > 1 and len(transformed_blocks) >= 2 * MIN_CHUNK_BLOCKS:
+        return _decrypt_chunked(transformed_blocks, keys, out, threads)
+
+    if isinstance(keys, SeededKeys):
+        with stage("expand_key", blocks=keys.num_blocks):
+            keys = keys.expand()
+
+    before, after = _buffers(transformed_blocks, out, keys.indices is not None)
     temp = transformed_blocks
+    n = len(transformed_blocks)
 
     if keys.np_flags is not None:
-        temp = undo_negative_positive(temp, keys.np_flags)
+        with stage("negative_positive", blocks=n):
+            temp = undo_negative_positive(temp, keys.np_flags, out=before)
     if keys.rf_values is not None:
-        temp = undo_rotation_and_flipping(temp, keys.rf_values)
+        with stage("rotation_and_flipping", blocks=n):
+            temp = undo_rotation_and_flipping(temp, keys.rf_values, out=before)
     if keys.indices is not None:
-        temp = undo_permute(temp, keys.indices)
+        with stage("permute", blocks=n):
+            temp = undo_permute(temp, keys.indices, out=after)
     if keys.xor_keys is not None:
-        temp = undo_intensity_modulation(temp, keys.xor_keys)
+        with stage("intensity_modulation", blocks=n):
+            temp = undo_intensity_modulation(temp, keys.xor_keys, out=after)
+
+    if out is not None and temp is not out:
+        np.copyto(out, temp)
+        temp = out
 
     return temp
 
 
+def _encrypt_chunked(blocks: np.ndarray, ops_flag: int, secret: Optional[int], out: Optional[np.ndarray],
+                     block_offset: int, threads: int):
+    """encrypt() on contiguous chunks in a thread pool; same result and keys.
+
+    XOR runs per chunk; then every output chunk gathers its permuted blocks
+    and rotates/negates them in place. Seeded parameters are drawn per chunk
+    from their Philox counters; legacy ones come from legacy_params(), so
+    neither depends on the number of threads.
+    """
+    n = len(blocks)
+    seeded = secret is not None
+    permuted = ops_flag & 0b0010
+    result = np.empty_like(blocks) if out is None else out
+    ranges = _chunk_ranges(n, threads)
+
+    if seeded:
+        xor_draws = np.empty(n, dtype=np.uint8)
+        rf_values = np.empty((n, 2), dtype=np.int64)
+        np_flags = np.empty(n, dtype=bool)
+    else:
+        xor_draws, legacy_indices, rf_values, np_flags = legacy_params(n)
+    xor_keys = np.empty(n, dtype=np.uint8) if ops_flag & 0b0001 else None
+    low_variance = np.empty(n, dtype=bool) if seeded and ops_flag & 0b0001 else None
+    # Permuting reads every block, so XOR has to finish first; as in the
+    # serial path it then goes to blocks itself when out is given.
+    source = blocks
+    if ops_flag & 0b0001:
+        source = (blocks if out is not None else np.empty_like(blocks)) if permuted else result
+
+    def modulate(start, stop):
+        if seeded:
+            params = block_params(secret, block_offset + start, block_offset + stop)
+            xor_draws[start:stop] = params.xor_draws
+            rf_values[start:stop] = params.rf_values
+            np_flags[start:stop] = params.np_flags
+        if ops_flag & 0b0001:
+            chunk = blocks[start:stop]
+            if low_variance is not None:
+                low_variance[start:stop] = low_variance_mask(chunk)
+            _, xor_keys[start:stop] = apply_intensity_modulation(chunk, xor_draws[start:stop], out=source[start:stop])
+
+    def transform(start, stop):
+        chunk = result[start:stop]
+        if permuted:
+            np.take(source, order[start:stop], axis=0, out=chunk)
+        elif source is not result:
+            np.copyto(chunk, source[start:stop])
+        if ops_flag & 0b0100:
+            apply_rotation_and_flipping(chunk, rf_values[start:stop], out=chunk)
+        if ops_flag & 0b1000:
+            apply_negative_positive(chunk, np_flags[start:stop], out=chunk)
+
+    with ThreadPoolExecutor(len(ranges)) as pool:
+        # The seeded argsort runs beside the chunked XOR pass.
+        if permuted and seeded:
+            permutation = pool.submit(block_permutation, secret, block_offset, block_offset + n)
+        if seeded or ops_flag & 0b0001:
+            with stage("intensity_modulation", blocks=n):
+                _map_chunks(pool, modulate, ranges)
+        indices = order = None
+        if permuted:
+            indices = order = permutation.result() if seeded else legacy_indices
+
+        with stage("block_transforms", blocks=n):
+            _map_chunks(pool, transform, ranges)
+
+    if seeded:
+        keys = SeededKeys(secret=secret, num_blocks=n, ops_flag=ops_flag,
+                          low_variance=np.packbits(low_variance).tobytes() if low_variance is not None else None)
+    else:
+        keys = TransformKeys(
+            xor_keys=xor_keys,
+            indices=indices,
+            rf_values=rf_values if ops_flag & 0b0100 else None,
+            np_flags=np_flags if ops_flag & 0b1000 else None
+        )
+
+    return result, keys
+
+
+def _decrypt_chunked(transformed_blocks: np.ndarray, keys: Union[TransformKeys, SeededKeys],
+                     out: Optional[np.ndarray], threads: int) -> np.ndarray:
+    """decrypt() on contiguous chunks in a thread pool.
+
+    Negative-positive and rotation/flipping are undone per chunk; then every
+    output chunk gathers its blocks through the inverse permutation and
+    undoes XOR in place.
+    """
+    n = len(transformed_blocks)
+    seeded = isinstance(keys, SeededKeys)
+    result = np.empty_like(transformed_blocks) if out is None else out
+    ranges = _chunk_ranges(n, threads)
+
+    if seeded:
+        ops_flag = keys.ops_flag
+        rf_values = np.empty((n, 2), dtype=np.int64)
+        np_flags = np.empty(n, dtype=bool)
+        xor_keys = np.empty(n, dtype=np.uint8)
+        if ops_flag & 0b0001:
+            low_variance = np.unpackbits(np.frombuffer(keys.low_variance, dtype=np.uint8), count=n).astype(bool)
+    else:
+        ops_flag = sum(bit for bit, value in ((0b0001, keys.xor_keys), (0b0010, keys.indices),
+                                              (0b0100, keys.rf_values), (0b1000, keys.np_flags))
+                       if value is not None)
+        rf_values = np.asarray(keys.rf_values).reshape(-1, 2) if keys.rf_values is not None else None
+        np_flags, xor_keys = keys.np_flags, keys.xor_keys
+    permuted = ops_flag & 0b0010
+    target = transformed_blocks
+    if ops_flag & 0b1100:
+        target = (transformed_blocks if out is not None else np.empty_like(transformed_blocks)) if permuted else result
+
+    def restore(start, stop):
+        if seeded:
+            params = block_params(keys.secret, start, stop)
+            rf_values[start:stop] = params.rf_values
+            np_flags[start:stop] = params.np_flags
+            if ops_flag & 0b0001:
+                xor_keys[start:stop] = xor_values(params.xor_draws, low_variance[start:stop])
+        chunk = transformed_blocks[start:stop]
+        if ops_flag & 0b1000:
+            chunk = undo_negative_positive(chunk, np_flags[start:stop], out=target[start:stop])
+        if ops_flag & 0b0100:
+            undo_rotation_and_flipping(chunk, rf_values[start:stop], out=target[start:stop])
+
+    def unpermute(start, stop):
+        chunk = result[start:stop]
+        if permuted:
+            np.take(target, inverse[start:stop], axis=0, out=chunk)
+        elif target is not result:
+            np.copyto(chunk, target[start:stop])
+        if ops_flag & 0b0001:
+            undo_intensity_modulation(chunk, xor_keys[start:stop], out=chunk)
+
+    with ThreadPoolExecutor(len(ranges)) as pool:
+        if permuted:
+            inverse = pool.submit(
+                lambda: inverse_permutation(keys.permutation() if seeded else keys.indices))
+        with stage("block_transforms", blocks=n):
+            _map_chunks(pool, restore, ranges)
+        if permuted:
+            inverse = inverse.result()
+        with stage("permute", blocks=n):
+            _map_chunks(pool, unpermute, ranges)
+
+    return result
+
+
+def encrypted_positions(keys: TransformKeys, block_ids: np.ndarray) -> np.ndarray:
+    """Positions in the encrypted block array of the original blocks ``block_ids``."""
+    if keys.indices is None:
+        return block_ids
+    return inverse_permutation(keys.indices)[block_ids]
+
+
+def decrypt_subset(blocks: np.ndarray, keys: TransformKeys, block_ids: np.ndarray,
+                   positions: np.ndarray) -> np.ndarray:
+    """Decrypt just the original blocks ``block_ids``, given as ``blocks`` in that order.
+
+    ``positions`` (see encrypted_positions) is where each block sat in the
+    encrypted array; the post-permutation steps are keyed by it and XOR by
+    the original position.
+    """
+    n = len(blocks)
+    if keys.np_flags is not None:
+        with stage("negative_positive", blocks=n):
+            blocks = undo_negative_positive(blocks, np.asarray(keys.np_flags)[positions], out=blocks)
+    if keys.rf_values is not None:
+        with stage("rotation_and_flipping", blocks=n):
+            blocks = undo_rotation_and_flipping(
+                blocks, np.asarray(keys.rf_values).reshape(-1, 2)[positions], out=blocks)
+    if keys.xor_keys is not None:
+        with stage("intensity_modulation", blocks=n):
+            blocks = undo_intensity_modulation(blocks, np.asarray(keys.xor_keys)[block_ids], out=blocks)
+
+    return blocks
+
+
 def export_key_to_string(key_obj) -> str:
-    return base64.b64encode(pickle.dumps(key_obj)).decode("utf-8")
+    return base64.b64encode(encode_key(key_obj)).decode("utf-8")
 
 
 def import_key_from_string(key_str: str):
-    return pickle.loads(base64.b64decode(key_str.encode("utf-8")))
+    data = base64.b64decode(key_str.encode("utf-8"))
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_key(data)
+    return load_legacy_key(data)
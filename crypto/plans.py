@@ -0,0 +1,279 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional, Tuple
+import numpy as np
+from config import BLOCK_SIZE
+from crypto.keys import TransformKeys, xor_values
+from crypto.operations import _chunk_ranges, _map_chunks, inverse_permutation
+from crypto.transforms import _rotate_and_flip, legacy_params, low_variance_mask
+from graphic.operations import padded_shape
+from instrumentation import stage
+
+
+# A plan replaces pad_to_block_size, divide_into_blocks, the permutation,
+# rotation/flipping and merge_blocks by a single gather of output pixels.
+# Negative-positive is x ^ 255 and XOR uses one key per block, so both
+# commute with the gather and become one XOR with a per-block constant.
+
+# Total size of compiled plans; each pool worker gets an equal share.
+PLAN_CACHE_BYTES = 1 << 30
+# np.take converts its indices to intp, so a gather runs this many pixels at a time.
+GATHER_CHUNK = 1 << 16
+
+
+def _offset_templates(inverse: bool) -> np.ndarray:
+    # In-block source offset of every output pixel, per rotation/flip code
+    # (rot * 3 + flip), taken from the transform itself.
+    template = np.arange(BLOCK_SIZE**2).reshape(1, BLOCK_SIZE, BLOCK_SIZE)
+    return np.stack([_rotate_and_flip(template, [[rot, flip]], inverse=inverse)[0]
+                     for rot in range(4) for flip in range(3)])
+
+
+def _rf_codes(rf_values, num_blocks: int) -> np.ndarray:
+    if rf_values is None:
+        return np.zeros(num_blocks, dtype=np.intp)
+    rf_values = np.asarray(rf_values).reshape(-1, 2)
+    return (rf_values[:, 0] * 3 + rf_values[:, 1]).astype(np.intp)
+
+
+@dataclass
+class TransformPlan:
+    """Pixel gather for one image geometry and block arrangement.
+
+    Output block ``j`` (row-major in the padded image) is source block
+    ``order[j]``, rotated/flipped. ``gather`` indexes a C-contiguous source
+    with row length ``pitch`` whose top-left ``shape`` holds the image;
+    indices past the edge are clamped, which is the edge padding. It is
+    uint32 unless the source has 2**32 pixels or more.
+    """
+    shape: Tuple[int, int]
+    pitch: int
+    order: np.ndarray
+    gather: np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.gather.nbytes + self.order.nbytes
+
+    def apply(self, source: np.ndarray, out: np.ndarray, threads: int = 1) -> np.ndarray:
+        flat_source, flat_out = source.reshape(-1), out.reshape(-1)
+        block_pixels = BLOCK_SIZE**2
+
+        def gather(start, stop):
+            for lo in range(start * block_pixels, stop * block_pixels, GATHER_CHUNK):
+                hi = min(lo + GATHER_CHUNK, stop * block_pixels)
+                np.take(flat_source, self.gather[lo:hi], out=flat_out[lo:hi])
+
+        if threads <= 1:
+            gather(0, len(self.order))
+            return out
+
+        ranges = _chunk_ranges(len(self.order), threads)
+        with ThreadPoolExecutor(len(ranges)) as pool:
+            _map_chunks(pool, gather, ranges)
+        return out
+
+
+def compile_plan(shape: Tuple[int, int], pitch: int, order: np.ndarray, codes: np.ndarray,
+                 inverse: bool = False) -> TransformPlan:
+    h, w = shape
+    padded_h, padded_w = padded_shape(shape)
+    blocks_h, blocks_w = padded_h // BLOCK_SIZE, padded_w // BLOCK_SIZE
+    index_dtype = np.uint32 if h * pitch <= 2**32 else np.intp
+    templates = _offset_templates(inverse)
+    dy, dx = templates // BLOCK_SIZE, templates % BLOCK_SIZE
+    offsets = (dy * pitch + dx).astype(index_dtype)
+    order = np.asarray(order, dtype=np.intp)
+    origins = (order // blocks_w * BLOCK_SIZE * pitch + order % blocks_w * BLOCK_SIZE).astype(index_dtype)
+
+    # Filled a strip of block rows at a time, straight into the (rows, 8,
+    # cols, 8) layout, to keep the temporaries small.
+    gather = np.empty((blocks_h, BLOCK_SIZE, blocks_w, BLOCK_SIZE), dtype=index_dtype)
+    grid = gather.transpose(0, 2, 1, 3)
+    for top in range(0, blocks_h, 64):
+        bottom = min(top + 64, blocks_h)
+        blocks = slice(top * blocks_w, bottom * blocks_w)
+        np.add(origins[blocks].reshape(-1, blocks_w, 1, 1),
+               offsets[codes[blocks]].reshape(-1, blocks_w, BLOCK_SIZE, BLOCK_SIZE), out=grid[top:bottom])
+
+    # Source blocks on a ragged edge read the edge pixels instead.
+    ragged = np.flatnonzero(((order // blocks_w + 1) * BLOCK_SIZE > h) | ((order % blocks_w + 1) * BLOCK_SIZE > w))
+    if len(ragged):
+        ys = np.minimum((order[ragged] // blocks_w * BLOCK_SIZE)[:, None, None] + dy[codes[ragged]], h - 1)
+        xs = np.minimum((order[ragged] % blocks_w * BLOCK_SIZE)[:, None, None] + dx[codes[ragged]], w - 1)
+        grid[ragged // blocks_w, ragged % blocks_w] = ys * pitch + xs
+
+    return TransformPlan(shape, pitch, order, gather.reshape(-1))
+
+
+class PlanCache:
+    """LRU cache of compiled plans, bounded by the total size of their indices.
+
+    Compiling costs about as much as one unplanned run, so a plan is only
+    compiled once its key has been asked for ``compile_after`` times; until
+    then get() returns None and the caller takes the unplanned path, as do
+    other threads while a plan is being compiled. A 12 MP stacked image
+    needs about 145 MB of gather indices.
+    """
+
+    def __init__(self, max_bytes: int = PLAN_CACHE_BYTES, compile_after: int = 2, max_seen: int = 1024):
+        self.max_bytes = max_bytes
+        self.compile_after = compile_after
+        self.max_seen = max_seen
+        self.nbytes = 0
+        self._plans: "OrderedDict[Hashable, TransformPlan]" = OrderedDict()
+        self._seen: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._compiling = set()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], TransformPlan]) -> Optional[TransformPlan]:
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+            if key in self._compiling:
+                return None
+            seen = self._seen.pop(key, 0) + 1
+            if seen < self.compile_after:
+                self._seen[key] = seen
+                if len(self._seen) > self.max_seen:
+                    self._seen.popitem(last=False)
+                return None
+            self._compiling.add(key)
+
+        try:
+            with stage("compile_plan"):
+                plan = build()
+            with self._lock:
+                self._plans[key] = plan
+                self.nbytes += plan.nbytes
+                while self.nbytes > self.max_bytes and len(self._plans) > 1:
+                    self.nbytes -= self._plans.popitem(last=False)[1].nbytes
+        finally:
+            with self._lock:
+                self._compiling.discard(key)
+        return plan
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+            self._seen.clear()
+            self._compiling.clear()
+            self.nbytes = 0
+
+
+plan_cache = PlanCache()
+
+
+def share_plan_cache(workers: int) -> None:
+    """Pool initializer: split PLAN_CACHE_BYTES between ``workers`` processes."""
+    plan_cache.max_bytes = PLAN_CACHE_BYTES // max(workers, 1)
+
+
+def _block_grid(img: np.ndarray) -> np.ndarray:
+    h, w = img.shape
+    return img.reshape(h // BLOCK_SIZE, BLOCK_SIZE, w // BLOCK_SIZE, BLOCK_SIZE)
+
+
+def _xor_blocks(img: np.ndarray, constants: np.ndarray) -> None:
+    grid = _block_grid(img)
+    np.bitwise_xor(grid, constants.reshape(grid.shape[0], 1, grid.shape[2], 1), out=grid)
+
+
+def _low_variance(img: np.ndarray) -> np.ndarray:
+    # Rotation and flipping do not change a block's variance (it is exact
+    # for uint8 blocks), so it can be taken after the gather.
+    grid = _block_grid(img)
+    rows = max(1, 65536 // grid.shape[2])
+    return np.concatenate([low_variance_mask(grid[top:top + rows].swapaxes(1, 2).reshape(
+        -1, BLOCK_SIZE, BLOCK_SIZE)) for top in range(0, grid.shape[0], rows)])
+
+
+def encrypt_planned(source: np.ndarray, shape: Tuple[int, int], ops_flag: int, out: np.ndarray,
+                    threads: int = 1) -> Optional[Tuple[np.ndarray, TransformKeys]]:
+    """Legacy-key encrypt of the image in the top-left ``shape`` of ``source``
+    into ``out`` (padded shape); same pixels and key as pad, divide,
+    encrypt and merge. None while the geometry has no plan yet (see PlanCache).
+
+    Legacy parameters only depend on the block count, so the plan is
+    compiled once per geometry and the draws come from legacy_params().
+    """
+    padded_h, padded_w = padded_shape(shape)
+    n = padded_h * padded_w // BLOCK_SIZE**2
+    permuted, rotated = ops_flag & 0b0010, ops_flag & 0b0100
+
+    def build():
+        _, indices, rf_values, _ = legacy_params(n)
+        return compile_plan(shape, source.shape[1], indices if permuted else np.arange(n),
+                            _rf_codes(rf_values if rotated else None, n))
+
+    plan = plan_cache.get(("encrypt", shape, source.shape[1], permuted, rotated), build)
+    if plan is None:
+        return None
+    xor_draws, indices, rf_values, np_flags = legacy_params(n)
+    with stage("gather", blocks=n):
+        plan.apply(source, out, threads)
+
+    xor_keys = None
+    constants = np.zeros(n, dtype=np.uint8)
+    if ops_flag & 0b0001:
+        with stage("intensity_modulation", blocks=n):
+            constants = xor_values(xor_draws[plan.order], _low_variance(out))
+            xor_keys = np.empty(n, dtype=np.uint8)
+            xor_keys[plan.order] = constants
+    if ops_flag & 0b1000:
+        constants = constants ^ np.where(np_flags, 255, 0).astype(np.uint8)
+    if ops_flag & 0b1001:
+        with stage("xor_blocks", blocks=n):
+            _xor_blocks(out, constants)
+
+    return out, TransformKeys(
+        xor_keys=xor_keys,
+        indices=indices if permuted else None,
+        rf_values=rf_values if rotated else None,
+        np_flags=np_flags if ops_flag & 0b1000 else None,
+    )
+
+
+def _fingerprint(keys: TransformKeys) -> Optional[str]:
+    digest = hashlib.blake2b(digest_size=16)
+    for values, dtype in ((keys.indices, np.int64), (keys.rf_values, np.int64)):
+        digest.update(b"-" if values is None else np.ascontiguousarray(values, dtype=dtype).tobytes())
+    return digest.hexdigest()
+
+
+def decrypt_planned(encrypted: np.ndarray, keys: TransformKeys, out: np.ndarray,
+                    threads: int = 1) -> Optional[np.ndarray]:
+    """Decrypt the C-contiguous stacked ``encrypted`` image with a cached
+    inverse plan into ``out`` (padded shape); same pixels as pad, divide,
+    decrypt and merge. The plan is keyed by the geometry and a digest of the
+    key's permutation and rotation/flip values; None while there is none yet.
+    """
+    padded_h, padded_w = padded_shape(encrypted.shape)
+    n = padded_h * padded_w // BLOCK_SIZE**2
+
+    def build():
+        inverse = inverse_permutation(keys.indices) if keys.indices is not None else np.arange(n)
+        return compile_plan(encrypted.shape, encrypted.shape[1], inverse,
+                            _rf_codes(keys.rf_values, n)[inverse], inverse=True)
+
+    plan = plan_cache.get(("decrypt", encrypted.shape, _fingerprint(keys)), build)
+    if plan is None:
+        return None
+    with stage("gather", blocks=n):
+        plan.apply(encrypted, out, threads)
+
+    constants = np.zeros(n, dtype=np.uint8)
+    if keys.xor_keys is not None:
+        constants = np.asarray(keys.xor_keys, dtype=np.uint8)
+    if keys.np_flags is not None:
+        constants = constants ^ np.where(np.asarray(keys.np_flags, dtype=bool)[plan.order], 255, 0).astype(np.uint8)
+    if keys.xor_keys is not None or keys.np_flags is not None:
+        with stage("xor_blocks", blocks=n):
+            _xor_blocks(out, constants)
+
+    return out
@@ -1,114 +1,210 @@
 import numpy as np
 import random
-from config import BLOCK_SIZE, SEED, VARIANCE_THRESHOLD
+import threading
+from collections import OrderedDict
+from config import SEED, VARIANCE_THRESHOLD
+from crypto.keys import xor_values
 
 
-def permute(blocks):
-    num_blocks = len(blocks)
+def draw_permutation(num_blocks):
     indices = list(range(num_blocks))
+    random.Random(SEED).shuffle(indices)
+    return indices
 
-    random.seed(SEED)
-    random.shuffle(indices)
 
-    transformed_blocks = blocks[indices]
+def permute(blocks, indices=None, out=None):
+    if indices is None:
+        indices = draw_permutation(len(blocks))
+
+    transformed_blocks = np.take(blocks, indices, axis=0, out=out)
 
     return transformed_blocks, indices
 
 
-def undo_permute(transformed_blocks, indices):
-    blocks = np.empty_like(transformed_blocks)
+def undo_permute(transformed_blocks, indices, out=None):
+    blocks = np.empty_like(transformed_blocks) if out is None else out
+    blocks[np.asarray(indices)] = transformed_blocks
+
+    return blocks
+
+
+def _draw_uint32(rng, num_values):
+    # Each scalar randint(0, n) with n <= 16 consumes exactly one raw uint32
+    # from the MT19937 stream and keeps its low bits.
+    return rng.randint(0, 2**32, size=num_values, dtype=np.uint32)
+
+
+def _draw_rf_values(rng, num_blocks):
+    """Replay the per-block randint(0, 4) / randint(0, 3) draws as arrays."""
+    values = np.empty(0, dtype=np.uint32)
+    while True:
+        values = np.concatenate(
+            [values, _draw_uint32(rng, num_blocks * 7 // 3 + 64) & 3])
+
+        # randint(0, 4) takes any draw, randint(0, 3) rejects 3 and redraws.
+        # Every accepted flip is preceded by a rotation, so the role of each
+        # non-3 draw only depends on the run of 3s in front of it.
+        accepted = np.flatnonzero(values != 3)
+        gaps = np.diff(accepted, prepend=-1) - 1
+        reset = gaps > 0
+        last_reset = np.maximum.accumulate(
+            np.where(reset, np.arange(len(accepted)), 0))
+        is_flip = (reset[last_reset] + np.arange(len(accepted)) - last_reset) % 2 == 1
+
+        if np.count_nonzero(is_flip) >= num_blocks:
+            break
+
+    prev_is_flip = np.concatenate([[True], is_flip[:-1]])
+    rot_from_gap = np.where(reset & prev_is_flip)[0]
+    rot_positions = np.sort(np.concatenate([
+        accepted[~is_flip],
+        np.concatenate([[-1], accepted])[rot_from_gap] + 1,
+    ]))[:num_blocks]
+    flip_positions = accepted[is_flip][:num_blocks]
+
+    rf_values = np.empty((num_blocks, 2), dtype=np.int64)
+    rf_values[:, 0] = values[rot_positions]
+    rf_values[:, 1] = values[flip_positions]
+
+    return rf_values
+
+
+def _rotate_and_flip(blocks, rf_values, inverse=False, out=None):
+    rf_values = np.asarray(rf_values).reshape(-1, 2)
+    codes = rf_values[:, 0] * 3 + rf_values[:, 1]
+    # Each group is gathered into a temporary first, so out may be blocks.
+    transformed_blocks = np.empty_like(blocks) if out is None else out
+
+    for code in np.unique(codes):
+        rot_k, flip_mode = divmod(int(code), 3)
+        selected = codes == code
+        group = blocks[selected]
+
+        if inverse:
+            group = np.rot90(_flip(group, flip_mode), k=-rot_k, axes=(1, 2))
+        else:
+            group = _flip(np.rot90(group, k=rot_k, axes=(1, 2)), flip_mode)
+
+        transformed_blocks[selected] = group
+
+    return transformed_blocks
 
-    for i, idx in enumerate(indices):
-        blocks[idx] = transformed_blocks[i]
 
+def _flip(blocks, flip_mode):
+    if flip_mode == 1:
+        return blocks[:, :, ::-1]
+    if flip_mode == 2:
+        return blocks[:, ::-1, :]
     return blocks
 
 
-flip_functions = {
-    0: lambda x: x,
-    1: np.fliplr,
-    2: np.flipud,
-}
+def draw_rf_values(num_blocks):
+    return _draw_rf_values(np.random.RandomState(SEED), num_blocks)
 
 
-def apply_rotation_and_flipping(blocks):
-    np.random.seed(SEED)
-    transformed_blocks = []
-    rf_values = []
+def apply_rotation_and_flipping(blocks, rf_values=None, out=None):
+    if rf_values is None:
+        rf_values = draw_rf_values(len(blocks))
 
-    for block in blocks:
-        rot_k = np.random.randint(0, 4)
-        rotated_block = np.rot90(block, k=rot_k)
+    return _rotate_and_flip(blocks, rf_values, out=out), rf_values
 
-        flip_mode = np.random.randint(0, 3)
-        flipped_block = flip_functions[flip_mode](rotated_block)
 
-        transformed_blocks.append(flipped_block)
-        rf_values.append((rot_k, flip_mode))
+def undo_rotation_and_flipping(transformed_blocks, rf_values, out=None):
+    return _rotate_and_flip(transformed_blocks, rf_values, inverse=True, out=out)
 
-    return np.array(transformed_blocks), rf_values
 
+def _negate(blocks, np_flags, out=None):
+    np_flags = np.asarray(np_flags, dtype=bool)
+    if out is None:
+        out = blocks.copy()
+    elif out is not blocks:
+        np.copyto(out, blocks)
 
-def undo_rotation_and_flipping(transformed_blocks, rf_values):
-    blocks = []
-    for transformed_block, (rot_k, flip_mode) in zip(transformed_blocks, rf_values):
-        unflipped_block = flip_functions[flip_mode](transformed_block)
-        unrotated_block = np.rot90(unflipped_block, k=(4 - rot_k) % 4)
-        blocks.append(unrotated_block)
+    np.subtract(255, out, out=out, where=np_flags[:, None, None])
 
-    return np.array(blocks)
+    return out
 
 
-def apply_negative_positive(blocks):
-    np.random.seed(SEED)
-    transformed_blocks = []
-    np_flags = []
+def draw_np_flags(num_blocks):
+    return np.random.RandomState(SEED).rand(num_blocks) < 0.5
 
-    for block in blocks:
-        apply_neg = np.random.rand() < 0.5
-        if apply_neg:
-            block = 255 - block
-        transformed_blocks.append(block)
-        np_flags.append(apply_neg)
 
-    return np.array(transformed_blocks), np_flags
+def apply_negative_positive(blocks, np_flags=None, out=None):
+    if np_flags is None:
+        np_flags = draw_np_flags(len(blocks))
 
+    return _negate(blocks, np_flags, out), np_flags
 
-def undo_negative_positive(transformed_blocks, np_flags):
-    blocks = []
-    for transformed_block, apply_neg in zip(transformed_blocks, np_flags):
-        if apply_neg:
-            block = 255 - transformed_block
-        else:
-            block = transformed_block
-        blocks.append(block)
 
-    return np.array(blocks)
+def undo_negative_positive(transformed_blocks, np_flags, out=None):
+    return _negate(transformed_blocks, np_flags, out)
 
 
-def apply_intensity_modulation(blocks):
-    np.random.seed(SEED)
-    transformed_blocks = []
-    xor_keys = []
+def low_variance_mask(blocks, chunk_size=4096):
+    # Chunked so the float64 temporaries (8 bytes per pixel) stay a few MB.
+    mask = np.empty(len(blocks), dtype=bool)
+    for start in range(0, len(blocks), chunk_size):
+        chunk = blocks[start:start + chunk_size]
+        mask[start:start + chunk_size] = chunk.var(axis=(1, 2)) < VARIANCE_THRESHOLD
+
+    return mask
+
+
+def _xor(blocks, xor_keys, out=None):
+    xor_keys = np.asarray(xor_keys, dtype=np.uint8)
+    if xor_keys.ndim == 1:
+        xor_keys = xor_keys[:, None, None]
+
+    return np.bitwise_xor(blocks, xor_keys, out=out)
+
+
+def draw_xor_draws(num_blocks):
+    return _draw_uint32(np.random.RandomState(SEED), num_blocks)
+
+
+def apply_intensity_modulation(blocks, xor_draws=None, out=None):
+    if xor_draws is None:
+        xor_draws = draw_xor_draws(len(blocks))
+
+    xor_keys = xor_values(xor_draws, low_variance_mask(blocks))
+
+    return _xor(blocks, xor_keys, out), xor_keys
+
+
+def undo_intensity_modulation(transformed_blocks, xor_keys, out=None):
+    return _xor(transformed_blocks, xor_keys, out)
+
+
+# Legacy draws of the most recent block counts, bounded by their total size
+# (about 29 bytes per block).
+LEGACY_CACHE_BYTES = 64 << 20
+_legacy_cache = OrderedDict()
+_legacy_cache_bytes = 0
+_legacy_lock = threading.Lock()
 
-    for block in blocks:
-        block_variance = np.var(block)
-        if block_variance < VARIANCE_THRESHOLD:
-            xor_value = np.random.randint(0, 4, dtype=np.uint8)
-        else:
-            xor_value = np.random.randint(0, 16, dtype=np.uint8)
 
-        xor_key = np.full((BLOCK_SIZE, BLOCK_SIZE), xor_value, dtype=np.uint8)
-        transformed_blocks.append(np.bitwise_xor(block, xor_key))
-        xor_keys.append(xor_key)
+def _params_nbytes(params):
+    return sum(array.nbytes for array in params)
 
-    return np.array(transformed_blocks), xor_keys
 
+def legacy_params(num_blocks):
+    # Legacy keys only depend on the block count, so images of one size share them.
+    global _legacy_cache_bytes
+    with _legacy_lock:
+        params = _legacy_cache.get(num_blocks)
+        if params is not None:
+            _legacy_cache.move_to_end(num_blocks)
+            return params
 
-def undo_intensity_modulation(transformed_blocks, xor_keys):
-    blocks = []
-    for transformed_block, xor_key in zip(transformed_blocks, xor_keys):
-        block = np.bitwise_xor(transformed_block, xor_key)
-        blocks.append(block)
+    params = (draw_xor_draws(num_blocks), np.asarray(draw_permutation(num_blocks)),
+              draw_rf_values(num_blocks), draw_np_flags(num_blocks))
+    for array in params:
+        array.flags.writeable = False
 
-    return np.array(blocks)
+    with _legacy_lock:
+        if num_blocks not in _legacy_cache:
+            _legacy_cache[num_blocks] = params
+            _legacy_cache_bytes += _params_nbytes(params)
+        while _legacy_cache_bytes > LEGACY_CACHE_BYTES and len(_legacy_cache) > 1:
+            _legacy_cache_bytes -= _params_nbytes(_legacy_cache.popitem(last=False)[1])
+    return params
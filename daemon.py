@@ -0,0 +1,78 @@
+import json
+import os
+import socket
+import socketserver
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+
+# Only the standard library is imported here, so clients start fast.
+
+Job = Dict[str, Any]
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        # One JSON job per line and one JSON reply per job; a connection may
+        # carry any number of jobs.
+        for line in self.rfile:
+            try:
+                response = self.server.run(json.loads(line))
+            except BaseException as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Warm interpreter serving JSON-lines jobs on a local Unix socket.
+
+    Each connection gets a thread; jobs run in it, or in ``executor`` (e.g.
+    a process pool) when given. The socket is only accessible to its owner.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: Union[str, Path], handler: Callable[[Job], Job],
+                 executor: Optional[Executor] = None):
+        self.path = Path(path)
+        self.handler = handler
+        self.executor = executor
+        _remove_stale(self.path)
+
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), _JobHandler)
+        finally:
+            os.umask(umask)
+
+    def run(self, job: Job) -> Job:
+        if self.executor is None:
+            return self.handler(job)
+        return self.executor.submit(self.handler, job).result()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+
+def _remove_stale(path: Path) -> None:
+    if not path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            path.unlink(missing_ok=True)
+            return
+    raise OSError(f"A daemon is already listening on {path}")
+
+
+def submit(path: Union[str, Path], job: Job) -> Job:
+    """Send one job to the daemon at ``path`` and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(job).encode() + b"\n")
+        with sock.makefile("rb") as reader:
+            return json.loads(reader.readline())
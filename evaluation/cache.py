@@ -0,0 +1,51 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Tuple, Union
+import numpy as np
+
+
+def _encode(value: Any) -> str:
+    if isinstance(value, np.ndarray):
+        return json.dumps({"array": value.tolist(), "dtype": str(value.dtype)})
+    return json.dumps({"value": float(value)})
+
+
+def _decode(text: str) -> Any:
+    data = json.loads(text)
+    if "array" in data:
+        return np.asarray(data["array"], dtype=data["dtype"])
+    return data["value"]
+
+
+class ResultCache:
+    """On-disk metric results keyed by the content hashes of the evaluated and original files.
+
+    A row is only reused while both files are byte-identical and the metric's
+    version matches, so editing an image or bumping a metric version recomputes it.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "file_hash TEXT, original_hash TEXT, metric TEXT, version INTEGER, value TEXT, "
+            "PRIMARY KEY (file_hash, original_hash, metric, version))")
+
+    def get(self, file_hash: str, original_hash: str,
+            versions: Dict[str, int]) -> Dict[str, Any]:
+        rows = self._db.execute(
+            "SELECT metric, version, value FROM results WHERE file_hash = ? AND original_hash = ?",
+            (file_hash, original_hash))
+        return {metric: _decode(value) for metric, version, value in rows
+                if versions.get(metric) == version}
+
+    def put_many(self, entries: Iterable[Tuple[str, str, str, int, Any]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                ((f, o, m, v, _encode(value)) for f, o, m, v, value in entries))
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,261 @@
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from PIL import Image
+import numpy as np
+from skimage.measure import shannon_entropy
+from skimage.metrics import peak_signal_noise_ratio as psnr
+from config import BLOCK_SIZE
+from evaluation.cache import ResultCache
+from hashing import file_digest
+
+
+ENCRYPTED_METRICS = ("entropy", "histogram", "npcr", "uaci", "block_adjacency")
+DECRYPTED_METRICS = ("psnr", "bpp")
+# Bump a metric's version whenever its definition changes to invalidate cached results.
+METRIC_VERSIONS = {"entropy": 1, "histogram": 1, "npcr": 1, "uaci": 1,
+                   "block_adjacency": 1, "psnr": 1, "bpp": 1}
+NAME_PATTERN = re.compile(
+    r"^(?P<image>.+)_(?P<kind>encrypted|decrypted)_(?P<ops>\d+)_q(?P<quality>\d+)$")
+
+
+class ImageCache:
+    """Bounded LRU of decoded images, keyed by path and PIL mode and capped by total bytes."""
+
+    def __init__(self, max_bytes: int = 512 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._images: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+
+    def load(self, path: Path, mode: str = "L") -> np.ndarray:
+        key = (str(path), mode)
+        if key in self._images:
+            self._images.move_to_end(key)
+            return self._images[key]
+
+        img = np.array(Image.open(path).convert(mode))
+        self._images[key] = img
+        self.nbytes += img.nbytes
+        # The newest image is kept even if it alone exceeds the cap.
+        while self.nbytes > self.max_bytes and len(self._images) > 1:
+            self.nbytes -= self._images.popitem(last=False)[1].nbytes
+        return img
+
+
+default_cache = ImageCache()
+
+
+def image_histogram(img: np.ndarray) -> np.ndarray:
+    return np.histogram(img.flatten(), bins=256, range=(0, 255))[0]
+
+
+def _window_means(blocks: np.ndarray, win: int) -> np.ndarray:
+    """Means of every ``win`` x ``win`` window fully inside each block, as (N, k, k)."""
+    k = blocks.shape[-1] - win + 1
+    rows = np.stack([blocks[:, r:r + win].sum(axis=1) for r in range(k)], axis=1)
+    return np.stack([rows[:, :, c:c + win].sum(axis=2) for c in range(k)], axis=2) / win**2
+
+
+def pair_ssim(first: np.ndarray, second: np.ndarray, win: int = 7, data_range: float = 255) -> np.ndarray:
+    """SSIM of each block pair in two (N, 8, 8) stacks, as skimage's defaults compute it.
+
+    skimage uses a 7x7 uniform window with sample covariance and averages only
+    the windows that lie entirely inside the block, which is all this evaluates.
+    """
+    x = first.astype(np.float64)
+    y = second.astype(np.float64)
+    cov_norm = win**2 / (win**2 - 1)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    ux, uy = _window_means(x, win), _window_means(y, win)
+    vx = cov_norm * (_window_means(x * x, win) - ux * ux)
+    vy = cov_norm * (_window_means(y * y, win) - uy * uy)
+    vxy = cov_norm * (_window_means(x * y, win) - ux * uy)
+
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux**2 + uy**2 + c1) * (vx + vy + c2))
+    return s.mean(axis=(1, 2))
+
+
+def adjacent_block_pairs(img: np.ndarray, chunk_rows: int = 64):
+    """Yield (first, second) stacks of right and lower neighbouring 8x8 blocks.
+
+    Covers the same pairs as the original per-block loop, which starts a pair
+    at every block origin in ``range(0, h - 8, 8)`` x ``range(0, w - 8, 8)``.
+    Chunks of ``chunk_rows`` block rows keep memory flat on large images.
+    """
+    h, w = img.shape
+    nr, nc = h // BLOCK_SIZE, w // BLOCK_SIZE
+    rows = len(range(0, h - BLOCK_SIZE, BLOCK_SIZE))
+    cols = len(range(0, w - BLOCK_SIZE, BLOCK_SIZE))
+    grid = img[:nr * BLOCK_SIZE, :nc * BLOCK_SIZE].reshape(
+        nr, BLOCK_SIZE, nc, BLOCK_SIZE).swapaxes(1, 2)
+
+    right_cols = min(cols, nc - 1)
+    down_rows = min(rows, nr - 1)
+    for start in range(0, rows, chunk_rows):
+        stop = min(start + chunk_rows, rows)
+        if right_cols > 0:
+            yield (grid[start:stop, :right_cols].reshape(-1, BLOCK_SIZE, BLOCK_SIZE),
+                   grid[start:stop, 1:right_cols + 1].reshape(-1, BLOCK_SIZE, BLOCK_SIZE))
+        if start < down_rows:
+            stop = min(stop, down_rows)
+            yield (grid[start:stop, :cols].reshape(-1, BLOCK_SIZE, BLOCK_SIZE),
+                   grid[start + 1:stop + 1, :cols].reshape(-1, BLOCK_SIZE, BLOCK_SIZE))
+
+
+def block_adjacency(img: np.ndarray, pair_metric: Callable[[np.ndarray, np.ndarray], np.ndarray] = pair_ssim) -> float:
+    """Mean of ``pair_metric`` over each 8x8 block and its right and lower neighbours.
+
+    With the default SSIM this matches the per-block skimage loop to within
+    1e-9; ``pair_metric`` may be any function scoring (N, 8, 8) stacks pairwise.
+    """
+    total, count = 0.0, 0
+    for first, second in adjacent_block_pairs(img):
+        scores = pair_metric(first, second)
+        total += float(scores.sum())
+        count += len(scores)
+    return total / count if count else float("nan")
+
+
+def _extract_y_channel(stacked_image: np.ndarray) -> np.ndarray:
+    """Extract Y (luma) channel from horizontally stacked grayscale YCbCr image."""
+    return stacked_image[:, :stacked_image.shape[1] // 3]
+
+
+def _encrypted_metrics(path: Path, original_path: Path, cache: ImageCache, metrics) -> Dict[str, Any]:
+    encrypted = cache.load(path, "L")
+    values = {}
+
+    if "entropy" in metrics:
+        values["entropy"] = shannon_entropy(encrypted)
+    if "histogram" in metrics:
+        values["histogram"] = image_histogram(encrypted)
+    if {"npcr", "uaci"} & set(metrics) and original_path.exists():
+        original = cache.load(original_path, "L")
+        enc_y = _extract_y_channel(encrypted)
+        if original.shape != enc_y.shape:
+            enc_y = np.array(Image.fromarray(enc_y).resize(
+                (original.shape[1], original.shape[0])))
+        values["npcr"] = np.sum(original != enc_y) / enc_y.size * 100
+        values["uaci"] = np.mean(np.abs(original.astype(np.int16) - enc_y.astype(np.int16))) / 255 * 100
+    if "block_adjacency" in metrics:
+        values["block_adjacency"] = block_adjacency(encrypted)
+
+    return values
+
+
+def _decrypted_metrics(path: Path, original_path: Path, cache: ImageCache, metrics) -> Dict[str, Any]:
+    if not original_path.exists():
+        return {}
+
+    original = cache.load(original_path, "RGB")
+    decrypted = cache.load(path, "RGB")
+    values = {}
+
+    if "psnr" in metrics:
+        min_h = min(original.shape[0], decrypted.shape[0])
+        min_w = min(original.shape[1], decrypted.shape[1])
+        values["psnr"] = psnr(original[:min_h, :min_w], decrypted[:min_h, :min_w], data_range=255)
+    if "bpp" in metrics:
+        values["bpp"] = os.path.getsize(path) * 8 / (original.shape[0] * original.shape[1])
+
+    return values
+
+
+def _compute(task: Tuple[Path, Path, str, Tuple[str, ...]], cache: Optional[ImageCache] = None) -> Dict[str, Any]:
+    path, original_path, kind, metrics = task
+    compute = _encrypted_metrics if kind == "encrypted" else _decrypted_metrics
+    return compute(path, original_path, cache or default_cache, metrics)
+
+
+def evaluate_files(paths: Iterable[Path], input_dir: Path, cache: Optional[ImageCache] = None,
+                   metrics: Optional[Iterable[str]] = None, result_cache: Optional[ResultCache] = None,
+                   workers: int = 1) -> List[Dict[str, Any]]:
+    """Compute every requested metric of each file in one pass, as tidy rows.
+
+    Each row holds ``path``, ``image``, ``kind``, ``ops``, ``quality``,
+    ``metric`` and ``value``. Files are matched to ``input_dir/<image>.jpg``
+    by their ``<image>_<kind>_<ops>_q<quality>`` name. With a ``result_cache``
+    only files whose content, original or metric version changed are decoded;
+    those misses are spread over ``workers`` processes.
+    """
+    cache = cache or default_cache
+    metrics = tuple(metrics or ENCRYPTED_METRICS + DECRYPTED_METRICS)
+    versions = {metric: METRIC_VERSIONS[metric] for metric in metrics}
+    entries, misses, digests = [], [], {}
+
+    def digest(path: Path) -> str:
+        if path not in digests:
+            digests[path] = file_digest(path)
+        return digests[path]
+
+    for path in paths:
+        path = Path(path)
+        match = NAME_PATTERN.match(path.stem)
+        if not match:
+            continue
+
+        original_path = input_dir / f"{match['image']}.jpg"
+        hashes = (digest(path), digest(original_path)) if result_cache else None
+        values = result_cache.get(*hashes, versions) if result_cache else {}
+        missing = tuple(m for m in metrics if m not in values)
+        entries.append((path, match, hashes, values))
+        if missing:
+            misses.append((len(entries) - 1, (path, original_path, match["kind"], missing)))
+
+    if workers > 1 and len(misses) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            computed = list(executor.map(_compute, [task for _, task in misses]))
+    else:
+        computed = [_compute(task, cache) for _, task in misses]
+
+    new_results = []
+    for (index, _), values in zip(misses, computed):
+        path, match, hashes, cached = entries[index]
+        cached.update(values)
+        if result_cache:
+            new_results.extend((*hashes, metric, versions[metric], value)
+                               for metric, value in values.items())
+    if result_cache and new_results:
+        result_cache.put_many(new_results)
+
+    rows = []
+    for path, match, _, values in entries:
+        for metric in metrics:
+            if metric not in values:
+                continue
+            rows.append({
+                "path": str(path),
+                "image": match["image"],
+                "kind": match["kind"],
+                "ops": int(match["ops"]),
+                "quality": int(match["quality"]),
+                "metric": metric,
+                "value": values[metric],
+            })
+
+    return rows
+
+
+def evaluate(input_dir: Path, encrypted_dir: Optional[Path] = None, decrypted_dir: Optional[Path] = None,
+             cache: Optional[ImageCache] = None, metrics: Optional[Iterable[str]] = None,
+             result_cache: Optional[ResultCache] = None, workers: int = 1) -> List[Dict[str, Any]]:
+    """Evaluate every encrypted and decrypted file against the originals in ``input_dir``."""
+    paths = []
+    for folder in (encrypted_dir, decrypted_dir):
+        if folder is not None:
+            paths.extend(sorted(Path(folder).glob("*.jpg")))
+
+    return evaluate_files(paths, Path(input_dir), cache, metrics, result_cache, workers)
+
+
+def select(rows: List[Dict[str, Any]], **criteria) -> List[Dict[str, Any]]:
+    return [row for row in rows if all(row[k] == v for k, v in criteria.items())]
+
+
+def values(rows: List[Dict[str, Any]], metric: str, **criteria) -> List[Any]:
+    return [row["value"] for row in select(rows, metric=metric, **criteria)]
@@ -1,29 +1,29 @@
-import os
 from pathlib import Path
-from PIL import Image
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import matplotlib.pyplot as plt
-from skimage.measure import shannon_entropy
-from skimage.metrics import peak_signal_noise_ratio as psnr, structural_similarity as ssim
-from graphic.utils import open_jpeg
-from config import BLOCK_SIZE
+from evaluation.engine import default_cache, evaluate, image_histogram, select, values
 
 
-def evaluate_entropy(folder: Path, mode1: int = 14, mode2: int = 15) -> None:
-    """Compare Shannon entropy between two encryption modes."""
-    def compute_entropy(img_path: Path) -> float:
-        img = Image.open(img_path).convert("L")
-        img_np = np.array(img)
-        return shannon_entropy(img_np)
+Results = Optional[List[Dict[str, Any]]]
+
+
+def _paired(rows: List[Dict[str, Any]], metric: str, mode1: int = 14, mode2: int = 15,
+            quality: int = 95) -> Tuple[List[Any], List[Any]]:
+    """Values of ``metric`` for the images encrypted in both modes at ``quality``."""
+    first = {r["image"]: r["value"] for r in select(rows, metric=metric, ops=mode1, quality=quality)}
+    second = {r["image"]: r["value"] for r in select(rows, metric=metric, ops=mode2, quality=quality)}
+    images = sorted(first.keys() & second.keys())
+    return [first[i] for i in images], [second[i] for i in images]
 
-    img_paths = list(folder.glob("*.jpg"))
-    mode1_entropies, mode2_entropies = [], []
 
-    for path in img_paths:
-        if f"_{mode1}" in path.stem:
-            mode1_entropies.append(compute_entropy(path))
-        elif f"_{mode2}" in path.stem:
-            mode2_entropies.append(compute_entropy(path))
+def evaluate_entropy(folder: Path, mode1: int = 14, mode2: int = 15, results: Results = None) -> None:
+    """Compare Shannon entropy between two encryption modes."""
+    rows = results if results is not None else evaluate(
+        folder, encrypted_dir=folder, metrics=("entropy",))
+
+    mode1_entropies = values(rows, "entropy", kind="encrypted", ops=mode1)
+    mode2_entropies = values(rows, "entropy", kind="encrypted", ops=mode2)
 
     print("--- Shannon Entropy Evaluation ---")
     print(
@@ -32,13 +32,14 @@ def evaluate_entropy(folder: Path, mode1: int = 14, mode2: int = 15) -> None:
         f"Mode {mode2} (With XOR)   : Average Entropy = {np.mean(mode2_entropies):.4f} bits")
 
 
-def plot_histogram_comparison(img1_path: Path, img2_path: Path) -> None:
+def plot_histogram_comparison(img1_path: Path, img2_path: Path, results: Results = None) -> None:
     """Plot histogram comparison between two grayscale images."""
-    img1 = np.array(Image.open(img1_path).convert("L"))
-    img2 = np.array(Image.open(img2_path).convert("L"))
+    def histogram(path: Path) -> np.ndarray:
+        rows = select(results or [], metric="histogram", path=str(path))
+        return rows[0]["value"] if rows else image_histogram(default_cache.load(Path(path), "L"))
 
-    hist1, _ = np.histogram(img1.flatten(), bins=256, range=(0, 255))
-    hist2, _ = np.histogram(img2.flatten(), bins=256, range=(0, 255))
+    hist1 = histogram(img1_path)
+    hist2 = histogram(img2_path)
     max_y = max(hist1.max(), hist2.max())
 
     fig, axs = plt.subplots(1, 2, figsize=(12, 5), sharey=True)
@@ -58,38 +59,20 @@ def plot_histogram_comparison(img1_path: Path, img2_path: Path) -> None:
     plt.show()
 
 
-def plot_psnr_vs_bpp(input_dir: Path, decrypted_dir: Path, mode: int = 15) -> None:
+def plot_psnr_vs_bpp(input_dir: Path, decrypted_dir: Path, mode: int = 15, results: Results = None) -> None:
     """Plot PSNR vs BPP curve for a range of JPEG qualities."""
     qualities = list(range(70, 100, 5))
     bpp_list, psnr_list = [], []
-
-    input_files = sorted(input_dir.glob("*.jpg"))
+    rows = results if results is not None else evaluate(
+        input_dir, decrypted_dir=decrypted_dir, metrics=("psnr", "bpp"))
 
     for q in qualities:
-        total_psnr, total_bpp, count = 0, 0, 0
-
-        for input_img_path in input_files:
-            filename = input_img_path.stem
-            original = np.array(open_jpeg(str(input_img_path)))
-
-            decrypted_img_path = decrypted_dir / \
-                f"{filename}_decrypted_{mode}_q{q}.jpg"
-            if not decrypted_img_path.exists():
-                continue
-
-            decrypted = np.array(open_jpeg(str(decrypted_img_path)))
-            psnr_val = psnr(original, decrypted, data_range=255)
-            size_bits = os.path.getsize(decrypted_img_path) * 8
-            num_pixels = original.shape[0] * original.shape[1]
-            bpp_val = size_bits / num_pixels
-
-            total_psnr += psnr_val
-            total_bpp += bpp_val
-            count += 1
+        psnr_values = values(rows, "psnr", kind="decrypted", ops=mode, quality=q)
+        bpp_values = values(rows, "bpp", kind="decrypted", ops=mode, quality=q)
 
-        if count > 0:
-            bpp_list.append(total_bpp / count)
-            psnr_list.append(total_psnr / count)
+        if psnr_values:
+            bpp_list.append(np.mean(bpp_values))
+            psnr_list.append(np.mean(psnr_values))
 
     plt.plot(bpp_list, psnr_list, marker='o')
     plt.xlabel('Bits Per Pixel (BPP)')
@@ -100,83 +83,29 @@ def plot_psnr_vs_bpp(input_dir: Path, decrypted_dir: Path, mode: int = 15) -> No
     plt.show()
 
 
-def evaluate_social_media_psnr_table(input_dir: Path, decrypted_dir: Path, mode: int = 15) -> None:
+def evaluate_social_media_psnr_table(input_dir: Path, decrypted_dir: Path, mode: int = 15,
+                                     results: Results = None) -> None:
     """Print PSNR table for JPEG re-compressed images (e.g., social media downloads)."""
     qualities = list(range(70, 100, 5))
-    input_files = sorted(input_dir.glob("*.jpg"))
+    rows = results if results is not None else evaluate(
+        input_dir, decrypted_dir=decrypted_dir, metrics=("psnr",))
 
     print(f"{'JPEG Quality':<15}{'Average PSNR (dB)':<20}")
     print("-" * 35)
 
     for q in qualities:
-        psnr_sum, count = 0, 0
-
-        for input_path in input_files:
-            stem = input_path.stem
-            downloaded_path = decrypted_dir / \
-                f"{stem}_decrypted_{mode}_q{q}.jpg"
-
-            if not downloaded_path.exists():
-                continue
-
-            original = np.array(open_jpeg(str(input_path)))
-            downloaded = np.array(open_jpeg(str(downloaded_path)))
-
-            min_h = min(original.shape[0], downloaded.shape[0])
-            min_w = min(original.shape[1], downloaded.shape[1])
-
-            original = original[:min_h, :min_w]
-            downloaded = downloaded[:min_h, :min_w]
-
-            psnr_val = psnr(original, downloaded, data_range=255)
-            psnr_sum += psnr_val
-            count += 1
-
-        avg_psnr = psnr_sum / count if count else 0
+        psnr_values = values(rows, "psnr", kind="decrypted", ops=mode, quality=q)
+        avg_psnr = np.mean(psnr_values) if psnr_values else 0
         print(f"{q:<15}{avg_psnr:<20.4f}")
 
 
-def plot_npcr_uaci(input_dir: Path, encrypted_dir: Path) -> None:
+def plot_npcr_uaci(input_dir: Path, encrypted_dir: Path, results: Results = None) -> None:
     """Plot mean NPCR and UACI comparison between basic and XOR modes."""
-    npcr_basic_list, uaci_basic_list = [], []
-    npcr_xor_list, uaci_xor_list = [], []
-
-    for path in encrypted_dir.glob('*_14_q95.jpg'):
-        base = path.stem.replace('_encrypted_14_q95', '')
-        original = open_jpeg(str(input_dir / f"{base}.jpg"), as_array=True)
-        enc_basic = open_jpeg(str(path), as_array=True)
-        enc_xor = open_jpeg(
-            str(encrypted_dir / f"{base}_encrypted_15_q95.jpg"), as_array=True)
-
-        def extract_y_channel(stacked_image: np.ndarray) -> np.ndarray:
-            """Extract Y (luma) channel from horizontally stacked grayscale YCbCr image."""
-            return stacked_image[:, :stacked_image.shape[1] // 3]
-
-        enc_basic_y = extract_y_channel(enc_basic)
-        enc_xor_y = extract_y_channel(enc_xor)
-
-        if original.shape != enc_basic_y.shape:
-            enc_basic_y = np.array(Image.fromarray(enc_basic_y).resize(
-                (original.shape[1], original.shape[0])))
-        if original.shape != enc_xor_y.shape:
-            enc_xor_y = np.array(Image.fromarray(enc_xor_y).resize(
-                (original.shape[1], original.shape[0])))
-
-        diff_basic = original != enc_basic_y
-        diff_xor = original != enc_xor_y
-
-        npcr_basic = np.sum(diff_basic) / diff_basic.size * 100
-        uaci_basic = np.mean(np.abs(original.astype(
-            np.int8) - enc_basic_y.astype(np.int8))) / 255 * 100
-
-        npcr_xor = np.sum(diff_xor) / diff_xor.size * 100
-        uaci_xor = np.mean(np.abs(original.astype(
-            np.int8) - enc_xor_y.astype(np.int8))) / 255 * 100
-
-        npcr_basic_list.append(npcr_basic)
-        uaci_basic_list.append(uaci_basic)
-        npcr_xor_list.append(npcr_xor)
-        uaci_xor_list.append(uaci_xor)
+    rows = results if results is not None else evaluate(
+        input_dir, encrypted_dir=encrypted_dir, metrics=("npcr", "uaci"))
+
+    npcr_basic_list, npcr_xor_list = _paired(rows, "npcr")
+    uaci_basic_list, uaci_xor_list = _paired(rows, "uaci")
 
     mean_npcr_basic = np.mean(npcr_basic_list)
     mean_uaci_basic = np.mean(uaci_basic_list)
@@ -208,34 +137,12 @@ def plot_npcr_uaci(input_dir: Path, encrypted_dir: Path) -> None:
     plt.show()
 
 
-def evaluate_block_adjacency(encrypted_dir: Path) -> None:
+def evaluate_block_adjacency(encrypted_dir: Path, results: Results = None) -> None:
     """Evaluate and print mean block adjacency scores for basic and XOR modes."""
-    block_basic, block_xor = [], []
-
-    for path in encrypted_dir.glob('*_14_q95.jpg'):
-        base = path.stem.replace('_encrypted_14_q95', '')
-        enc_basic = open_jpeg(str(path), as_array=True)
-        enc_xor = open_jpeg(
-            str(encrypted_dir / f"{base}_encrypted_15_q95.jpg"), as_array=True)
-
-        scores_basic, scores_xor = [], []
-
-        for img, scores in [(enc_basic, scores_basic), (enc_xor, scores_xor)]:
-            h, w = img.shape
-            for i in range(0, h - BLOCK_SIZE, BLOCK_SIZE):
-                for j in range(0, w - BLOCK_SIZE, BLOCK_SIZE):
-                    block = img[i:i+BLOCK_SIZE, j:j+BLOCK_SIZE]
-                    right = img[i:i+BLOCK_SIZE, j+BLOCK_SIZE:j+2 *
-                                BLOCK_SIZE] if j + 2*BLOCK_SIZE <= w else None
-                    down = img[i+BLOCK_SIZE:i+2*BLOCK_SIZE, j:j +
-                               BLOCK_SIZE] if i + 2*BLOCK_SIZE <= h else None
-                    if right is not None:
-                        scores.append(ssim(block, right))
-                    if down is not None:
-                        scores.append(ssim(block, down))
-
-        block_basic.append(np.mean(scores_basic))
-        block_xor.append(np.mean(scores_xor))
+    rows = results if results is not None else evaluate(
+        encrypted_dir, encrypted_dir=encrypted_dir, metrics=("block_adjacency",))
+
+    block_basic, block_xor = _paired(rows, "block_adjacency")
 
     print(f"Mean Block Adjacency Score Basic: {np.mean(block_basic):.6f}")
     print(f"Mean Block Adjacency Score XOR  : {np.mean(block_xor):.6f}")
@@ -0,0 +1,455 @@
+import re
+import struct
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from config import BLOCK_SIZE
+
+
+# Natural (row-major) index of the k-th coefficient in zigzag order.
+ZIGZAG = np.array([
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+])
+
+# Annex K.3 Huffman tables: (code counts per length 1..16, symbols).
+STANDARD_TABLES = {
+    (0, 0): ([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12))),
+    (0, 1): ([0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], list(range(12))),
+    (1, 0): ([0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d], bytes.fromhex(
+        "01020300041105122131410613516107227114328191a1082342b1c11552d1f0"
+        "2433627282090a161718191a25262728292a3435363738393a434445464748494a"
+        "535455565758595a636465666768696a737475767778797a838485868788898a"
+        "92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6"
+        "c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa")),
+    (1, 1): ([0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77], bytes.fromhex(
+        "000102031104052131061241510761711322328108144291a1b1c109233352f0"
+        "156272d10a162434e125f11718191a262728292a35363738393a434445464748"
+        "494a535455565758595a636465666768696a737475767778797a828384858687"
+        "88898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3"
+        "c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8f9fa")),
+}
+
+
+@dataclass
+class Component:
+    id: int
+    h: int
+    v: int
+    tq: int
+    # Quantized coefficients in natural order, shape (blocks_h, blocks_w, 8, 8).
+    coefficients: Optional[np.ndarray] = None
+
+
+@dataclass
+class JpegCoefficients:
+    width: int
+    height: int
+    components: List[Component]
+    quant_tables: Dict[int, np.ndarray]
+    # APPn / COM segments copied verbatim to the output.
+    extra_segments: List[bytes] = field(default_factory=list)
+
+    def quant_table(self, component: Component) -> np.ndarray:
+        return self.quant_tables[component.tq]
+
+
+def _huffman_codes(counts, symbols) -> Dict[int, Tuple[int, int]]:
+    codes, code, k = {}, 0, 0
+    for length, count in enumerate(counts, start=1):
+        for _ in range(count):
+            codes[symbols[k]] = (code, length)
+            code, k = code + 1, k + 1
+        code <<= 1
+    return codes
+
+
+def _lookup_table(counts, symbols) -> List[int]:
+    # Indexed by the next 16 bits; entries are length << 8 | symbol.
+    table = np.zeros(1 << 16, dtype=np.int32)
+    for symbol, (code, length) in _huffman_codes(counts, symbols).items():
+        start = code << (16 - length)
+        table[start:start + (1 << (16 - length))] = length << 8 | symbol
+    return table.tolist()
+
+
+def _fast_table(counts, symbols, ac: bool) -> List[int]:
+    # Indexed by the next 16 bits like _lookup_table. Where the code and its
+    # extra bits both fit in them, the entry is the total length, the zero
+    # run (AC) and the decoded value: length | run << 5 | (value + 32768) << 9.
+    # Other entries are 0 and take the slow path.
+    table = np.zeros(1 << 16, dtype=np.int64)
+    for symbol, (code, length) in _huffman_codes(counts, symbols).items():
+        run, size = (symbol >> 4, symbol & 15) if ac else (0, symbol)
+        if length + size > 16 or (ac and not size):
+            continue
+        start = code << (16 - length)
+        windows = np.arange(start, start + (1 << (16 - length)))
+        value = (windows >> (16 - length - size)) & ((1 << size) - 1)
+        if size:
+            value = np.where(value < 1 << (size - 1), value - (1 << size) + 1, value)
+        table[windows] = (length + size) | run << 5 | (value + 32768) << 9
+    return table.tolist()
+
+
+def _segments(data: bytes):
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+
+    pos = 2
+    while pos < len(data):
+        if data[pos] != 0xFF:
+            raise ValueError(f"Expected a marker at offset {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            return
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        body = data[pos + 4:pos + 2 + length]
+        pos += 2 + length
+
+        if marker != 0xDA:
+            yield marker, body, None
+            continue
+
+        end = pos
+        while True:
+            end = data.find(b"\xff", end)
+            if end < 0:
+                raise ValueError("Unterminated entropy-coded segment")
+            if data[end + 1] == 0 or 0xD0 <= data[end + 1] <= 0xD7:
+                end += 2
+                continue
+            break
+        yield marker, body, data[pos:end]
+        pos = end
+
+
+def _decode_scan(entropy: bytes, scan, mcus: int, mcu_layout, dc_tables, ac_tables,
+                 outputs, restart_interval: int) -> None:
+    segments = re.split(rb"\xff[\xd0-\xd7]", entropy)
+    interval = restart_interval or mcus
+
+    for segment_index, segment in enumerate(segments):
+        buf = list(segment.replace(b"\xff\x00", b"\xff")) + [0, 0, 0, 0]
+        pos = 0
+        preds = [0] * len(scan)
+        first = segment_index * interval
+
+        for mcu in range(first, min(first + interval, mcus)):
+            for ci, (comp_index, td, ta) in enumerate(scan):
+                (dc_table, dc_fast), (ac_table, ac_fast) = dc_tables[td], ac_tables[ta]
+                out = outputs[comp_index]
+                for base in mcu_layout(ci, mcu):
+                    i = pos >> 3
+                    window = ((buf[i] << 16 | buf[i + 1] << 8 | buf[i + 2]) >> (8 - (pos & 7))) & 0xFFFF
+                    fast = dc_fast[window]
+                    if fast:
+                        pos += fast & 31
+                        diff = (fast >> 9) - 32768
+                    else:
+                        entry = dc_table[window]
+                        pos += entry >> 8
+                        s = entry & 0xFF
+                        diff = 0
+                        if s:
+                            i = pos >> 3
+                            diff = ((buf[i] << 16 | buf[i + 1] << 8 | buf[i + 2])
+                                    >> (24 - s - (pos & 7))) & ((1 << s) - 1)
+                            pos += s
+                            if diff < 1 << (s - 1):
+                                diff -= (1 << s) - 1
+                    preds[ci] += diff
+                    out[base] = preds[ci]
+
+                    k = 1
+                    while k < 64:
+                        i = pos >> 3
+                        window = ((buf[i] << 16 | buf[i + 1] << 8 | buf[i + 2]) >> (8 - (pos & 7))) & 0xFFFF
+                        fast = ac_fast[window]
+                        if fast:
+                            pos += fast & 31
+                            k += (fast >> 5) & 15
+                            out[base + k] = (fast >> 9) - 32768
+                            k += 1
+                            continue
+                        entry = ac_table[window]
+                        pos += entry >> 8
+                        rs = entry & 0xFF
+                        s = rs & 15
+                        if not s:
+                            if rs != 0xF0:
+                                break
+                            k += 16
+                            continue
+                        k += rs >> 4
+                        i = pos >> 3
+                        value = ((buf[i] << 16 | buf[i + 1] << 8 | buf[i + 2])
+                                 >> (24 - s - (pos & 7))) & ((1 << s) - 1)
+                        pos += s
+                        if value < 1 << (s - 1):
+                            value -= (1 << s) - 1
+                        out[base + k] = value
+                        k += 1
+
+
+def read_coefficients(data: bytes) -> JpegCoefficients:
+    """Read the quantized DCT blocks of a baseline (sequential Huffman) JPEG."""
+    quant_tables, dc_tables, ac_tables, extra = {}, {}, {}, []
+    jpeg, restart_interval, outputs = None, 0, None
+
+    for marker, body, entropy in _segments(data):
+        if marker == 0xDB:
+            pos = 0
+            while pos < len(body):
+                pq, tq = body[pos] >> 4, body[pos] & 15
+                size = 128 if pq else 64
+                values = np.frombuffer(body[pos + 1:pos + 1 + size], dtype=">u2" if pq else np.uint8)
+                table = np.empty(64, dtype=np.int32)
+                table[ZIGZAG] = values
+                quant_tables[tq] = table.reshape(BLOCK_SIZE, BLOCK_SIZE)
+                pos += 1 + size
+        elif marker == 0xC4:
+            pos = 0
+            while pos < len(body):
+                tc, th = body[pos] >> 4, body[pos] & 15
+                counts = list(body[pos + 1:pos + 17])
+                symbols = body[pos + 17:pos + 17 + sum(counts)]
+                (ac_tables if tc else dc_tables)[th] = (_lookup_table(counts, symbols),
+                                                        _fast_table(counts, symbols, ac=bool(tc)))
+                pos += 17 + sum(counts)
+        elif marker == 0xDD:
+            restart_interval = struct.unpack(">H", body[:2])[0]
+        elif marker in (0xC0, 0xC1):
+            if body[0] != 8:
+                raise ValueError("Only 8-bit JPEGs are supported")
+            height, width, count = struct.unpack(">HHB", body[1:6])
+            components = [Component(id=body[6 + 3 * i], h=body[7 + 3 * i] >> 4,
+                                    v=body[7 + 3 * i] & 15, tq=body[8 + 3 * i])
+                          for i in range(count)]
+            jpeg = JpegCoefficients(width=width, height=height, components=components,
+                                    quant_tables=quant_tables, extra_segments=extra)
+            mcus_y, mcus_x = _mcu_grid(jpeg)
+            outputs = [array("i", bytes(4 * mcus_y * c.v * mcus_x * c.h * 64)) for c in components]
+        elif 0xC2 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            raise ValueError("Only baseline (sequential Huffman) JPEGs are supported")
+        elif marker == 0xDA:
+            _read_scan(jpeg, body, entropy, dc_tables, ac_tables, outputs, restart_interval)
+        elif 0xE0 <= marker <= 0xEF or marker == 0xFE:
+            extra.append(bytes([0xFF, marker]) + struct.pack(">H", len(body) + 2) + body)
+
+    mcus_y, mcus_x = _mcu_grid(jpeg)
+    for component, out in zip(jpeg.components, outputs):
+        zigzag = np.frombuffer(out, dtype=np.int32).reshape(-1, 64)
+        natural = np.empty_like(zigzag)
+        natural[:, ZIGZAG] = zigzag
+        component.coefficients = natural.reshape(
+            mcus_y * component.v, mcus_x * component.h, BLOCK_SIZE, BLOCK_SIZE)
+
+    return jpeg
+
+
+def _ceil_div(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def _mcu_grid(jpeg: JpegCoefficients) -> Tuple[int, int]:
+    h_max = max(c.h for c in jpeg.components)
+    v_max = max(c.v for c in jpeg.components)
+    return (_ceil_div(jpeg.height, BLOCK_SIZE * v_max), _ceil_div(jpeg.width, BLOCK_SIZE * h_max))
+
+
+def _component_blocks(jpeg: JpegCoefficients, component: Component) -> Tuple[int, int]:
+    # Blocks covering the component itself, as used by non-interleaved scans.
+    h_max = max(c.h for c in jpeg.components)
+    v_max = max(c.v for c in jpeg.components)
+    return (_ceil_div(_ceil_div(jpeg.height * component.v, v_max), BLOCK_SIZE),
+            _ceil_div(_ceil_div(jpeg.width * component.h, h_max), BLOCK_SIZE))
+
+
+def _read_scan(jpeg, body, entropy, dc_tables, ac_tables, outputs, restart_interval) -> None:
+    count = body[0]
+    ids = [c.id for c in jpeg.components]
+    scan = [(ids.index(body[1 + 2 * i]), body[2 + 2 * i] >> 4, body[2 + 2 * i] & 15)
+            for i in range(count)]
+    mcus_y, mcus_x = _mcu_grid(jpeg)
+
+    if count == 1:
+        component = jpeg.components[scan[0][0]]
+        rows, cols = _component_blocks(jpeg, component)
+        stride = mcus_x * component.h
+
+        def layout(_, mcu):
+            return ((mcu // cols * stride + mcu % cols) * 64,)
+
+        mcus = rows * cols
+    else:
+        def layout(ci, mcu):
+            component = jpeg.components[scan[ci][0]]
+            stride = mcus_x * component.h
+            top, left = mcu // mcus_x * component.v, mcu % mcus_x * component.h
+            return [((top + y) * stride + left + x) * 64
+                    for y in range(component.v) for x in range(component.h)]
+
+        mcus = mcus_y * mcus_x
+
+    _decode_scan(entropy, scan, mcus, layout, dc_tables, ac_tables, outputs, restart_interval)
+
+
+def _scan_order(jpeg: JpegCoefficients) -> Tuple[np.ndarray, np.ndarray]:
+    """Component index and flat block index of every block in scan order."""
+    if len(jpeg.components) == 1:
+        component = jpeg.components[0]
+        rows, cols = _component_blocks(jpeg, component)
+        stride = component.coefficients.shape[1]
+        y, x = np.divmod(np.arange(rows * cols), cols)
+        return np.zeros(rows * cols, dtype=np.int64), y * stride + x
+
+    mcus_y, mcus_x = _mcu_grid(jpeg)
+    mcu_y, mcu_x = np.divmod(np.arange(mcus_y * mcus_x), mcus_x)
+    comp_parts, block_parts = [], []
+    for ci, component in enumerate(jpeg.components):
+        y, x = np.divmod(np.arange(component.v * component.h), component.h)
+        rows = mcu_y[:, None] * component.v + y
+        cols = mcu_x[:, None] * component.h + x
+        block_parts.append(rows * (mcus_x * component.h) + cols)
+        comp_parts.append(np.full(rows.shape, ci))
+
+    return (np.concatenate(comp_parts, axis=1).ravel(),
+            np.concatenate(block_parts, axis=1).ravel())
+
+
+def _code_arrays(table_class: int, table_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    codes = np.zeros(256, dtype=np.int64)
+    lengths = np.zeros(256, dtype=np.int64)
+    for symbol, (code, length) in _huffman_codes(*STANDARD_TABLES[table_class, table_id]).items():
+        codes[symbol], lengths[symbol] = code, length
+    return codes, lengths
+
+
+def _bit_sizes(values: np.ndarray) -> np.ndarray:
+    # frexp's exponent of |v| is its bit length (0 for 0), exact for 16-bit values.
+    return np.frexp(np.abs(values).astype(np.float64))[1].astype(np.int64)
+
+
+def _entropy_tokens(jpeg: JpegCoefficients) -> Tuple[np.ndarray, np.ndarray]:
+    comp_index, block_index = _scan_order(jpeg)
+    zigzag = np.empty((len(comp_index), 64), dtype=np.int64)
+    for ci, component in enumerate(jpeg.components):
+        selected = comp_index == ci
+        zigzag[selected] = component.coefficients.reshape(-1, 64)[block_index[selected]][:, ZIGZAG]
+    table_id = (comp_index > 0).astype(np.int64)
+    num_blocks = len(comp_index)
+
+    # DC differences per component, in scan order.
+    dc = zigzag[:, 0]
+    diff = np.empty_like(dc)
+    for ci in range(len(jpeg.components)):
+        selected = np.flatnonzero(comp_index == ci)
+        diff[selected] = np.diff(dc[selected], prepend=0)
+
+    block, k = np.nonzero(zigzag[:, 1:])
+    k += 1
+    values = zigzag[block, k]
+    first = np.r_[True, block[1:] != block[:-1]]
+    runs = k - np.where(first, 0, np.r_[0, k[:-1]]) - 1
+    zrl = runs // 16
+
+    last_k = np.zeros(num_blocks, dtype=np.int64)
+    last_k[block] = k
+    has_eob = last_k < 63
+
+    # The tokens of a block are DC, (ZRLs, AC)*, EOB; each one is written
+    # straight to its place in the stream.
+    steps = zrl + 1
+    ac_tokens = np.bincount(block, weights=steps, minlength=num_blocks).astype(np.int64)
+    counts = 1 + ac_tokens + has_eob
+    block_start = np.cumsum(counts) - counts
+    ac_pos = block_start[block] + np.cumsum(steps) - (np.cumsum(ac_tokens) - ac_tokens)[block]
+    zrl_rank = np.arange(zrl.sum()) - np.repeat(np.cumsum(zrl) - zrl, zrl)
+    zrl_pos = np.repeat(ac_pos - zrl, zrl) + zrl_rank
+    eob_blocks = np.flatnonzero(has_eob)
+    eob_pos = block_start[eob_blocks] + counts[eob_blocks] - 1
+
+    total = int(counts.sum())
+    symbols = np.zeros(total, dtype=np.int64)
+    amplitudes = np.zeros(total, dtype=np.int64)
+    # Row of the code tables below: class (DC 0, AC 1) * 2 + table id.
+    tables = np.empty(total, dtype=np.int64)
+    symbols[block_start], amplitudes[block_start], tables[block_start] = _bit_sizes(diff), diff, table_id
+    symbols[zrl_pos], tables[zrl_pos] = 0xF0, 2 + np.repeat(table_id[block], zrl)
+    symbols[ac_pos], amplitudes[ac_pos] = (runs % 16) << 4 | _bit_sizes(values), values
+    tables[ac_pos] = 2 + table_id[block]
+    tables[eob_pos] = 2 + table_id[eob_blocks]
+
+    code_tables = [_code_arrays(tc, th) for tc in (0, 1) for th in (0, 1)]
+    codes = np.stack([table_codes for table_codes, _ in code_tables])[tables, symbols]
+    lengths = np.stack([table_lengths for _, table_lengths in code_tables])[tables, symbols]
+
+    sizes = symbols & 15
+    extra = np.where(amplitudes < 0, amplitudes + (1 << sizes) - 1, amplitudes)
+
+    values = np.stack([codes, extra], axis=1).ravel()
+    widths = np.stack([lengths, sizes], axis=1).ravel()
+    return values, widths
+
+
+def _pack_bits(values: np.ndarray, widths: np.ndarray, chunk_size: int = 1 << 20) -> bytes:
+    # A code or extra-bits field is at most 16 bits long, so with its offset
+    # in its first byte it lies within 3 bytes. Fields never share bits, so
+    # every byte is the sum of the parts that land in it.
+    ends = np.cumsum(widths)
+    total = int(ends[-1]) if len(ends) else 0
+    packed = np.zeros(total // 8 + 3, dtype=np.int64)
+
+    for start in range(0, len(values), chunk_size):
+        w = widths[start:start + chunk_size]
+        offsets = ends[start:start + chunk_size] - w
+        first = offsets >> 3
+        base = int(first[0])
+        shifted = values[start:start + chunk_size] << (24 - w - (offsets & 7))
+        for lane in range(3):
+            parts = np.bincount(first - base + lane, weights=(shifted >> (16 - 8 * lane)) & 0xFF)
+            packed[base:base + len(parts)] += parts.astype(np.int64)
+
+    # Pad the final byte with 1-bits, then stuff a zero byte after every 0xFF.
+    packed = packed[:-(-total // 8)]
+    if total % 8:
+        packed[-1] |= (1 << (8 - total % 8)) - 1
+    return packed.astype(np.uint8).tobytes().replace(b"\xff", b"\xff\x00")
+
+
+def write_coefficients(jpeg: JpegCoefficients) -> bytes:
+    """Entropy-code the blocks back into a baseline JPEG with the Annex K tables."""
+    parts = [b"\xff\xd8"] + jpeg.extra_segments
+
+    for tq, table in sorted(jpeg.quant_tables.items()):
+        values = table.ravel()[ZIGZAG]
+        pq = int(values.max() > 255)
+        body = bytes([pq << 4 | tq]) + values.astype(">u2" if pq else np.uint8).tobytes()
+        parts.append(b"\xff\xdb" + struct.pack(">H", len(body) + 2) + body)
+
+    sof = struct.pack(">BHHB", 8, jpeg.height, jpeg.width, len(jpeg.components))
+    sof += b"".join(bytes([c.id, c.h << 4 | c.v, c.tq]) for c in jpeg.components)
+    parts.append(b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof)
+
+    used = [(0, 0), (1, 0)] + ([(0, 1), (1, 1)] if len(jpeg.components) > 1 else [])
+    for tc, th in used:
+        counts, symbols = STANDARD_TABLES[tc, th]
+        body = bytes([tc << 4 | th]) + bytes(counts) + bytes(symbols)
+        parts.append(b"\xff\xc4" + struct.pack(">H", len(body) + 2) + body)
+
+    sos = bytes([len(jpeg.components)])
+    sos += b"".join(bytes([c.id, 0x00 if i == 0 else 0x11]) for i, c in enumerate(jpeg.components))
+    sos += bytes([0, 63, 0])
+    parts.append(b"\xff\xda" + struct.pack(">H", len(sos) + 2) + sos)
+
+    parts.append(_pack_bits(*_entropy_tokens(jpeg)))
+    parts.append(b"\xff\xd9")
+
+    return b"".join(parts)
@@ -1,31 +1,121 @@
 from PIL import Image
 import numpy as np
+from typing import Optional, Tuple
+from config import BLOCK_SIZE
 
 
-def convert_and_stack_ycbcr(img: Image) -> np.ndarray:
-    ycbcr_img = img.convert('YCbCr')
+def convert_and_stack_ycbcr(img: Image, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # A YCbCr image (see open_jpeg_ycbcr) is used as is, without a conversion.
+    ycbcr_img = img if img.mode == 'YCbCr' else img.convert('YCbCr')
+    h, w = ycbcr_img.height, ycbcr_img.width
 
-    y, cb, cr = ycbcr_img.split()
+    # out may be larger than the stacked image (e.g. a padded buffer); the
+    # planes are written into its top-left corner.
+    if out is None:
+        out = np.empty((h, 3 * w), dtype=np.uint8)
+    stacked_img_np = out[:h, :3 * w]
 
-    y_np = np.array(y)
-    cb_np = np.array(cb)
-    cr_np = np.array(cr)
-
-    stacked_img_np = np.hstack([y_np, cb_np, cr_np])
+    for c, band in enumerate(ycbcr_img.split()):
+        stacked_img_np[:, c * w:(c + 1) * w] = np.asarray(band)
 
     return stacked_img_np
 
 
-def restore_from_stacked_ycbcr(stacked_img_np: np.ndarray) -> Image:
-    _, w3 = stacked_img_np.shape
+def unstack_ycbcr(stacked_img_np: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    h, w3 = stacked_img_np.shape
     w = w3 // 3
 
-    y_np = stacked_img_np[:, 0:w]
-    cb_np = stacked_img_np[:, w:2*w]
-    cr_np = stacked_img_np[:, 2*w:3*w]
+    if out is None:
+        out = np.empty((h, w, 3), dtype=np.uint8)
+
+    for c in range(3):
+        out[:, :, c] = stacked_img_np[:, c * w:(c + 1) * w]
+
+    return out
 
-    ycbcr_img_np = np.stack([y_np, cb_np, cr_np], axis=-1).astype(np.uint8)
+
+def ycbcr_to_image(ycbcr_img_np: np.ndarray, mode: str = 'RGB') -> Image:
     ycbcr_img = Image.fromarray(ycbcr_img_np, mode='YCbCr')
-    img = ycbcr_img.convert('RGB')
 
-    return img
+    return ycbcr_img if mode == 'YCbCr' else ycbcr_img.convert(mode)
+
+
+def restore_from_stacked_ycbcr(stacked_img_np: np.ndarray, mode: str = 'RGB') -> Image:
+    """Rebuild the colour image from its stacked planes; ``mode='YCbCr'`` skips
+    the RGB conversion, e.g. when the image is only re-encoded as JPEG."""
+    w = stacked_img_np.shape[1] // 3
+    planes = [Image.fromarray(np.ascontiguousarray(stacked_img_np[:, c * w:(c + 1) * w]))
+              for c in range(3)]
+    img = Image.merge('YCbCr', planes)
+
+    return img if mode == 'YCbCr' else img.convert(mode)
+
+
+# Chroma subsampling factors (vertical, horizontal) of the subsampled layouts.
+SUBSAMPLING = {"4:2:2": (1, 2), "4:2:0": (2, 2)}
+
+
+def subsampled_shape(shape: Tuple[int, int], subsampling: str) -> Tuple[int, int]:
+    """Shape of the stacked image: Y over a strip holding Cb and Cr side by side.
+
+    Y is edge-padded so that the downsampled Cb and Cr planes are whole
+    blocks, which keeps every block inside a single plane.
+    """
+    fy, fx = SUBSAMPLING[subsampling]
+    h, w = shape
+    unit_h, unit_w = BLOCK_SIZE * fy, BLOCK_SIZE * fx
+    padded_h = (h + unit_h - 1) // unit_h * unit_h
+    padded_w = (w + unit_w - 1) // unit_w * unit_w
+    return padded_h + padded_h // fy, padded_w
+
+
+def stack_subsampled_ycbcr(img: Image, subsampling: str, out: Optional[np.ndarray] = None) -> np.ndarray:
+    fy, fx = SUBSAMPLING[subsampling]
+    ycbcr_img = img if img.mode == 'YCbCr' else img.convert('YCbCr')
+    h, w = ycbcr_img.height, ycbcr_img.width
+    stacked_h, stacked_w = subsampled_shape((h, w), subsampling)
+    padded_h = stacked_h * fy // (fy + 1)
+
+    if out is None:
+        out = np.empty((stacked_h, stacked_w), dtype=np.uint8)
+    stacked_img_np = out[:stacked_h, :stacked_w]
+
+    luma = stacked_img_np[:padded_h]
+    luma[:h, :w] = np.asarray(ycbcr_img.getchannel(0))
+    luma[:h, w:] = luma[:h, w - 1:w]
+    luma[h:] = luma[h - 1:h]
+
+    # Box filter over each fy x fx cell; partial cells at the edges average
+    # what they cover and the planes are then edge-padded to whole blocks.
+    chroma = np.asarray(ycbcr_img.reduce((fx, fy)))
+    chroma_w = stacked_w // fx
+    strip = stacked_img_np[padded_h:]
+    for c in range(2):
+        plane = strip[:, c * chroma_w:(c + 1) * chroma_w]
+        ch, cw = chroma.shape[:2]
+        plane[:ch, :cw] = chroma[:, :, c + 1]
+        plane[:ch, cw:] = plane[:ch, cw - 1:cw]
+        plane[ch:] = plane[ch - 1:ch]
+
+    return stacked_img_np
+
+
+def restore_from_subsampled_ycbcr(stacked_img_np: np.ndarray, size: Tuple[int, int], subsampling: str,
+                                  mode: str = 'RGB') -> Image:
+    """Upsample Cb and Cr back to full resolution and crop to the source ``size`` (h, w)."""
+    fy, fx = SUBSAMPLING[subsampling]
+    stacked_h, stacked_w = stacked_img_np.shape
+    padded_h = stacked_h * fy // (fy + 1)
+    chroma_w = stacked_w // fx
+    h, w = size
+
+    planes = [Image.fromarray(np.ascontiguousarray(stacked_img_np[:h, :w]))]
+    for c in range(2):
+        plane = Image.fromarray(np.ascontiguousarray(
+            stacked_img_np[padded_h:, c * chroma_w:(c + 1) * chroma_w]))
+        # Scaling only the source region that covers the image skips a crop.
+        planes.append(plane.resize((w, h), Image.BILINEAR, box=(0, 0, w / fx, h / fy)))
+
+    img = Image.merge('YCbCr', planes)
+
+    return img if mode == 'YCbCr' else img.convert(mode)
@@ -1,38 +1,71 @@
 import numpy as np
-from typing import Tuple
+from typing import Iterator, Optional, Tuple
 from config import BLOCK_SIZE
 
 
-def pad_to_block_size(img_np: np.ndarray) -> np.ndarray:
+def padded_shape(shape: Tuple[int, int]) -> Tuple[int, int]:
+    h, w = shape
+    return (((h + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE,
+            ((w + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE)
+
+
+def strip_ranges(height: int, tile_rows: int) -> Iterator[Tuple[int, int]]:
+    """Row ranges of horizontal strips that are ``tile_rows`` blocks high."""
+    strip_height = tile_rows * BLOCK_SIZE
+    for top in range(0, height, strip_height):
+        yield top, min(top + strip_height, height)
+
+
+def _is_corner_view(img_np: np.ndarray, out: np.ndarray) -> bool:
+    return (img_np.__array_interface__["data"][0] == out.__array_interface__["data"][0]
+            and img_np.strides == out.strides)
+
+
+def pad_to_block_size(img_np: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
     h, w = img_np.shape
-    pad_h = (BLOCK_SIZE - h % BLOCK_SIZE) % BLOCK_SIZE
-    pad_w = (BLOCK_SIZE - w % BLOCK_SIZE) % BLOCK_SIZE
 
-    padded_img_np = np.pad(img_np, ((0, pad_h), (0, pad_w)), mode='edge')
+    if out is None:
+        pad_h = (BLOCK_SIZE - h % BLOCK_SIZE) % BLOCK_SIZE
+        pad_w = (BLOCK_SIZE - w % BLOCK_SIZE) % BLOCK_SIZE
 
-    return padded_img_np
+        padded_img_np = np.pad(img_np, ((0, pad_h), (0, pad_w)), mode='edge')
 
+        return padded_img_np
 
-def divide_into_blocks(img_np: np.ndarray) -> np.ndarray:
+    # Edge padding in place; img_np may already be the top-left view of out.
+    if not _is_corner_view(img_np, out):
+        out[:h, :w] = img_np
+    out[:h, w:] = out[:h, w - 1:w]
+    out[h:, :] = out[h - 1:h, :]
+
+    return out
+
+
+def divide_into_blocks(img_np: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
     h, w = img_np.shape
-    blocks = (img_np.reshape(h // BLOCK_SIZE, BLOCK_SIZE, w // BLOCK_SIZE, BLOCK_SIZE)
-              .swapaxes(1, 2)
-              .reshape(-1, BLOCK_SIZE, BLOCK_SIZE))
+    grid = img_np.reshape(h // BLOCK_SIZE, BLOCK_SIZE, w // BLOCK_SIZE, BLOCK_SIZE).swapaxes(1, 2)
 
-    return blocks
+    if out is None:
+        return grid.reshape(-1, BLOCK_SIZE, BLOCK_SIZE)
 
+    out.reshape(grid.shape)[...] = grid
 
-def merge_blocks(blocks: np.ndarray, original_shape: Tuple[int, int]) -> np.ndarray:
+    return out
+
+
+def merge_blocks(blocks: np.ndarray, original_shape: Tuple[int, int],
+                 out: Optional[np.ndarray] = None) -> np.ndarray:
     h, w = original_shape
-    padded_h = ((h + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
-    padded_w = ((w + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+    padded_h, padded_w = padded_shape(original_shape)
     num_blocks_w = padded_w // BLOCK_SIZE
 
-    merged = (
-        blocks.reshape(padded_h // BLOCK_SIZE,
-                       num_blocks_w, BLOCK_SIZE, BLOCK_SIZE)
-        .swapaxes(1, 2)
-        .reshape(padded_h, padded_w)
-    )
+    grid = blocks.reshape(padded_h // BLOCK_SIZE,
+                          num_blocks_w, BLOCK_SIZE, BLOCK_SIZE).swapaxes(1, 2)
+
+    if out is None:
+        merged = grid.reshape(padded_h, padded_w)
+    else:
+        merged = out.reshape(padded_h, padded_w)
+        merged.reshape(grid.shape)[...] = grid
 
     return merged[:h, :w]
@@ -5,11 +5,27 @@ from typing import Union
 
 def open_jpeg(path: str, as_array: bool = False) -> Union[Image.Image, np.ndarray]:
     img = Image.open(path)
-    return np.array(img.convert('L')) if as_array else img.convert("RGB")
+    if as_array:
+        return np.array(img if img.mode == "L" else img.convert('L'))
+    return img.convert("RGB")
+
+
+def open_jpeg_ycbcr(path: str) -> Image.Image:
+    """Open an image in YCbCr mode; JPEGs are decoded without a colour conversion."""
+    img = Image.open(path)
+    if img.mode == "RGB":
+        # Asks libjpeg for its native YCbCr output instead of RGB.
+        img.draft("YCbCr", img.size)
+    if img.mode == "YCbCr":
+        img.load()
+        return img
+    return img.convert("RGB").convert("YCbCr")
 
 
 def save_jpeg(path: str, img: Union[Image.Image, np.ndarray], quality: int = 100) -> None:
     if isinstance(img, np.ndarray):
-        img = Image.fromarray(img.astype(np.uint8)).convert("L")
+        img = Image.fromarray(img.astype(np.uint8, copy=False))
+        if img.mode != "L":
+            img = img.convert("L")
 
     img.save(path, format="JPEG", quality=quality)
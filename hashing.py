@@ -0,0 +1,16 @@
+import hashlib
+from pathlib import Path
+from typing import Union
+
+
+def file_digest(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    """BLAKE2b hex digest of a file's content; empty string if it does not exist."""
+    path = Path(path)
+    if not path.is_file():
+        return ""
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+
+COUNTERS = ("bytes_in", "bytes_out", "blocks")
+
+
+class LogSink:
+    """One log line per finished stage."""
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger("jpeg_encryption")
+        self.level = level
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        counters = " ".join(f"{k}={record[k]}" for k in COUNTERS if k in record)
+        self.logger.log(self.level, "%s %.6fs %s", record["stage"], record["seconds"], counters)
+
+    def close(self) -> None:
+        pass
+
+
+class JsonLinesSink:
+    """Appends every finished stage to a JSON-lines file."""
+
+    def __init__(self, path: Union[str, Path]):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class PrometheusSink:
+    """Aggregates stages into Prometheus text-format counters, written on close."""
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, prefix: str = "jpeg_encryption_stage"):
+        self.path = Path(path) if path else None
+        self.prefix = prefix
+        self.totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        totals = self.totals[record["stage"]]
+        totals["calls"] += 1
+        totals["seconds"] += record["seconds"]
+        for counter in COUNTERS:
+            totals[counter] += record.get(counter, 0)
+
+    def render(self) -> str:
+        lines = []
+        for metric in ("calls", "seconds") + COUNTERS:
+            name = f"{self.prefix}_{metric}_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, totals in sorted(self.totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {totals[metric]:g}')
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        if self.path is not None:
+            self.path.write_text(self.render())
+
+
+class ListSink:
+    """Keeps records in memory, e.g. to ship them back from a worker process."""
+
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        self.records.append(record)
+
+    def close(self) -> None:
+        pass
+
+
+class Collector:
+    """Times nested pipeline stages and hands each finished one to its sinks.
+
+    Stage names are joined along the nesting, e.g. ``encrypt_image/encrypt/permute``.
+    The ``record`` yielded by :meth:`stage` takes counters set inside the block.
+    """
+
+    enabled = True
+
+    def __init__(self, sinks: Iterable[Any] = ()):
+        self.sinks = list(sinks)
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str, **counters):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(name)
+        record = {"stage": "/".join(stack), **counters}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            stack.pop()
+            self.emit(record)
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+class NullCollector:
+    """The default: every stage is a shared no-op context."""
+
+    enabled = False
+    _null = nullcontext({})
+
+    def stage(self, name: str, **counters):
+        return self._null
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+_collector: Union[Collector, NullCollector] = NullCollector()
+
+
+def get_collector() -> Union[Collector, NullCollector]:
+    return _collector
+
+
+def set_collector(collector: Optional[Collector]) -> Union[Collector, NullCollector]:
+    """Install ``collector`` (None disables instrumentation) and return the previous one."""
+    global _collector
+    previous, _collector = _collector, collector or NullCollector()
+    return previous
+
+
+def stage(name: str, **counters):
+    return _collector.stage(name, **counters)
+
+
+def make_collector(kind: str, path: Optional[Union[str, Path]] = None) -> Collector:
+    """Collector with a single sink: ``log``, ``jsonl`` or ``prometheus``."""
+    if kind == "log":
+        return Collector([LogSink()])
+    if kind == "jsonl":
+        return Collector([JsonLinesSink(path or "metrics.jsonl")])
+    if kind == "prometheus":
+        return Collector([PrometheusSink(path or "metrics.prom")])
+    raise ValueError(f"Unknown metrics sink: {kind}")
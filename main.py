@@ -1,16 +1,19 @@
 import argparse
+import logging
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Any, Tuple
-from crypto.operations import encrypt, decrypt, export_key_to_string, import_key_from_string
-from graphic.utils import open_jpeg, save_jpeg
-from graphic.io import convert_and_stack_ycbcr, restore_from_stacked_ycbcr
-from graphic.operations import pad_to_block_size, divide_into_blocks, merge_blocks
-from config import INPUT_DIR, ENCRYPTED_DIR, DECRYPTED_DIR
+from typing import Any, Dict, List, Optional, Tuple
+from instrumentation import Collector, ListSink, get_collector, make_collector, set_collector, stage
+from config import INPUT_DIR, ENCRYPTED_DIR, DECRYPTED_DIR, KEY_ARCHIVE, BATCH_MANIFEST
 
 
-INPUT_DIR.mkdir(exist_ok=True)
-ENCRYPTED_DIR.mkdir(exist_ok=True)
-DECRYPTED_DIR.mkdir(exist_ok=True)
+# numpy, Pillow and the pipeline are imported inside the functions that use
+# them, so -e/-d and daemon clients only load what they need.
 
 
 def get_output_path(input_path: Path, batch_dir: Path, operation_type: str, ops_flag: int, jpeg_quality: int, batch: bool = False) -> str:
@@ -30,41 +33,489 @@ def get_output_path(input_path: Path, batch_dir: Path, operation_type: str, ops_
         return str(input_path.parent / filename)
 
 
-def encrypt_image(path: Path, ops_flag: int, jpeg_quality: int, batch: bool = False) -> Tuple[Any, Path]:
+def encrypt_image(path: Path, ops_flag: int, jpeg_quality: int, batch: bool = False, seeded: bool = False,
+                  tile_rows: Optional[int] = None, subsampling: Optional[str] = None,
+                  threads: int = 1) -> Tuple[Any, Path]:
     # -------- ENCRYPT --------
-    img = open_jpeg(str(path))
+    from pipeline import encrypt_jpeg_bytes
+    data = Path(path).read_bytes()
+    with stage("encrypt_image", bytes_in=len(data)) as record:
+        encrypted, key = encrypt_jpeg_bytes(data, ops_flag, jpeg_quality, seeded, tile_rows,
+                                            subsampling=subsampling, threads=threads)
 
-    stacked = convert_and_stack_ycbcr(img)
-    padded = pad_to_block_size(stacked)
-    blocks = divide_into_blocks(padded)
+        encrypted_img_path = Path(get_output_path(
+            path, ENCRYPTED_DIR, "encrypted", ops_flag, jpeg_quality, batch))
+        encrypted_img_path.write_bytes(encrypted)
+        record["bytes_out"] = len(encrypted)
 
-    encrypted_blocks, key = encrypt(blocks, ops_flag)
-    encrypted_img = merge_blocks(encrypted_blocks, stacked.shape)
+    return key, encrypted_img_path
 
-    encrypted_img_path = get_output_path(
-        path, ENCRYPTED_DIR, "encrypted", ops_flag, jpeg_quality, batch)
-    save_jpeg(encrypted_img_path, encrypted_img, jpeg_quality)
 
-    return key, Path(encrypted_img_path)
+def decrypt_image(path: Path, ops_flag: int, key, jpeg_quality: int, batch: bool = False,
+                  threads: int = 1) -> None:
+    # -------- DECRYPT --------
+    from pipeline import decrypt_jpeg_bytes
+    data = Path(path).read_bytes()
+    with stage("decrypt_image", bytes_in=len(data)) as record:
+        decrypted = decrypt_jpeg_bytes(data, key, threads=threads)
 
+        Path(get_output_path(path, DECRYPTED_DIR, "decrypted", ops_flag, jpeg_quality, batch)
+             ).write_bytes(decrypted)
+        record["bytes_out"] = len(decrypted)
 
-def decrypt_image(path: Path, ops_flag: int, key, jpeg_quality: int, batch: bool = False) -> None:
-    # -------- DECRYPT --------
-    encrypted_reloaded = open_jpeg(str(path), as_array=True)
 
-    padded = pad_to_block_size(encrypted_reloaded)
-    blocks = divide_into_blocks(padded)
-    decrypted_blocks = decrypt(blocks, key)
+def decrypt_image_region(path: Path, key, box: Optional[Tuple[int, int, int, int]] = None,
+                         step: Optional[int] = None) -> Path:
+    # -------- DECRYPT (region or preview) --------
+    from region import decrypt_jpeg_region
+    data = Path(path).read_bytes()
+    with stage("decrypt_image_region", bytes_in=len(data)) as record:
+        decrypted = decrypt_jpeg_region(data, key, box, step)
 
-    decrypted_img = restore_from_stacked_ycbcr(
-        merge_blocks(decrypted_blocks, encrypted_reloaded.shape)
-    )
+        output = Path(get_output_path(path, DECRYPTED_DIR, "decrypted", 0, 0))
+        output = output.with_name(f"{output.stem}_{f'preview{step}' if step else 'roi'}{output.suffix}")
+        output.write_bytes(decrypted)
+        record["bytes_out"] = len(decrypted)
 
-    save_jpeg(get_output_path(path, DECRYPTED_DIR, "decrypted",
-              ops_flag, jpeg_quality, batch), decrypted_img)
+    return output
 
 
-def main():
+def encrypt_image_dct(path: Path, ops_flag: int, jpeg_quality: int, batch: bool = False,
+                      seeded: bool = False) -> Tuple[Any, Path]:
+    # -------- ENCRYPT (DCT coefficient domain) --------
+    from pipeline import encrypt_jpeg_bytes
+    data = Path(path).read_bytes()
+    with stage("encrypt_image_dct", bytes_in=len(data)) as record:
+        encrypted, key = encrypt_jpeg_bytes(data, ops_flag, seeded=seeded, dct=True)
+
+        encrypted_img_path = Path(get_output_path(
+            path, ENCRYPTED_DIR, "encrypted", ops_flag, jpeg_quality, batch))
+        encrypted_img_path.write_bytes(encrypted)
+        record["bytes_out"] = len(encrypted)
+
+    return key, encrypted_img_path
+
+
+def decrypt_image_dct(path: Path, ops_flag: int, key, jpeg_quality: int, batch: bool = False) -> None:
+    # -------- DECRYPT (DCT coefficient domain) --------
+    from pipeline import decrypt_jpeg_bytes
+    data = Path(path).read_bytes()
+    with stage("decrypt_image_dct", bytes_in=len(data)) as record:
+        decrypted = decrypt_jpeg_bytes(data, key, dct=True)
+
+        Path(get_output_path(path, DECRYPTED_DIR, "decrypted", ops_flag, jpeg_quality, batch)
+             ).write_bytes(decrypted)
+        record["bytes_out"] = len(decrypted)
+
+
+def encrypt_image_sweep(path: Path, ops_flag: int, qualities: List[int], batch: bool = False,
+                        seeded: bool = False, tile_rows: Optional[int] = None,
+                        subsampling: Optional[str] = None) -> Tuple[Any, List[Path]]:
+    # -------- ENCRYPT ONCE, ENCODE + DECRYPT PER QUALITY --------
+    from pipeline import encrypt_jpeg_sweep
+    data = Path(path).read_bytes()
+    with stage("encrypt_image_sweep", bytes_in=len(data)) as record:
+        key, variants = encrypt_jpeg_sweep(data, qualities, ops_flag, seeded, tile_rows, subsampling)
+
+        written = []
+        for quality, encrypted, decrypted in variants:
+            encrypted_img_path = Path(get_output_path(
+                path, ENCRYPTED_DIR, "encrypted", ops_flag, quality, batch))
+            encrypted_img_path.write_bytes(encrypted)
+            decrypted_img_path = Path(get_output_path(
+                encrypted_img_path, DECRYPTED_DIR, "decrypted", ops_flag, quality, batch))
+            decrypted_img_path.write_bytes(decrypted)
+            written += [encrypted_img_path, decrypted_img_path]
+        record["bytes_out"] = sum(len(encrypted) for _, encrypted, _ in variants)
+
+    return key, written
+
+
+def encrypt_images(paths: List[Path], ops_flag: int, jpeg_quality: int, seeded: bool = False,
+                   subsampling: Optional[str] = None) -> List[Tuple[Any, Path, Path]]:
+    """Encrypt and decrypt several images with one batched transform pass each way."""
+    from pipeline import encrypt_jpeg_batch, decrypt_jpeg_batch
+    datas = [Path(path).read_bytes() for path in paths]
+    encrypted = encrypt_jpeg_batch(datas, ops_flag, jpeg_quality, seeded, subsampling)
+
+    encrypted_paths = []
+    for path, (data, _) in zip(paths, encrypted):
+        encrypted_paths.append(Path(get_output_path(
+            path, ENCRYPTED_DIR, "encrypted", ops_flag, jpeg_quality, batch=True)))
+        encrypted_paths[-1].write_bytes(data)
+
+    keys = [key for _, key in encrypted]
+    decrypted_paths = []
+    for path, data in zip(encrypted_paths, decrypt_jpeg_batch([data for data, _ in encrypted], keys)):
+        decrypted_paths.append(Path(get_output_path(
+            path, DECRYPTED_DIR, "decrypted", ops_flag, jpeg_quality, batch=True)))
+        decrypted_paths[-1].write_bytes(data)
+
+    return list(zip(keys, encrypted_paths, decrypted_paths))
+
+
+def process_batch_chunk(paths: List[Path], ops_flag: int, jpeg_quality: int, seeded: bool,
+                        tile_rows: Optional[int] = None, instrument: bool = False,
+                        subsampling: Optional[str] = None, qualities: Optional[List[int]] = None) -> Tuple[List[Tuple[Path, Any, Optional[str]]], List[dict]]:
+    # A worker process records its stages in memory and ships them back so
+    # the parent's sinks see every image.
+    sink = ListSink()
+    previous = set_collector(Collector([sink])) if instrument else None
+    results = []
+    try:
+        if not tile_rows and not qualities and len(paths) > 1:
+            try:
+                for path, (key, _, _) in zip(paths, encrypt_images(
+                        paths, ops_flag, jpeg_quality, seeded, subsampling)):
+                    results.append((path, key, None))
+                return results, sink.records
+            except Exception:
+                # One bad file fails the whole batch; redo it image by image
+                # so only that file is reported.
+                results = []
+
+        for path in paths:
+            try:
+                if qualities:
+                    key, _ = encrypt_image_sweep(path, ops_flag, qualities, batch=True, seeded=seeded,
+                                                 tile_rows=tile_rows, subsampling=subsampling)
+                    results.append((path, key, None))
+                    continue
+                key, temp_path = encrypt_image(
+                    path, ops_flag, jpeg_quality, batch=True, seeded=seeded, tile_rows=tile_rows,
+                    subsampling=subsampling)
+                decrypt_image(temp_path, ops_flag, key, jpeg_quality, batch=True)
+                results.append((path, key, None))
+            except Exception as e:
+                results.append((path, None, f"{type(e).__name__}: {e}"))
+    finally:
+        if instrument:
+            set_collector(previous)
+    return results, sink.records
+
+
+def run_batch(paths: List[Path], ops_flag: int, jpeg_quality: int, seeded: bool,
+              workers: int, chunk_size: int = 4, tile_rows: Optional[int] = None,
+              subsampling: Optional[str] = None, force: bool = False,
+              qualities: Optional[List[int]] = None) -> int:
+    from concurrent.futures import ProcessPoolExecutor
+    from crypto.archive import KeyArchive
+    from crypto.keys import SeededKeys
+    from crypto.plans import share_plan_cache
+    from manifest import BatchManifest
+    from parallel import bounded_map, chunked
+
+    for directory in (ENCRYPTED_DIR, DECRYPTED_DIR):
+        directory.mkdir(exist_ok=True)
+    archive = KeyArchive(KEY_ARCHIVE)
+    manifest = BatchManifest(BATCH_MANIFEST)
+    # Tiled keys are always seeded.
+    params = {"ops": ops_flag, "jq": qualities or jpeg_quality,
+              "key_mode": "seeded" if seeded or tile_rows else "legacy",
+              "tile": tile_rows, "chroma": subsampling}
+
+    def key_ids(path: Path) -> List[str]:
+        # One key record per encrypted output, so outputs of earlier runs
+        # with other -ops/-jq keep their own keys.
+        return [Path(get_output_path(path, ENCRYPTED_DIR, "encrypted", ops_flag, quality, batch=True)).stem
+                for quality in qualities or [jpeg_quality]]
+
+    # Images whose content, parameters, outputs and keys are all still in
+    # place are skipped unless --force is given.
+    fingerprints = {path: manifest.fingerprint(path) for path in paths}
+    for path in paths:
+        manifest.refresh(path, fingerprints[path])
+    pending = [path for path in paths if force or any(key_id not in archive for key_id in key_ids(path))
+               or not manifest.is_current(path, fingerprints[path], params)]
+    if len(pending) < len(paths):
+        print(f"Skipping {len(paths) - len(pending)} unchanged images")
+
+    collector = get_collector()
+    task = partial(process_batch_chunk, ops_flag=ops_flag, jpeg_quality=jpeg_quality, seeded=seeded,
+                   tile_rows=tile_rows, instrument=collector.enabled and workers > 1,
+                   subsampling=subsampling, qualities=qualities)
+    chunks = chunked(pending, chunk_size)
+    done = failed = 0
+    start = time.perf_counter()
+
+    def report(chunk_result):
+        nonlocal done, failed
+        results, records = chunk_result
+        for record in records:
+            collector.emit(record)
+        for path, key, error in results:
+            done += 1
+            if error is None:
+                # Only this process writes the archive, so appends never interleave.
+                archive.extend((key_id, key) for key_id in key_ids(path))
+                outputs = []
+                for quality in qualities or [jpeg_quality]:
+                    outputs.append(Path(get_output_path(
+                        path, ENCRYPTED_DIR, "encrypted", ops_flag, quality, batch=True)))
+                    outputs.append(get_output_path(
+                        outputs[-1], DECRYPTED_DIR, "decrypted", ops_flag, quality, batch=True))
+                key_mode = "seeded" if isinstance(key, SeededKeys) else "legacy"
+                manifest.record(path, fingerprints[path], dict(params, key_mode=key_mode), outputs)
+            else:
+                failed += 1
+                print(f"Failed {path}: {error}")
+        rate = done / (time.perf_counter() - start)
+        print(f"[{done}/{len(pending)}] {rate:.2f} images/s")
+
+    try:
+        if workers <= 1:
+            for chunk in chunks:
+                report(task(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=share_plan_cache,
+                                     initargs=(workers,)) as executor:
+                for results in bounded_map(executor, task, chunks, max_in_flight=2 * workers):
+                    report(results)
+    finally:
+        # Saved even after an interruption so finished images are not redone.
+        manifest.save()
+
+    return failed
+
+
+def quality_range(text: str) -> List[int]:
+    start, stop, step = (int(part) for part in text.split(":"))
+    qualities = list(range(start, stop, step))
+    if not qualities or not all(1 <= q <= 100 for q in qualities):
+        raise argparse.ArgumentTypeError(f"{text} gives no qualities in 1-100")
+    return qualities
+
+
+def region_box(text: str) -> Tuple[int, int, int, int]:
+    left, top, right, bottom = (int(value) for value in text.split(","))
+    if left >= right or top >= bottom:
+        raise argparse.ArgumentTypeError(f"{text} needs LEFT < RIGHT and TOP < BOTTOM")
+    return left, top, right, bottom
+
+
+def process_member(member: Tuple[str, bytes], ops_flag: int, jpeg_quality: int, seeded: bool,
+                   tile_rows: Optional[int] = None, subsampling: Optional[str] = None,
+                   qualities: Optional[List[int]] = None, instrument: bool = False
+                   ) -> Tuple[str, List[Tuple[str, bytes]], Any, Optional[str], List[dict]]:
+    # Archive counterpart of process_batch_chunk for one in-memory member:
+    # returns the output members named as batch mode names its files, under
+    # the member's own folder.
+    from pipeline import encrypt_jpeg_bytes, decrypt_jpeg_bytes, encrypt_jpeg_sweep
+    from pathlib import PurePosixPath
+    from streaming import member_id
+    name, data = member
+    sink = ListSink()
+    previous = set_collector(Collector([sink])) if instrument else None
+    try:
+        with stage("encrypt_member", bytes_in=len(data)):
+            if qualities:
+                key, variants = encrypt_jpeg_sweep(data, qualities, ops_flag, seeded, tile_rows, subsampling)
+            else:
+                encrypted, key = encrypt_jpeg_bytes(data, ops_flag, jpeg_quality, seeded, tile_rows,
+                                                    subsampling=subsampling)
+                variants = [(jpeg_quality, encrypted, decrypt_jpeg_bytes(encrypted, key))]
+
+        outputs = []
+        folder = Path(member_id(name)).parent
+        for quality, encrypted, decrypted in variants:
+            encrypted_name = Path(get_output_path(
+                Path(PurePosixPath(name).name), ENCRYPTED_DIR / folder, "encrypted", ops_flag, quality, batch=True))
+            outputs.append((encrypted_name.as_posix(), encrypted))
+            outputs.append((Path(get_output_path(
+                encrypted_name, DECRYPTED_DIR / folder, "decrypted", ops_flag, quality,
+                batch=True)).as_posix(), decrypted))
+        return name, outputs, key, None, sink.records
+    except Exception as e:
+        return name, [], None, f"{type(e).__name__}: {e}", sink.records
+    finally:
+        if instrument:
+            set_collector(previous)
+
+
+def run_archive(source: str, dest: str, keys_path: Path, ops_flag: int, jpeg_quality: int,
+                seeded: bool, workers: int, tile_rows: Optional[int] = None,
+                subsampling: Optional[str] = None, qualities: Optional[List[int]] = None) -> int:
+    """Stream the JPEG members of a tar/zip archive (or stdin) through the
+    pipeline into an output archive, with the keys in a key archive beside it.
+
+    At most 2 * workers members are in memory; reading, processing and
+    writing overlap.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from crypto.archive import KeyArchive
+    from crypto.plans import share_plan_cache
+    from parallel import bounded_map
+    from pathlib import PurePosixPath
+    from streaming import ArchiveWriter, iter_members
+
+    archive = KeyArchive(keys_path)
+    collector = get_collector()
+    task = partial(process_member, ops_flag=ops_flag, jpeg_quality=jpeg_quality, seeded=seeded,
+                   tile_rows=tile_rows, subsampling=subsampling, qualities=qualities,
+                   instrument=collector.enabled and workers > 1)
+    done = failed = 0
+    seen = set()
+    start = time.perf_counter()
+
+    # Even with one worker the member runs on a pool thread, so the next
+    # member is read (and the previous one written) in the meantime.
+    executor = (ProcessPoolExecutor(max_workers=workers, initializer=share_plan_cache, initargs=(workers,))
+                if workers > 1 else ThreadPoolExecutor(max_workers=1))
+    with executor, ArchiveWriter(dest) as writer:
+        for name, outputs, key, error, records in bounded_map(
+                executor, task, iter_members(source), max_in_flight=2 * max(workers, 1)):
+            for record in records:
+                collector.emit(record)
+            done += 1
+            # Keys are stored under each encrypted output's path below
+            # encrypted_images/, without the suffix.
+            key_ids = [PurePosixPath(output_name).relative_to(ENCRYPTED_DIR.as_posix()).with_suffix("").as_posix()
+                       for output_name, _ in outputs[::2]]
+            if error is None and seen.intersection(key_ids):
+                error = f"Another member already has the key ID {key_ids[0]}"
+            if error is None:
+                seen.update(key_ids)
+                archive.extend((key_id, key) for key_id in key_ids)
+                for output_name, data in outputs:
+                    writer.add(output_name, data)
+            else:
+                failed += 1
+                print(f"Failed {name}: {error}", file=sys.stderr)
+            # stdout may be the output archive, so progress goes to stderr.
+            print(f"[{done}] {done / (time.perf_counter() - start):.2f} images/s", file=sys.stderr)
+
+    return failed
+
+
+def process_frame(frame: Tuple[int, str, bytes], ops_flag: int, jpeg_quality: int, secret: int,
+                  geometry: Tuple[int, int], sequence: Any = None, keys: Any = None,
+                  tile_rows: Optional[int] = None, subsampling: Optional[str] = None
+                  ) -> Tuple[str, Optional[bytes], Any, Optional[str]]:
+    # Sequence counterpart of process_member. Source frame i is encrypted
+    # under frame_secret(secret, i). With a sequence record, i is the frame's
+    # position in the encrypted sequence and it is decrypted with the index
+    # and low-variance bits of its FrameKeys record in the key archive.
+    import io
+    from PIL import Image
+    from crypto.archive import frame_id
+    from crypto.keys import frame_secret
+    from pipeline import encrypt_jpeg_bytes, decrypt_jpeg_bytes
+    index, name, data = frame
+    try:
+        size = Image.open(io.BytesIO(data)).size
+        if size != geometry:
+            raise ValueError(f"Frame is {size[0]}x{size[1]}, the sequence {geometry[0]}x{geometry[1]}")
+        if sequence is not None:
+            if frame_id(index) not in keys:
+                raise ValueError(f"The key archive has no record for frame {index}")
+            record = keys[frame_id(index)]
+            key = sequence.frame(record.index, record.low_variance)
+            with stage("decrypt_frame", bytes_in=len(data)):
+                return name, decrypt_jpeg_bytes(data, key), key, None
+        with stage("encrypt_frame", bytes_in=len(data)):
+            encrypted, key = encrypt_jpeg_bytes(
+                data, ops_flag, jpeg_quality, True, tile_rows, subsampling=subsampling,
+                secret=frame_secret(secret, index))
+        return name, encrypted, key, None
+    except Exception as e:
+        return name, None, None, f"{type(e).__name__}: {e}"
+
+
+def run_sequence(source: str, dest: str, keys_path: Path, ops_flag: int, jpeg_quality: int,
+                 workers: int, tile_rows: Optional[int] = None, subsampling: Optional[str] = None,
+                 decrypt: bool = False, target_fps: Optional[float] = None) -> int:
+    """Encrypt (or decrypt) a frame sequence, a directory of same-size JPEGs
+    or an MJPEG stream, into a directory or MJPEG stream in frame order.
+
+    The geometry is taken from the first frame and must not change. Frames
+    run on ``workers`` threads, so decoding, transforming and encoding of
+    consecutive frames overlap, while reading and writing happen on this
+    one. Each thread reuses its buffers from frame to frame. Frame keys are
+    always seeded: the key archive gets one SequenceKeys record (secret,
+    geometry, ops and layout) and per written frame a FrameKeys record with
+    its source index (and low-variance bits with intensity modulation), from
+    which decryption rebuilds the frame's key. Failed frames are skipped and
+    counted in the return value. The frame rate is reported on stderr.
+    """
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import chain
+    from PIL import Image
+    from crypto.archive import SEQUENCE_ID, KeyArchive, frame_id
+    from crypto.keys import FrameKeys, SequenceKeys
+    from crypto.operations import new_secret
+    from parallel import ordered_map
+    from streaming import FrameWriter, iter_frames
+
+    if decrypt and not keys_path.is_file():
+        print(f"Key archive {keys_path} does not exist.", file=sys.stderr)
+        return 1
+    archive = KeyArchive(keys_path)
+    sequence = None
+    if decrypt:
+        if SEQUENCE_ID not in archive:
+            print(f"Key archive {keys_path} has no sequence record.", file=sys.stderr)
+            return 1
+        sequence = archive[SEQUENCE_ID]
+
+    frames = iter_frames(source)
+    first = next(frames, None)
+    if first is None:
+        print(f"No frames in {source}", file=sys.stderr)
+        return 0
+
+    geometry = Image.open(io.BytesIO(first[1])).size
+    secret = new_secret()
+    threads = max(workers, 1)
+    task = partial(process_frame, ops_flag=ops_flag, jpeg_quality=jpeg_quality, secret=secret,
+                   geometry=geometry, sequence=sequence, keys=archive if decrypt else None,
+                   tile_rows=tile_rows, subsampling=subsampling)
+    done = failed = written = 0
+    keys = []
+    start = time.perf_counter()
+    first_done = None
+
+    with ThreadPoolExecutor(max_workers=threads) as executor, FrameWriter(dest) as writer:
+        for index, (name, data, key, error) in enumerate(ordered_map(
+                executor, task, ((index, name, data) for index, (name, data) in enumerate(chain([first], frames))),
+                max_in_flight=2 * threads)):
+            done += 1
+            first_done = first_done or time.perf_counter()
+            if error is not None:
+                failed += 1
+                print(f"Failed {name}: {error}", file=sys.stderr)
+                continue
+            writer.add(name, data)
+            written += 1
+            if decrypt:
+                continue
+            if sequence is None:
+                # Every frame shares the layout of the first one encrypted.
+                sequence = SequenceKeys(secret=secret, geometry=geometry, num_blocks=key.num_blocks,
+                                        ops_flag=key.ops_flag, tile_blocks=key.tile_blocks,
+                                        subsampling=key.subsampling, source_size=key.source_size)
+                keys.append((SEQUENCE_ID, sequence))
+            keys.append((frame_id(written - 1), FrameKeys(index=index, num_blocks=key.num_blocks,
+                                                          low_variance=key.low_variance)))
+            if len(keys) >= 64:
+                archive.extend(keys)
+                keys.clear()
+        if keys:
+            archive.extend(keys)
+
+    elapsed = time.perf_counter() - start
+    # The first frame pays for the thread pool and buffers.
+    sustained = (done - 1) / (time.perf_counter() - first_done) if done > 1 else done / elapsed
+    print(f"{written} frames of {geometry[0]}x{geometry[1]} in {elapsed:.2f} s: "
+          f"{done / elapsed:.2f} fps, {sustained:.2f} fps after the first frame", file=sys.stderr)
+    if failed:
+        print(f"{failed} frames failed and were not written", file=sys.stderr)
+    if target_fps and sustained < target_fps:
+        print(f"Below the target of {target_fps:g} fps", file=sys.stderr)
+    return failed
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", nargs=1, metavar="IMAGE",
                         help="Encrypt a single image")
@@ -74,45 +525,293 @@ def main():
                         help="Operation bitmask for encryption")
     parser.add_argument("-jq", type=int, default=95,
                         help="JPEG compression quality")
-    args = parser.parse_args()
+    parser.add_argument("--jq-sweep", type=quality_range, metavar="START:STOP:STEP",
+                        help="Encrypt once and encode/decrypt at every quality in range(START, STOP, STEP)")
+    parser.add_argument("-km", choices=["legacy", "seeded"],
+                        help="Key mode: full per-block keys or a per-image secret (default: legacy; "
+                             "--sequence is always seeded)")
+    parser.add_argument("-tile", type=int, metavar="BLOCK_ROWS",
+                        help="Encrypt in strips of this many block rows (implies seeded keys)")
+    parser.add_argument("-chroma", choices=["4:4:4", "4:2:2", "4:2:0"], default="4:4:4",
+                        help="Stack Cb/Cr at full resolution or downsampled below Y")
+    parser.add_argument("-dct", action="store_true",
+                        help="Encrypt/decrypt quantized DCT blocks directly (baseline JPEG, -ops without XOR)")
+    parser.add_argument("-roi", type=region_box, metavar="LEFT,TOP,RIGHT,BOTTOM",
+                        help="With -d: decrypt only this rectangle of the image")
+    parser.add_argument("-preview", type=int, metavar="K",
+                        help="With -d: decrypt every K-th block into a 1/(8K)-scale preview")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes for batch, archive and daemon mode; frame threads for --sequence")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads for the block transforms of a single -e/-d image")
+    parser.add_argument("--chunk-size", type=int, default=4,
+                        help="Images per batched transform pass in batch mode")
+    parser.add_argument("--force", action="store_true",
+                        help="Batch mode: redo images the manifest records as up to date")
+    parser.add_argument("--changed-since", type=datetime.fromisoformat, metavar="DATETIME",
+                        help="Batch mode: only consider inputs modified at or after this ISO date/time")
+    parser.add_argument("--archive-in", metavar="ARCHIVE",
+                        help="Read input JPEGs from a tar/zip archive ('-' for a tar stream on stdin)")
+    parser.add_argument("--archive-out", metavar="ARCHIVE",
+                        help="Write encrypted/decrypted images to this tar/zip archive ('-' for stdout)")
+    parser.add_argument("--archive-keys", metavar="FILE",
+                        help="Key archive for --archive-in or --sequence (default: ARCHIVE.jfek for the output "
+                             "archive or encrypted sequence, or the batch key archive when that is '-')")
+    parser.add_argument("--sequence", metavar="SOURCE",
+                        help="Encrypt a frame sequence: a directory of same-size JPEG frames or an MJPEG file "
+                             "('-' for stdin)")
+    parser.add_argument("--sequence-out", metavar="DEST",
+                        help="Output directory, or .mjpeg/.mjpg file ('-' for stdout), for --sequence")
+    parser.add_argument("--sequence-decrypt", action="store_true",
+                        help="Decrypt the --sequence frames with the keys in --archive-keys instead")
+    parser.add_argument("--fps", type=float, metavar="TARGET",
+                        help="Frame rate --sequence has to sustain; a warning is printed when it falls short")
+    parser.add_argument("--daemon", metavar="SOCKET",
+                        help="Serve -e/-d jobs on this Unix socket from a warm process "
+                             "(with a pool of --workers processes if > 1)")
+    parser.add_argument("--socket", metavar="SOCKET",
+                        help="Submit this -e/-d job to the daemon on SOCKET instead of running it here")
+    parser.add_argument("--metrics", choices=["log", "jsonl", "prometheus"],
+                        help="Record per-stage timings and counters")
+    parser.add_argument("--metrics-out", metavar="FILE",
+                        help="Output file for jsonl/prometheus metrics")
+    parser.add_argument("--profile", metavar="STATS",
+                        help="Run under cProfile and write the stats to this file")
+    return parser
 
-    if args.e:
-        path = Path(args.e[0])
-        if not path.is_file():
-            print(f"File {path} does not exist.")
-            return
 
-        key, _ = encrypt_image(path, args.ops, args.jq)
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    args.subsampling = None if args.chroma == "4:4:4" else args.chroma
+    if args.subsampling and (args.tile or args.dct):
+        parser.error("-chroma subsampling cannot be combined with -tile or -dct")
+    if bool(args.archive_in) != bool(args.archive_out):
+        parser.error("--archive-in and --archive-out must be given together")
+    if bool(args.sequence) != bool(args.sequence_out):
+        parser.error("--sequence and --sequence-out must be given together")
+    if args.sequence and (args.dct or args.jq_sweep or args.archive_in):
+        parser.error("--sequence cannot be combined with -dct, --jq-sweep or --archive-in")
+    if (args.sequence_decrypt or args.fps) and not args.sequence:
+        parser.error("--sequence-decrypt and --fps need --sequence")
+    if args.sequence and args.km == "legacy":
+        parser.error("--sequence derives its frame keys from one secret and cannot use -km legacy")
+    args.km = args.km or "legacy"
+    if args.jq_sweep and args.dct:
+        parser.error("--jq-sweep re-encodes pixels and cannot be combined with -dct")
+    if (args.roi or args.preview) and (not args.d or args.dct or (args.roi and args.preview)):
+        parser.error("-roi or -preview (not both) need -d and cannot be combined with -dct")
+    if args.preview is not None and args.preview < 1:
+        parser.error("-preview must be at least 1")
+    if args.socket and not (args.e or args.d):
+        parser.error("--socket only submits -e/-d jobs")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.socket:
+        sys.exit(submit_job(args.socket, sys.argv[1:]))
+    if args.daemon:
+        serve(args.daemon, args.workers)
+        return
+
+    if args.metrics == "log":
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.metrics:
+        set_collector(make_collector(args.metrics, args.metrics_out))
+
+    try:
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            failed = profiler.runcall(run, args)
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        else:
+            failed = run(args)
+    finally:
+        get_collector().close()
+    if failed:
+        sys.exit(1)
+
+
+def encrypt_command(args: argparse.Namespace) -> str:
+    from crypto.operations import export_key_to_string
+
+    path = Path(args.e[0])
+    if not path.is_file():
+        return f"File {path} does not exist."
+
+    if args.jq_sweep:
+        key, _ = encrypt_image_sweep(path, args.ops, args.jq_sweep, seeded=args.km == "seeded",
+                                     tile_rows=args.tile, subsampling=args.subsampling)
+    elif args.dct:
+        key, _ = encrypt_image_dct(path, args.ops, args.jq,
+                                   seeded=args.km == "seeded")
+    else:
+        key, _ = encrypt_image(path, args.ops, args.jq,
+                               seeded=args.km == "seeded", tile_rows=args.tile,
+                               subsampling=args.subsampling, threads=args.threads)
+
+    key_path = path.with_name(f"{path.stem}_key.txt")
+    key_path.write_text(export_key_to_string(key))
+
+    return ("Encryption complete. DO NOT LOSE THIS KEY FILE:\n"
+            f"{key_path}\n"
+            "\nRequired to decrypt this image.")
+
 
-        key_path = path.with_name(f"{path.stem}_key.txt")
-        key_path.write_text(export_key_to_string(key))
+def lookup_key(archive: Any, path: Path) -> Any:
+    """Key of the encrypted image ``path`` in a key archive.
 
-        print("Encryption complete. DO NOT LOSE THIS KEY FILE:")
-        print(key_path)
-        print("\nRequired to decrypt this image.")
+    Batch mode stores keys under the encrypted file's stem and archive mode
+    under its path below encrypted_images/, so the longest trailing part of
+    ``path`` that has a record wins. Archives written before keys were
+    stored per output are keyed by the original image name.
+    """
+    parts = path.absolute().with_suffix("").parts
+    for start in range(len(parts)):
+        key_id = "/".join(parts[start:])
+        if key_id in archive:
+            return archive[key_id]
+    return archive[path.stem.rsplit("_encrypted_", 1)[0]]
 
-    elif args.d:
-        path = Path(args.d[0])
-        key_path = Path(args.d[1])
 
-        if not path.is_file():
-            print(f"File {path} does not exist.")
-            return
-        if not key_path.is_file():
-            print(f"Key file {key_path} does not exist.")
-            return
+def decrypt_command(args: argparse.Namespace) -> str:
+    from crypto.archive import MAGIC, KeyArchive
+    from crypto.operations import import_key_from_string
 
+    path = Path(args.d[0])
+    key_path = Path(args.d[1])
+
+    if not path.is_file():
+        return f"File {path} does not exist."
+    if not key_path.is_file():
+        return f"Key file {key_path} does not exist."
+
+    try:
+        with open(key_path, "rb") as f:
+            is_archive = f.read(len(MAGIC)) == MAGIC
+        if is_archive:
+            key = lookup_key(KeyArchive(key_path), path)
+        else:
+            key = import_key_from_string(key_path.read_text().strip())
+    except Exception:
+        return "Invalid decryption key."
+
+    if args.roi or args.preview:
+        from region import RegionError
         try:
-            key_str = key_path.read_text().strip()
-            key = import_key_from_string(key_str)
-            decrypt_image(path, args.ops, key, args.jq)
+            decrypt_image_region(path, key, args.roi, args.preview)
+        except RegionError as e:
+            return f"Invalid region: {e}"
         except Exception:
-            print("Invalid decryption key.")
+            return "Invalid decryption key."
+        return ""
+
+    try:
+        if args.dct:
+            decrypt_image_dct(path, args.ops, key, args.jq)
+        else:
+            decrypt_image(path, args.ops, key, args.jq, threads=args.threads)
+    except Exception:
+        return "Invalid decryption key."
+    return ""
+
+
+def run_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Daemon handler: run the -e/-d command line in ``job["argv"]``, with
+    paths relative to the client's ``job["cwd"]``."""
+    args = parse_args(job["argv"])
+    if args.e:
+        args.e = [os.path.join(job["cwd"], args.e[0])]
+        return {"ok": True, "output": encrypt_command(args)}
+    if args.d:
+        args.d = [os.path.join(job["cwd"], path) for path in args.d]
+        return {"ok": True, "output": decrypt_command(args)}
+    return {"ok": False, "error": "Only -e/-d jobs can be run by the daemon"}
+
+
+def serve(socket_path: str, workers: int) -> None:
+    import importlib
+    from daemon import Daemon
+
+    # Loaded before any worker is forked so that every process starts warm.
+    importlib.import_module("pipeline")
 
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from crypto.plans import share_plan_cache
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=share_plan_cache, initargs=(workers,))
+
+    # SIGTERM unwinds like Ctrl-C, so the socket file is removed either way.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with Daemon(socket_path, run_job, executor) as server:
+        print(f"Serving on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+def submit_job(socket_path: str, argv: List[str]) -> int:
+    from daemon import submit
+
+    # The daemon gets the same command line minus --socket.
+    argv = list(argv)
+    index = argv.index("--socket") if "--socket" in argv else None
+    if index is not None:
+        del argv[index:index + 2]
     else:
-        for path in INPUT_DIR.glob("*.jpg"):
-            key, temp_path = encrypt_image(path, args.ops, args.jq, batch=True)
-            decrypt_image(temp_path, args.ops, key, args.jq, batch=True)
+        argv = [arg for arg in argv if not arg.startswith("--socket=")]
+
+    response = submit(socket_path, {"argv": argv, "cwd": os.getcwd()})
+    if not response["ok"]:
+        print(response["error"], file=sys.stderr)
+        return 1
+    if response["output"]:
+        print(response["output"])
+    return 0
+
+
+def run(args: argparse.Namespace) -> int:
+    """Run the selected mode; returns the number of images or frames that failed."""
+    if args.e or args.d:
+        output = encrypt_command(args) if args.e else decrypt_command(args)
+        if output:
+            print(output)
+        return 0
+
+    if args.sequence:
+        encrypted = args.sequence if args.sequence_decrypt else args.sequence_out
+        keys_path = Path(args.archive_keys or (
+            KEY_ARCHIVE if encrypted == "-" else f"{encrypted.rstrip('/')}.jfek"))
+        return run_sequence(args.sequence, args.sequence_out, keys_path, args.ops, args.jq,
+                            args.workers, tile_rows=args.tile, subsampling=args.subsampling,
+                            decrypt=args.sequence_decrypt, target_fps=args.fps)
+
+    if args.archive_in:
+        keys_path = Path(args.archive_keys or (
+            KEY_ARCHIVE if args.archive_out == "-" else f"{args.archive_out}.jfek"))
+        return run_archive(args.archive_in, args.archive_out, keys_path, args.ops, args.jq,
+                           args.km == "seeded", args.workers, tile_rows=args.tile,
+                           subsampling=args.subsampling, qualities=args.jq_sweep)
+
+    INPUT_DIR.mkdir(exist_ok=True)
+    paths = sorted(INPUT_DIR.glob("*.jpg"))
+    if args.changed_since:
+        since = args.changed_since.timestamp()
+        paths = [path for path in paths if path.stat().st_mtime >= since]
+    return run_batch(paths, args.ops, args.jq, args.km == "seeded", args.workers,
+                     chunk_size=args.chunk_size, tile_rows=args.tile, subsampling=args.subsampling,
+                     force=args.force, qualities=args.jq_sweep)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Union
+from hashing import file_digest
+
+
+class BatchManifest:
+    """Content hashes, parameters and outputs of every image a batch run has finished.
+
+    An image is up to date while its content hash and the run parameters
+    match the recorded ones and its outputs still exist. Hashes are reused
+    while a file's size and mtime are unchanged, so a re-run over a static
+    corpus only stats the inputs.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self.path.is_file():
+            self.entries = json.loads(self.path.read_text())
+
+    def fingerprint(self, path: Path) -> Dict[str, Any]:
+        # Stat before hashing: a file changed in between then looks changed
+        # on the next run instead of keeping a stale hash.
+        stat = path.stat()
+        entry = self.entries.get(str(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            digest = entry["hash"]
+        else:
+            digest = file_digest(path)
+        return {"hash": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def is_current(self, path: Path, fingerprint: Dict[str, Any], params: Dict[str, Any]) -> bool:
+        entry = self.entries.get(str(path))
+        return (entry is not None and entry["hash"] == fingerprint["hash"]
+                and entry["params"] == params
+                and all(Path(output).is_file() for output in entry["outputs"]))
+
+    def refresh(self, path: Path, fingerprint: Dict[str, Any]) -> None:
+        # A touched but unchanged file keeps its entry with the new size and
+        # mtime, so the next run takes the stat fast path again.
+        entry = self.entries.get(str(path))
+        if entry is not None and entry["hash"] == fingerprint["hash"]:
+            entry.update(fingerprint)
+
+    def record(self, path: Path, fingerprint: Dict[str, Any], params: Dict[str, Any],
+               outputs: List[Union[str, Path]]) -> None:
+        self.entries[str(path)] = {**fingerprint, "params": params,
+                                   "outputs": [str(output) for output in outputs]}
+
+    def save(self) -> None:
+        # Written to a temporary file first so an interrupted run never
+        # leaves a truncated manifest behind.
+        temp = self.path.with_suffix(self.path.suffix + ".tmp")
+        temp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+        os.replace(temp, self.path)
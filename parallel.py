@@ -0,0 +1,46 @@
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def bounded_map(executor: Executor, fn: Callable[[T], R], items: Iterable[T],
+                max_in_flight: int) -> Iterator[R]:
+    """Like executor.map, but submits lazily and yields results as they finish.
+
+    At most ``max_in_flight`` tasks are pending at any time, so memory stays
+    flat however long ``items`` is.
+    """
+    items = iter(items)
+    pending = set()
+
+    while True:
+        for item in islice(items, max_in_flight - len(pending)):
+            pending.add(executor.submit(fn, item))
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def ordered_map(executor: Executor, fn: Callable[[T], R], items: Iterable[T],
+                max_in_flight: int) -> Iterator[R]:
+    """Like bounded_map, but yields results in the order of ``items``."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
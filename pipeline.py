@@ -0,0 +1,374 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from PIL import Image
+from crypto.operations import encrypt, decrypt, new_secret
+from crypto.keys import SeededKeys, TransformKeys
+from crypto.batch import encrypt_batch, decrypt_batch
+from crypto.plans import encrypt_planned, decrypt_planned
+from crypto.coefficients import encrypt_coefficients, decrypt_coefficients
+from graphic.coefficients import read_coefficients, write_coefficients
+from graphic.utils import open_jpeg, open_jpeg_ycbcr, save_jpeg
+from graphic.io import (
+    convert_and_stack_ycbcr,
+    restore_from_stacked_ycbcr,
+    unstack_ycbcr,
+    ycbcr_to_image,
+    subsampled_shape,
+    stack_subsampled_ycbcr,
+    restore_from_subsampled_ycbcr,
+)
+from graphic.operations import pad_to_block_size, divide_into_blocks, merge_blocks, padded_shape, strip_ranges
+from instrumentation import stage
+from config import BLOCK_SIZE
+
+
+JpegData = Union[bytes, bytearray, memoryview, BinaryIO]
+
+
+def allocate_buffers(shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    # Two image-sized buffers are enough for the whole pipeline: the padded
+    # image and the block tensor swap roles after each reshuffle.
+    buffer = np.empty(padded_shape(shape), dtype=np.uint8)
+    scratch = np.empty((buffer.size // BLOCK_SIZE**2, BLOCK_SIZE, BLOCK_SIZE), dtype=np.uint8)
+    return buffer, scratch
+
+
+class BufferPool:
+    """Per-thread cache of allocate_buffers results for the most recent shapes.
+
+    Repeated calls on same-sized images (or strips) skip the allocation; the
+    buffers are only valid until the next call on the same thread.
+    """
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self._local = threading.local()
+
+    def get(self, shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+        pool = self._local.__dict__.setdefault("buffers", OrderedDict())
+        shape = padded_shape(shape)
+        if shape in pool:
+            pool.move_to_end(shape)
+            return pool[shape]
+
+        pool[shape] = allocate_buffers(shape)
+        if len(pool) > self.maxsize:
+            pool.popitem(last=False)
+        return pool[shape]
+
+
+buffer_pool = BufferPool()
+
+
+def encrypt_strips(img, ops_flag: int, tile_rows: int, threads: int = 1,
+                   secret: Optional[int] = None) -> Tuple[np.ndarray, SeededKeys]:
+    # Each strip of tile_rows block rows is stacked, padded, split, encrypted
+    # with its own permutation and merged before the next one is read.
+    h, w3 = shape = (img.height, 3 * img.width)
+    padded_h, padded_w = padded_shape(shape)
+    tile_blocks = tile_rows * padded_w // BLOCK_SIZE
+
+    key = SeededKeys(secret=new_secret() if secret is None else secret,
+                     num_blocks=padded_h * padded_w // BLOCK_SIZE**2, ops_flag=ops_flag, tile_blocks=tile_blocks)
+    encrypted_img = np.empty((padded_h, padded_w), dtype=np.uint8)
+    low_variance = []
+
+    for top, bottom in strip_ranges(h, tile_rows):
+        strip_shape = (bottom - top, w3)
+        buffer, scratch = buffer_pool.get(strip_shape)
+
+        stacked = convert_and_stack_ycbcr(img.crop((0, top, img.width, bottom)), out=buffer)
+        blocks = divide_into_blocks(pad_to_block_size(stacked, out=buffer), out=scratch)
+
+        encrypted_blocks, strip_key = encrypt(
+            blocks, ops_flag, key.secret, out=buffer.reshape(scratch.shape),
+            block_offset=top // BLOCK_SIZE * padded_w // BLOCK_SIZE, threads=threads)
+        merge_blocks(encrypted_blocks, buffer.shape, out=encrypted_img[top:top + buffer.shape[0]])
+
+        if strip_key.low_variance is not None:
+            low_variance.append(np.unpackbits(
+                np.frombuffer(strip_key.low_variance, dtype=np.uint8), count=len(blocks)))
+
+    if low_variance:
+        key.low_variance = np.packbits(np.concatenate(low_variance)).tobytes()
+
+    return encrypted_img[:h, :w3], key
+
+
+def decrypt_strips(encrypted_img: np.ndarray, key: SeededKeys, threads: int = 1) -> np.ndarray:
+    h, w3 = encrypted_img.shape
+    padded_w = padded_shape(encrypted_img.shape)[1]
+    tile_rows = key.tile_blocks * BLOCK_SIZE // padded_w
+    ycbcr = np.empty((h, w3 // 3, 3), dtype=np.uint8)
+
+    for top, bottom in strip_ranges(h, tile_rows):
+        strip_shape = (bottom - top, w3)
+        buffer, scratch = buffer_pool.get(strip_shape)
+
+        blocks = divide_into_blocks(
+            pad_to_block_size(encrypted_img[top:bottom], out=buffer), out=scratch)
+        start = top // BLOCK_SIZE * padded_w // BLOCK_SIZE
+        decrypted_blocks = decrypt(blocks, key.expand(start, start + len(blocks)),
+                                   out=buffer.reshape(scratch.shape), threads=threads)
+
+        unstack_ycbcr(merge_blocks(decrypted_blocks, strip_shape, out=scratch), out=ycbcr[top:bottom])
+
+    return ycbcr
+
+
+def _as_file(data: JpegData) -> BinaryIO:
+    return data if hasattr(data, "read") else io.BytesIO(data)
+
+
+def _as_bytes(data: JpegData) -> bytes:
+    return data.read() if hasattr(data, "read") else bytes(data)
+
+
+def encode_jpeg(img: Union[Image.Image, np.ndarray], quality: int = 100) -> bytes:
+    with stage("encode") as record:
+        output = io.BytesIO()
+        save_jpeg(output, img, quality)
+        record["bytes_out"] = output.tell()
+    return output.getvalue()
+
+
+def stacked_shape(img: Image.Image, subsampling: Optional[str] = None) -> Tuple[int, int]:
+    if subsampling:
+        return subsampled_shape((img.height, img.width), subsampling)
+    return img.height, 3 * img.width
+
+
+def stack_image(img: Image.Image, subsampling: Optional[str] = None,
+                out: Optional[np.ndarray] = None) -> np.ndarray:
+    if subsampling:
+        return stack_subsampled_ycbcr(img, subsampling, out=out)
+    return convert_and_stack_ycbcr(img, out=out)
+
+
+def _record_layout(key, img: Image.Image, subsampling: Optional[str]) -> None:
+    if subsampling:
+        key.subsampling = subsampling
+        key.source_size = (img.height, img.width)
+
+
+def restore_image(merged: np.ndarray, key, mode: str = "RGB") -> Image.Image:
+    if getattr(key, "subsampling", None):
+        return restore_from_subsampled_ycbcr(merged, key.source_size, key.subsampling, mode)
+    return restore_from_stacked_ycbcr(merged, mode)
+
+
+def encrypt_pixels(img: Image.Image, ops_flag: int, seeded: bool = False,
+                   tile_rows: Optional[int] = None, subsampling: Optional[str] = None,
+                   threads: int = 1, secret: Optional[int] = None) -> Tuple[np.ndarray, Any]:
+    """Encrypt an RGB image into its stacked grayscale form.
+
+    With ``subsampling`` ("4:2:2" or "4:2:0") Cb and Cr are stored
+    downsampled below Y and the layout is recorded in the key. Without tiling
+    the result is a view of a pooled buffer: encode or copy it before the
+    next call on this thread. ``threads`` > 1 runs the block transforms of
+    this one image in a thread pool; the output and key do not change.
+    Seeded keys use ``secret`` if given instead of a fresh one.
+    """
+    if tile_rows:
+        if subsampling:
+            raise ValueError("Tiled mode does not support chroma subsampling")
+        with stage("encrypt_strips"):
+            return encrypt_strips(img, ops_flag, tile_rows, threads, secret)
+
+    shape = stacked_shape(img, subsampling)
+    buffer, scratch = buffer_pool.get(shape)
+
+    with stage("convert_and_stack_ycbcr"):
+        stacked = stack_image(img, subsampling, out=buffer)
+
+    if not seeded:
+        # Legacy keys only depend on the geometry, which then gets a cached plan.
+        with stage("encrypt_planned", bytes_in=stacked.nbytes):
+            planned = encrypt_planned(buffer, shape, ops_flag, scratch.reshape(buffer.shape), threads)
+        if planned is not None:
+            merged, key = planned
+            _record_layout(key, img, subsampling)
+            return merged[:shape[0], :shape[1]], key
+
+    with stage("pad_divide") as counters:
+        padded = pad_to_block_size(stacked, out=buffer)
+        blocks = divide_into_blocks(padded, out=scratch)
+        counters["blocks"] = len(blocks)
+
+    if seeded and secret is None:
+        secret = new_secret()
+    with stage("encrypt", blocks=len(blocks), bytes_in=blocks.nbytes):
+        encrypted_blocks, key = encrypt(
+            blocks, ops_flag, secret if seeded else None, out=buffer.reshape(scratch.shape),
+            threads=threads)
+    with stage("merge"):
+        encrypted_img = merge_blocks(encrypted_blocks, shape, out=scratch)
+
+    _record_layout(key, img, subsampling)
+    return encrypted_img, key
+
+
+def decrypt_pixels(encrypted_img: np.ndarray, key, mode: str = "RGB", threads: int = 1) -> Image.Image:
+    """Decrypt a stacked grayscale image back into an RGB (or ``mode``) image."""
+    if getattr(key, "tile_blocks", None):
+        with stage("decrypt_strips"):
+            return ycbcr_to_image(decrypt_strips(encrypted_img, key, threads), mode)
+
+    shape = encrypted_img.shape
+    buffer, scratch = buffer_pool.get(shape)
+
+    if isinstance(key, TransformKeys) and (key.xor_keys is None or np.ndim(key.xor_keys) == 1):
+        with stage("decrypt_planned", bytes_in=encrypted_img.nbytes):
+            merged = decrypt_planned(np.ascontiguousarray(encrypted_img), key, buffer, threads)
+        if merged is not None:
+            with stage("restore_from_stacked_ycbcr"):
+                return restore_image(merged[:shape[0], :shape[1]], key, mode)
+
+    with stage("pad_divide") as counters:
+        padded = pad_to_block_size(encrypted_img, out=buffer)
+        blocks = divide_into_blocks(padded, out=scratch)
+        counters["blocks"] = len(blocks)
+    with stage("decrypt", blocks=len(blocks), bytes_in=blocks.nbytes):
+        decrypted_blocks = decrypt(blocks, key, out=buffer.reshape(scratch.shape), threads=threads)
+
+    with stage("merge"):
+        merged = merge_blocks(decrypted_blocks, shape, out=scratch)
+    with stage("restore_from_stacked_ycbcr"):
+        return restore_image(merged, key, mode)
+
+
+def encrypt_jpeg_bytes(data: JpegData, ops_flag: int = 0b1111, quality: int = 95, seeded: bool = False,
+                       tile_rows: Optional[int] = None, dct: bool = False,
+                       subsampling: Optional[str] = None, threads: int = 1,
+                       secret: Optional[int] = None) -> Tuple[bytes, Any]:
+    """Encrypt an in-memory JPEG and return the encrypted JPEG bytes and the key.
+
+    ``data`` may be bytes, a memoryview or a binary file object. With ``dct``
+    the quantized coefficients are transformed directly and ``quality`` is unused.
+    ``threads`` splits the pixel-domain transforms of the image across threads.
+    Seeded keys use ``secret`` if given instead of a fresh one.
+    """
+    if dct and subsampling:
+        raise ValueError("Coefficient-domain mode keeps the source JPEG's own subsampling")
+    if dct:
+        with stage("decode"):
+            jpeg = read_coefficients(_as_bytes(data))
+        if seeded and secret is None:
+            secret = new_secret()
+        with stage("encrypt_coefficients"):
+            key = encrypt_coefficients(jpeg, ops_flag, secret if seeded else None)
+        with stage("encode"):
+            return write_coefficients(jpeg), key
+
+    with stage("decode"):
+        img = open_jpeg_ycbcr(_as_file(data))
+
+    encrypted_img, key = encrypt_pixels(img, ops_flag, seeded, tile_rows, subsampling, threads, secret)
+    return encode_jpeg(encrypted_img, quality), key
+
+
+def decrypt_jpeg_bytes(data: JpegData, key, quality: int = 100, dct: bool = False, threads: int = 1) -> bytes:
+    """Decrypt in-memory encrypted JPEG bytes with ``key`` and return the JPEG bytes."""
+    if dct:
+        with stage("decode"):
+            jpeg = read_coefficients(_as_bytes(data))
+        with stage("decrypt_coefficients"):
+            decrypt_coefficients(jpeg, key)
+        with stage("encode"):
+            return write_coefficients(jpeg)
+
+    with stage("decode"):
+        encrypted_img = open_jpeg(_as_file(data), as_array=True)
+
+    # The planes go to the encoder as YCbCr, which is what it stores anyway.
+    return encode_jpeg(decrypt_pixels(encrypted_img, key, mode="YCbCr", threads=threads), quality)
+
+
+def encrypt_jpeg_sweep(data: JpegData, qualities: Sequence[int], ops_flag: int = 0b1111, seeded: bool = False,
+                       tile_rows: Optional[int] = None, subsampling: Optional[str] = None,
+                       decrypt_quality: int = 100, workers: Optional[int] = None
+                       ) -> Tuple[Any, List[Tuple[int, bytes, bytes]]]:
+    """Encrypt once and encode the result at every quality in ``qualities``.
+
+    Each encrypted variant is decoded again and decrypted, so the result is
+    the key and ``(quality, encrypted, decrypted)`` bytes per quality. The
+    variants run in ``workers`` threads (default: one per quality, up to the
+    CPU count); the JPEG codec releases the GIL.
+    """
+    with stage("decode"):
+        img = open_jpeg_ycbcr(_as_file(data))
+    encrypted_img, key = encrypt_pixels(img, ops_flag, seeded, tile_rows, subsampling)
+
+    def variant(quality: int) -> Tuple[int, bytes, bytes]:
+        # Worker threads have their own buffer pools, so encrypted_img (a
+        # view of this thread's pool) stays intact while they run.
+        encrypted = encode_jpeg(encrypted_img, quality)
+        return quality, encrypted, decrypt_jpeg_bytes(encrypted, key, decrypt_quality)
+
+    workers = workers or max(1, min(len(qualities), os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return key, list(executor.map(variant, qualities))
+
+
+def _pack_images(arrays: Sequence[Any], stack: bool, subsampling: Optional[str] = None
+                 ) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, int]]]:
+    # Each image is stacked (or taken as is), padded in a pooled buffer and
+    # split straight into its slice of one packed block array.
+    shapes = [stacked_shape(a, subsampling) if stack else a.shape for a in arrays]
+    sizes = [np.prod(padded_shape(shape)) // BLOCK_SIZE**2 for shape in shapes]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    blocks = np.empty((offsets[-1], BLOCK_SIZE, BLOCK_SIZE), dtype=np.uint8)
+
+    for array, shape, start, stop in zip(arrays, shapes, offsets[:-1], offsets[1:]):
+        buffer, _ = buffer_pool.get(shape)
+        image = stack_image(array, subsampling, out=buffer) if stack else array
+        divide_into_blocks(pad_to_block_size(image, out=buffer), out=blocks[start:stop])
+
+    return blocks, offsets, shapes
+
+
+def encrypt_jpeg_batch(items: Sequence[JpegData], ops_flag: int = 0b1111, quality: int = 95,
+                       seeded: bool = False, subsampling: Optional[str] = None) -> List[Tuple[bytes, Any]]:
+    """Encrypt many in-memory JPEGs with one vectorized transform pass.
+
+    Gives the same bytes and keys as calling encrypt_jpeg_bytes on each; it is
+    meant for many small images, where per-call overhead dominates.
+    """
+    with stage("decode"):
+        images = [open_jpeg_ycbcr(_as_file(d)) for d in items]
+    with stage("pack") as counters:
+        blocks, offsets, shapes = _pack_images(images, stack=True, subsampling=subsampling)
+        counters["blocks"] = len(blocks)
+
+    with stage("encrypt", blocks=len(blocks), bytes_in=blocks.nbytes):
+        encrypted, keys = encrypt_batch(blocks, ops_flag, offsets, seeded, out=blocks)
+
+    outputs = []
+    for image, shape, start, stop, key in zip(images, shapes, offsets[:-1], offsets[1:], keys):
+        _record_layout(key, image, subsampling)
+        merged = merge_blocks(encrypted[start:stop], shape, out=buffer_pool.get(shape)[0])
+        outputs.append((encode_jpeg(merged, quality), key))
+    return outputs
+
+
+def decrypt_jpeg_batch(items: Sequence[JpegData], keys: Sequence[Any], quality: int = 100) -> List[bytes]:
+    """Decrypt many in-memory encrypted JPEGs whose keys use the same operations."""
+    with stage("decode"):
+        images = [open_jpeg(_as_file(d), as_array=True) for d in items]
+    with stage("pack") as counters:
+        blocks, offsets, shapes = _pack_images(images, stack=False)
+        counters["blocks"] = len(blocks)
+
+    with stage("decrypt", blocks=len(blocks), bytes_in=blocks.nbytes):
+        decrypted = decrypt_batch(blocks, keys, offsets, out=blocks)
+
+    outputs = []
+    for shape, start, stop, key in zip(shapes, offsets[:-1], offsets[1:], keys):
+        merged = merge_blocks(decrypted[start:stop], shape, out=buffer_pool.get(shape)[0])
+        outputs.append(encode_jpeg(restore_image(merged, key, mode="YCbCr"), quality))
+    return outputs
@@ -0,0 +1,192 @@
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+from PIL import Image
+from crypto.keys import SeededKeys
+from crypto.operations import encrypted_positions, decrypt_subset
+from graphic.io import SUBSAMPLING
+from graphic.operations import padded_shape
+from graphic.utils import open_jpeg
+from pipeline import JpegData, _as_file, encode_jpeg
+from instrumentation import stage
+from config import BLOCK_SIZE
+
+
+# (left, top, right, bottom) in source image pixels, like PIL's crop box.
+Box = Tuple[int, int, int, int]
+
+
+class RegionError(ValueError):
+    """The requested region or preview does not fit the image."""
+
+
+class Plane(NamedTuple):
+    # Where a Y/Cb/Cr plane sits in the stacked image, its content size,
+    # how far it may be read (padding included) and its scale to the source.
+    top: int
+    left: int
+    height: int
+    width: int
+    bottom: int
+    right: int
+    fy: int
+    fx: int
+
+
+def stacked_planes(shape: Tuple[int, int], key) -> List[Plane]:
+    subsampling = getattr(key, "subsampling", None)
+    if not subsampling:
+        h, w3 = shape
+        w = w3 // 3
+        return [Plane(0, c * w, h, w, h, (c + 1) * w, 1, 1) for c in range(3)]
+
+    fy, fx = SUBSAMPLING[subsampling]
+    h, w = key.source_size
+    stacked_h, stacked_w = shape
+    padded_h = stacked_h * fy // (fy + 1)
+    chroma_w = stacked_w // fx
+    chroma_h, chroma_content_w = -(-h // fy), -(-w // fx)
+    return [Plane(0, 0, h, w, padded_h, stacked_w, 1, 1)] + [
+        Plane(padded_h, c * chroma_w, chroma_h, chroma_content_w, stacked_h, (c + 1) * chroma_w, fy, fx)
+        for c in range(2)]
+
+
+def decrypt_blocks(encrypted_img: np.ndarray, key, block_ids: np.ndarray) -> np.ndarray:
+    """Decrypt only the blocks ``block_ids`` (row-major in the stacked block grid).
+
+    The encrypted blocks are fetched through the inverse permutation, so the
+    pixel work is proportional to ``len(block_ids)``.
+    """
+    if isinstance(key, SeededKeys):
+        with stage("expand_key", blocks=key.num_blocks):
+            key = key.expand()
+
+    h, w = encrypted_img.shape
+    blocks_w = padded_shape((h, w))[1] // BLOCK_SIZE
+    positions = encrypted_positions(key, block_ids)
+    rows, cols = np.divmod(positions, blocks_w)
+
+    # Whole blocks are copied out of a block view of the image; only blocks
+    # on a ragged edge are gathered pixel by pixel, with clamped indices
+    # reproducing the edge padding of pad_to_block_size.
+    full_h, full_w = h // BLOCK_SIZE, w // BLOCK_SIZE
+    grid = encrypted_img[:full_h * BLOCK_SIZE, :full_w * BLOCK_SIZE].reshape(
+        full_h, BLOCK_SIZE, full_w, BLOCK_SIZE).swapaxes(1, 2)
+    inside = (rows < full_h) & (cols < full_w)
+    blocks = np.empty((len(positions), BLOCK_SIZE, BLOCK_SIZE), dtype=encrypted_img.dtype)
+    blocks[inside] = grid[rows[inside], cols[inside]]
+    if not inside.all():
+        edge = ~inside
+        offsets = np.arange(BLOCK_SIZE)
+        ys = np.minimum(rows[edge, None] * BLOCK_SIZE + offsets, h - 1)
+        xs = np.minimum(cols[edge, None] * BLOCK_SIZE + offsets, w - 1)
+        blocks[edge] = encrypted_img[ys[:, :, None], xs[:, None, :]]
+
+    with stage("decrypt_subset", blocks=len(blocks)):
+        return decrypt_subset(blocks, key, block_ids, positions)
+
+
+def _window_ids(shape: Tuple[int, int], top: int, bottom: int, left: int, right: int
+                ) -> Tuple[np.ndarray, int, int]:
+    blocks_w = padded_shape(shape)[1] // BLOCK_SIZE
+    rows = np.arange(top // BLOCK_SIZE, -(-bottom // BLOCK_SIZE))
+    cols = np.arange(left // BLOCK_SIZE, -(-right // BLOCK_SIZE))
+    return (rows[:, None] * blocks_w + cols).ravel(), len(rows), len(cols)
+
+
+def decrypt_region(encrypted_img: np.ndarray, key, box: Box, mode: str = "RGB") -> Image.Image:
+    """Decrypt the part of the source image inside ``box``; equal to cropping a full decrypt.
+
+    The box is clipped to the image; RegionError if nothing of it is left.
+    """
+    planes = stacked_planes(encrypted_img.shape, key)
+    left, top = max(box[0], 0), max(box[1], 0)
+    right, bottom = min(box[2], planes[0].width), min(box[3], planes[0].height)
+    if left >= right or top >= bottom:
+        raise RegionError(f"Region {box} does not overlap the {planes[0].width}x{planes[0].height} image")
+    if isinstance(key, SeededKeys):
+        key = key.expand()
+
+    # Each plane's window in stacked pixels; upsampled chroma keeps a pixel
+    # of margin so that it sees the same neighbours as in a full decrypt.
+    windows = []
+    for plane in planes:
+        margin = 1 if plane.fy * plane.fx > 1 else 0
+        windows.append((max(plane.top + top // plane.fy - margin, plane.top),
+                        min(plane.top - (-bottom // plane.fy) + margin, plane.bottom),
+                        max(plane.left + left // plane.fx - margin, plane.left),
+                        min(plane.left - (-right // plane.fx) + margin, plane.right)))
+
+    grids = [_window_ids(encrypted_img.shape, *window) for window in windows]
+    blocks = decrypt_blocks(encrypted_img, key, np.concatenate([ids for ids, _, _ in grids]))
+
+    bands, start = [], 0
+    for plane, (y0, y1, x0, x1), (ids, rows, cols) in zip(planes, windows, grids):
+        grid = blocks[start:start + len(ids)].reshape(rows, cols, BLOCK_SIZE, BLOCK_SIZE)
+        start += len(ids)
+        pixels = grid.swapaxes(1, 2).reshape(rows * BLOCK_SIZE, cols * BLOCK_SIZE)
+        top_pad, left_pad = y0 % BLOCK_SIZE, x0 % BLOCK_SIZE
+        band = Image.fromarray(np.ascontiguousarray(
+            pixels[top_pad:top_pad + y1 - y0, left_pad:left_pad + x1 - x0]))
+
+        if plane.fy * plane.fx > 1:
+            oy, ox = y0 - plane.top, x0 - plane.left
+            band = band.resize((right - left, bottom - top), Image.BILINEAR, box=(
+                left / plane.fx - ox, top / plane.fy - oy, right / plane.fx - ox, bottom / plane.fy - oy))
+        bands.append(band)
+
+    img = Image.merge("YCbCr", bands)
+    return img if mode == "YCbCr" else img.convert(mode)
+
+
+def decrypt_preview(encrypted_img: np.ndarray, key, step: int = 1, mode: str = "RGB") -> Image.Image:
+    """Low-resolution preview: every ``step``-th 8x8 window of each plane is
+    decrypted and becomes one pixel (its mean), so the result is 1/(8 * step) scale."""
+    planes = stacked_planes(encrypted_img.shape, key)
+    if any(plane.height < BLOCK_SIZE or plane.width < BLOCK_SIZE for plane in planes):
+        raise RegionError(f"A {planes[0].width}x{planes[0].height} image is too small for a preview")
+    if isinstance(key, SeededKeys):
+        key = key.expand()
+
+    # Window origins that fit inside each plane. A plane that does not start
+    # on a block boundary (Y|Cb|Cr with width % 8 != 0) has windows spanning
+    # two blocks, so both are fetched.
+    layouts = []
+    for plane in planes:
+        ys = plane.top + np.arange(0, plane.height - BLOCK_SIZE + 1, BLOCK_SIZE * step)
+        xs = plane.left + np.arange(0, plane.width - BLOCK_SIZE + 1, BLOCK_SIZE * step)
+        shift = xs[0] % BLOCK_SIZE if len(xs) else 0
+        cols = xs // BLOCK_SIZE
+        if shift:
+            cols = np.stack([cols, cols + 1], axis=1).ravel()
+        layouts.append((ys // BLOCK_SIZE, cols, shift, len(ys), len(xs)))
+
+    blocks_w = padded_shape(encrypted_img.shape)[1] // BLOCK_SIZE
+    ids = [(rows[:, None] * blocks_w + cols).ravel() for rows, cols, _, _, _ in layouts]
+    blocks = decrypt_blocks(encrypted_img, key, np.concatenate(ids))
+
+    bands, start = [], 0
+    for (rows, cols, shift, n_rows, n_cols), plane_ids in zip(layouts, ids):
+        grid = blocks[start:start + len(plane_ids)].reshape(n_rows, len(cols), BLOCK_SIZE, BLOCK_SIZE)
+        start += len(plane_ids)
+        if shift:
+            grid = np.concatenate([grid[:, 0::2, :, shift:], grid[:, 1::2, :, :shift]], axis=3)
+        sums = grid.sum(axis=(2, 3), dtype=np.uint32)
+        bands.append(Image.fromarray(((sums + BLOCK_SIZE**2 // 2) // BLOCK_SIZE**2).astype(np.uint8)))
+
+    size = bands[0].size
+    img = Image.merge("YCbCr", [band if band.size == size else band.resize(size, Image.BILINEAR)
+                                for band in bands])
+    return img if mode == "YCbCr" else img.convert(mode)
+
+
+def decrypt_jpeg_region(data: JpegData, key, box: Optional[Box] = None, step: Optional[int] = None,
+                        quality: int = 100) -> bytes:
+    """JPEG bytes of the decrypted ``box`` region or, with ``step``, of a preview."""
+    with stage("decode"):
+        encrypted_img = open_jpeg(_as_file(data), as_array=True)
+
+    if step:
+        img = decrypt_preview(encrypted_img, key, step, mode="YCbCr")
+    else:
+        img = decrypt_region(encrypted_img, key, box, mode="YCbCr")
+    return encode_jpeg(img, quality)
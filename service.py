@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from crypto.operations import export_key_to_string, import_key_from_string
+from crypto.plans import share_plan_cache
+from pipeline import encrypt_jpeg_bytes, decrypt_jpeg_bytes
+
+
+KEY_HEADER = "x-encryption-key"
+MAX_BODY = 64 * 2**20
+# Legacy keys travel in a header and grow with the image (about 4 MB at 12 MP),
+# so header lines may be as long as a body.
+MAX_HEADER = MAX_BODY
+
+
+def encrypt_job(data: bytes, ops_flag: int, quality: int, seeded: bool, dct: bool,
+                subsampling: Optional[str] = None) -> Tuple[bytes, str]:
+    # Runs in a worker process; the key is serialized there so only bytes cross back.
+    encrypted, key = encrypt_jpeg_bytes(data, ops_flag, quality, seeded=seeded, dct=dct,
+                                        subsampling=subsampling)
+    return encrypted, export_key_to_string(key)
+
+
+def decrypt_job(data: bytes, key_str: str, quality: int, dct: bool) -> bytes:
+    return decrypt_jpeg_bytes(data, import_key_from_string(key_str), quality, dct=dct)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str = ""):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class ServiceMetrics:
+    """Request counts, recent latencies and byte totals, rendered as Prometheus text."""
+
+    def __init__(self, window: int = 1024):
+        self.started = time.monotonic()
+        self.requests: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self.bytes_in: Dict[str, int] = defaultdict(int)
+        self.bytes_out: Dict[str, int] = defaultdict(int)
+        self.in_flight = 0
+        self.queued = 0
+
+    def observe(self, endpoint: str, status: int, seconds: float, bytes_in: int, bytes_out: int) -> None:
+        self.requests[endpoint, status] += 1
+        self.latencies[endpoint].append(seconds)
+        self.bytes_in[endpoint] += bytes_in
+        self.bytes_out[endpoint] += bytes_out
+
+    def render(self) -> str:
+        uptime = time.monotonic() - self.started
+        lines = ["# TYPE jpeg_encryption_requests_total counter"]
+        for (endpoint, status), count in sorted(self.requests.items()):
+            lines.append(f'jpeg_encryption_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+        lines.append("# TYPE jpeg_encryption_request_seconds summary")
+        for endpoint, samples in sorted(self.latencies.items()):
+            for q in (0.5, 0.9, 0.99):
+                value = float(np.quantile(samples, q)) if samples else 0.0
+                lines.append(f'jpeg_encryption_request_seconds{{endpoint="{endpoint}",quantile="{q}"}} {value:g}')
+
+        lines.append("# TYPE jpeg_encryption_throughput_rps gauge")
+        for endpoint in sorted(self.latencies):
+            total = sum(c for (e, _), c in self.requests.items() if e == endpoint)
+            lines.append(f'jpeg_encryption_throughput_rps{{endpoint="{endpoint}"}} {total / uptime:g}')
+
+        for name, totals in (("bytes_in", self.bytes_in), ("bytes_out", self.bytes_out)):
+            lines.append(f"# TYPE jpeg_encryption_{name}_total counter")
+            for endpoint, value in sorted(totals.items()):
+                lines.append(f'jpeg_encryption_{name}_total{{endpoint="{endpoint}"}} {value}')
+
+        lines.append("# TYPE jpeg_encryption_in_flight gauge")
+        lines.append(f"jpeg_encryption_in_flight {self.in_flight}")
+        lines.append("# TYPE jpeg_encryption_queued gauge")
+        lines.append(f"jpeg_encryption_queued {self.queued}")
+        return "\n".join(lines) + "\n"
+
+
+class EncryptionService:
+    """HTTP/1.1 front end that hands encryption jobs to a process pool.
+
+    At most ``max_concurrency`` jobs run and ``max_queue`` more may wait;
+    anything beyond that is turned away with 429 so latency stays bounded.
+
+    POST /encrypt?ops=15&quality=95&key_mode=seeded&dct=0&chroma=4:4:4  body: JPEG -> JPEG, key in X-Encryption-Key
+    POST /decrypt?quality=100&dct=0  body: JPEG, X-Encryption-Key -> JPEG
+    GET /metrics, GET /healthz
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, workers: Optional[int] = None,
+                 max_concurrency: Optional[int] = None, max_queue: int = 16,
+                 executor: Optional[Executor] = None, max_body: int = MAX_BODY,
+                 max_header: int = MAX_HEADER):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.max_header = max_header
+        self.metrics = ServiceMetrics()
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    async def start(self) -> "EncryptionService":
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=share_plan_cache,
+                                                 initargs=(self.workers,))
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=self.max_header)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Closing the transports ends idle keep-alive reads with EOF
+            # instead of cancelling their handlers.
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self) -> "EncryptionService":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        print(f"Serving on http://{self.host}:{self.port}")
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _run(self, fn, *args):
+        if self.metrics.in_flight + self.metrics.queued >= self.max_concurrency + self.max_queue:
+            raise HTTPError(HTTPStatus.TOO_MANY_REQUESTS, "Queue full, retry later")
+
+        self.metrics.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.metrics.queued -= 1
+        self.metrics.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.metrics.in_flight -= 1
+            self._slots.release()
+
+    async def _dispatch(self, method: str, path: str, query: Dict[str, str], headers: Dict[str, str],
+                        body: bytes) -> Tuple[HTTPStatus, Dict[str, str], bytes]:
+        dct = query.get("dct", "0") not in ("0", "false", "")
+        chroma = query.get("chroma", "4:4:4")
+        if chroma not in ("4:4:4", "4:2:2", "4:2:0"):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Unknown chroma layout {chroma}")
+        if path == "/encrypt" and method == "POST":
+            encrypted, key_str = await self._run(
+                encrypt_job, body, int(query.get("ops", 15)), int(query.get("quality", 95)),
+                query.get("key_mode", "seeded") == "seeded", dct, None if chroma == "4:4:4" else chroma)
+            return HTTPStatus.OK, {"Content-Type": "image/jpeg", "X-Encryption-Key": key_str}, encrypted
+        if path == "/decrypt" and method == "POST":
+            if KEY_HEADER not in headers:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing X-Encryption-Key header")
+            decrypted = await self._run(
+                decrypt_job, body, headers[KEY_HEADER], int(query.get("quality", 100)), dct)
+            return HTTPStatus.OK, {"Content-Type": "image/jpeg"}, decrypted
+        if path == "/metrics" and method == "GET":
+            return HTTPStatus.OK, {"Content-Type": "text/plain; version=0.0.4"}, self.metrics.render().encode()
+        if path == "/healthz" and method == "GET":
+            return HTTPStatus.OK, {"Content-Type": "text/plain"}, b"ok\n"
+        if path in ("/encrypt", "/decrypt", "/metrics", "/healthz"):
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+
+    async def _read_head(self, reader: asyncio.StreamReader, request_line: bytes) -> Tuple[str, str, Dict[str, str]]:
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+        headers = {}
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, headers
+            size += len(line)
+            if size > self.max_header:
+                raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep or not name.strip():
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed header line")
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: HTTPStatus, headers: Dict[str, str],
+                       payload: bytes, keep_alive: bool) -> None:
+        headers["Content-Length"] = str(len(payload))
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.REQUEST_URI_TOO_LONG,
+                                        {"Content-Type": "text/plain"}, b"Request line too long\n", False)
+                    break
+                if not request_line.strip():
+                    break
+
+                start = time.perf_counter()
+                try:
+                    method, target, headers = await self._read_head(reader, request_line)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except HTTPError as e:
+                    # The rest of the stream cannot be framed, so answer and hang up.
+                    await self._respond(writer, e.status, {"Content-Type": "text/plain"}, f"{e}\n".encode(), False)
+                    break
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"Content-Type": "text/plain"},
+                                        b"Invalid Content-Length\n", False)
+                    break
+
+                url = urlsplit(target)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                body = b""
+
+                try:
+                    if length > self.max_body:
+                        keep_alive = False
+                        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    body = await reader.readexactly(length)
+                    status, response_headers, payload = await self._dispatch(
+                        method, url.path, query, headers, body)
+                except HTTPError as e:
+                    status, response_headers, payload = e.status, {"Content-Type": "text/plain"}, f"{e}\n".encode()
+                    if e.status == HTTPStatus.TOO_MANY_REQUESTS:
+                        response_headers["Retry-After"] = "1"
+                except (ValueError, OSError) as e:
+                    status, response_headers, payload = (HTTPStatus.BAD_REQUEST, {"Content-Type": "text/plain"},
+                                                         f"{type(e).__name__}: {e}\n".encode())
+                except Exception as e:
+                    status, response_headers, payload = (HTTPStatus.INTERNAL_SERVER_ERROR,
+                                                         {"Content-Type": "text/plain"},
+                                                         f"{type(e).__name__}: {e}\n".encode())
+
+                await self._respond(writer, status, response_headers, payload, keep_alive)
+
+                if url.path in ("/encrypt", "/decrypt"):
+                    self.metrics.observe(url.path.lstrip("/"), status.value,
+                                         time.perf_counter() - start, len(body), len(payload))
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+
+class ServiceClient:
+    """Minimal keep-alive HTTP client for talking to the service over loopback."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080, max_header: int = MAX_HEADER):
+        self.host = host
+        self.port = port
+        self.max_header = max_header
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body: bytes = b"",
+                      headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port, limit=self.max_header)
+
+        headers = {"Host": f"{self.host}:{self.port}", "Content-Length": str(len(body)), **(headers or {})}
+        head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        self._writer.write(head.encode("latin-1") + body)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        response_headers = {}
+        while (line := await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        payload = await self._reader.readexactly(int(response_headers.get("content-length", 0)))
+
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status, response_headers, payload
+
+    async def encrypt(self, data: bytes, ops_flag: int = 15, quality: int = 95,
+                      key_mode: str = "seeded", dct: bool = False,
+                      chroma: str = "4:4:4") -> Tuple[int, bytes, Optional[str]]:
+        status, headers, payload = await self.request(
+            "POST", f"/encrypt?ops={ops_flag}&quality={quality}&key_mode={key_mode}&dct={int(dct)}"
+                    f"&chroma={chroma}", data)
+        return status, payload, headers.get(KEY_HEADER)
+
+    async def decrypt(self, data: bytes, key_str: str, quality: int = 100, dct: bool = False) -> Tuple[int, bytes]:
+        status, _, payload = await self.request(
+            "POST", f"/decrypt?quality={quality}&dct={int(dct)}", data, {"X-Encryption-Key": key_str})
+        return status, payload
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local JPEG encryption service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes for encryption jobs")
+    parser.add_argument("--max-concurrency", type=int,
+                        help="Jobs running at once (default: --workers)")
+    parser.add_argument("--max-queue", type=int, default=16,
+                        help="Jobs allowed to wait before requests get 429")
+    args = parser.parse_args()
+
+    service = EncryptionService(args.host, args.port, args.workers,
+                                args.max_concurrency, args.max_queue)
+    try:
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
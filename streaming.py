@@ -0,0 +1,203 @@
+import io
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+MJPEG_SUFFIXES = (".mjpeg", ".mjpg")
+# A marker inside scan data: 0xFF not followed by a stuffed 0x00, a restart
+# marker or another 0xFF (fill byte).
+SCAN_MARKER = re.compile(rb"\xff[^\x00\xd0-\xd7\xff]")
+
+
+def _is_jpeg(name: str) -> bool:
+    return name.lower().endswith(JPEG_SUFFIXES)
+
+
+def iter_members(source: str) -> Iterator[Tuple[str, bytes]]:
+    """Yield ``(name, data)`` for each JPEG in a tar or zip archive, one member at a time.
+
+    ``-`` reads a (possibly compressed) tar stream from stdin. Tar archives
+    are read as a stream, so only the current member is held in memory.
+    """
+    if source != "-" and zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_jpeg(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+
+    fileobj = sys.stdin.buffer if source == "-" else None
+    with tarfile.open(None if fileobj else source, mode="r|*", fileobj=fileobj) as archive:
+        for member in archive:
+            if member.isfile() and _is_jpeg(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+
+def member_id(name: str) -> str:
+    """Relative path of a member without its suffix, e.g. ``DCIM/100/IMG_0001``.
+
+    Members with the same file name in different folders keep distinct IDs.
+    """
+    parts = [part for part in PurePosixPath(name).parts if part not in ("/", ".")]
+    if not parts or ".." in parts:
+        raise ValueError(f"Unsafe member name {name!r}")
+    return PurePosixPath(*parts).with_suffix("").as_posix()
+
+
+class ArchiveWriter:
+    """Writes members to a zip (by suffix) or tar archive as they arrive.
+
+    ``-`` writes an uncompressed tar stream to stdout; ``.tar.gz`` / ``.tgz``
+    and friends are compressed on the fly. JPEGs are stored in zips without
+    recompression.
+    """
+
+    def __init__(self, dest: str):
+        self._zip = self._tar = None
+        if dest == "-":
+            self._tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+        elif dest.lower().endswith(".zip"):
+            self._zip = zipfile.ZipFile(dest, "w", zipfile.ZIP_STORED)
+        else:
+            compression = next((c for s, c in (("gz", "gz"), ("tgz", "gz"), ("bz2", "bz2"), ("xz", "xz"))
+                                if dest.lower().endswith(s)), "")
+            self._tar = tarfile.open(dest, mode=f"w|{compression}")
+
+    def add(self, name: str, data: bytes) -> None:
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+            return
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self) -> None:
+        (self._zip or self._tar).close()
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _frame_end(buffer: bytearray, start: int) -> Optional[int]:
+    """End of the JPEG whose SOI is at ``start``, or None if ``buffer`` stops before it."""
+    pos = start + 2
+    while pos + 2 <= len(buffer):
+        if buffer[pos] != 0xFF:
+            raise ValueError(f"Expected a JPEG marker at byte {pos} of the stream")
+        marker = buffer[pos + 1]
+        if marker == 0xD9:
+            return pos + 2
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            pos += 2
+            continue
+        if pos + 4 > len(buffer):
+            return None
+
+        pos += 2 + int.from_bytes(buffer[pos + 2:pos + 4], "big")
+        if marker == 0xDA:
+            match = SCAN_MARKER.search(buffer, pos)
+            if match is None:
+                return None
+            pos = match.start()
+    return None
+
+
+def iter_mjpeg(stream: BinaryIO, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Yield the frames of an MJPEG stream, i.e. concatenated JPEGs.
+
+    Bytes between frames (e.g. multipart boundaries) are skipped. Frames are
+    found by walking the JPEG markers, so embedded thumbnails do not split them.
+    """
+    buffer = bytearray()
+    start = 0
+    while True:
+        begin = buffer.find(b"\xff\xd8\xff", start)
+        end = _frame_end(buffer, begin) if begin >= 0 else None
+        if end is not None:
+            yield bytes(buffer[begin:end])
+            start = end
+            continue
+
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if begin >= 0:
+                raise ValueError("MJPEG stream ends inside a frame")
+            return
+        # Only the unfinished frame (or a possible partial SOI) is kept.
+        del buffer[:begin if begin >= 0 else max(start, len(buffer) - 2)]
+        start = 0
+        buffer += chunk
+
+
+def _natural_key(name: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def iter_frames(source: str) -> Iterator[Tuple[str, bytes]]:
+    """Yield ``(name, data)`` for each frame of a sequence.
+
+    ``source`` is a directory of JPEG frames, taken in natural name order
+    (frame2 before frame10), or an MJPEG file (``-`` for stdin) whose
+    frames are named frame000000.jpg, frame000001.jpg, ...
+    """
+    if source != "-" and os.path.isdir(source):
+        for path in sorted(Path(source).iterdir(), key=lambda path: _natural_key(path.name)):
+            if path.is_file() and _is_jpeg(path.name):
+                yield path.name, path.read_bytes()
+        return
+
+    stream = sys.stdin.buffer if source == "-" else open(source, "rb")
+    try:
+        for index, data in enumerate(iter_mjpeg(stream)):
+            yield f"frame{index:06d}.jpg", data
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+class FrameWriter:
+    """Writes frames as files of a directory or, for a ``.mjpeg`` / ``.mjpg``
+    path or ``-`` (stdout), concatenated into an MJPEG stream."""
+
+    def __init__(self, dest: str):
+        self._dir = self._stream = None
+        if dest == "-":
+            self._stream = sys.stdout.buffer
+        elif dest.lower().endswith(MJPEG_SUFFIXES):
+            self._stream = open(dest, "wb")
+        else:
+            self._dir = Path(dest)
+            self._dir.mkdir(parents=True, exist_ok=True)
+
+    def add(self, name: str, data: bytes) -> None:
+        if self._dir is not None:
+            (self._dir / name).write_bytes(data)
+        else:
+            self._stream.write(data)
+
+    def close(self) -> None:
+        if self._stream is sys.stdout.buffer:
+            self._stream.flush()
+        elif self._stream is not None:
+            self._stream.close()
+
+    def __enter__(self) -> "FrameWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,3 +1,4 @@
+import os
 from evaluation.operations import (
     evaluate_entropy,
     plot_histogram_comparison,
@@ -6,14 +7,26 @@ from evaluation.operations import (
     plot_npcr_uaci,
     evaluate_block_adjacency
 )
-from config import INPUT_DIR, ENCRYPTED_DIR, DECRYPTED_DIR, UPLOADED_DIR, UPLOADED_DECRYPTED_DIR
+from evaluation.cache import ResultCache
+from evaluation.engine import evaluate
+from config import INPUT_DIR, ENCRYPTED_DIR, DECRYPTED_DIR, UPLOADED_DIR, UPLOADED_DECRYPTED_DIR, EVALUATION_CACHE
 
-evaluate_entropy(ENCRYPTED_DIR)
-plot_histogram_comparison(str(ENCRYPTED_DIR / "image-1_encrypted_14_q95.jpg"),
-                          str(ENCRYPTED_DIR / "image-1_encrypted_15_q95.jpg"))
-plot_psnr_vs_bpp(INPUT_DIR, DECRYPTED_DIR)
-print()
-evaluate_social_media_psnr_table(
-    UPLOADED_DIR, UPLOADED_DECRYPTED_DIR)
-plot_npcr_uaci(INPUT_DIR, ENCRYPTED_DIR)
-evaluate_block_adjacency(ENCRYPTED_DIR)
+# Guarded so worker processes that re-import this module do not rerun it.
+if __name__ == "__main__":
+    result_cache = ResultCache(EVALUATION_CACHE)
+    workers = os.cpu_count() or 1
+    results = evaluate(INPUT_DIR, ENCRYPTED_DIR, DECRYPTED_DIR,
+                       result_cache=result_cache, workers=workers)
+    uploaded_results = evaluate(UPLOADED_DIR, decrypted_dir=UPLOADED_DECRYPTED_DIR,
+                                result_cache=result_cache, workers=workers)
+
+    evaluate_entropy(ENCRYPTED_DIR, results=results)
+    plot_histogram_comparison(str(ENCRYPTED_DIR / "image-1_encrypted_14_q95.jpg"),
+                              str(ENCRYPTED_DIR / "image-1_encrypted_15_q95.jpg"),
+                              results=results)
+    plot_psnr_vs_bpp(INPUT_DIR, DECRYPTED_DIR, results=results)
+    print()
+    evaluate_social_media_psnr_table(
+        UPLOADED_DIR, UPLOADED_DECRYPTED_DIR, results=uploaded_results)
+    plot_npcr_uaci(INPUT_DIR, ENCRYPTED_DIR, results=results)
+    evaluate_block_adjacency(ENCRYPTED_DIR, results=results)
@@ -0,0 +1,25 @@
+import os
+import manifest
+from manifest import BatchManifest
+
+
+def test_touched_unchanged_file_is_not_rehashed_twice(tmp_path, monkeypatch):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"jpeg")
+    book = BatchManifest(tmp_path / "manifest.json")
+    book.record(image, book.fingerprint(image), {}, [])
+    book.save()
+
+    hashed = []
+    digest = manifest.file_digest
+    monkeypatch.setattr(manifest, "file_digest", lambda path: hashed.append(path) or digest(path))
+    stat = image.stat()
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    for _ in range(2):
+        book = BatchManifest(tmp_path / "manifest.json")
+        fingerprint = book.fingerprint(image)
+        assert book.is_current(image, fingerprint, {})
+        book.refresh(image, fingerprint)
+        book.save()
+    assert len(hashed) == 1
@@ -0,0 +1,39 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from main import run_sequence
+from streaming import iter_frames
+
+
+def _frames(count: int, bad: int):
+    y, x = np.mgrid[0:240, 0:320]
+    for i in range(count):
+        img = np.stack([(x + 9 * i) % 256, (y + 5 * i) % 256, ((x ^ y) + i) % 256], axis=-1).astype(np.uint8)
+        if i == bad:
+            img = img[:200]
+        buffer = io.BytesIO()
+        Image.fromarray(img).save(buffer, "JPEG", quality=90)
+        yield buffer.getvalue()
+
+
+def _psnr(first: bytes, second: bytes) -> float:
+    a, b = (np.asarray(Image.open(io.BytesIO(d)).convert("RGB"), dtype=float) for d in (first, second))
+    return 10 * np.log10(255**2 / np.mean((a - b) ** 2))
+
+
+@pytest.mark.parametrize("ops_flag", [0b1111, 0b1110])
+def test_failed_frame_does_not_shift_later_keys(tmp_path, ops_flag):
+    source = tmp_path / "in.mjpeg"
+    frames = list(_frames(5, bad=1))
+    source.write_bytes(b"".join(frames))
+    keys = tmp_path / "keys.jfek"
+
+    assert run_sequence(str(source), str(tmp_path / "enc.mjpeg"), keys, ops_flag, 95, 2) == 1
+    assert run_sequence(str(tmp_path / "enc.mjpeg"), str(tmp_path / "dec.mjpeg"), keys, ops_flag, 95, 2,
+                        decrypt=True) == 0
+
+    decrypted = [data for _, data in iter_frames(str(tmp_path / "dec.mjpeg"))]
+    assert len(decrypted) == 4
+    for original, data in zip(frames[:1] + frames[2:], decrypted):
+        assert _psnr(original, data) > 30
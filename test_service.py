@@ -0,0 +1,65 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from PIL import Image
+from service import EncryptionService, ServiceClient
+
+
+def _jpeg(width: int, height: int) -> bytes:
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.stack([x % 256, y % 256, (x ^ y) % 256], axis=-1).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def _with_service(fn, **kwargs):
+    with ThreadPoolExecutor(1) as executor:
+        async with EncryptionService(executor=executor, **kwargs) as service:
+            client = ServiceClient(port=service.port)
+            try:
+                return await fn(client)
+            finally:
+                await client.close()
+
+
+async def _raw(port: int, request: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+@pytest.mark.parametrize("key_mode", ["seeded", "legacy"])
+def test_large_image_keys_round_trip(key_mode):
+    # 12 MP: the legacy key is megabytes and even the seeded one is over 64 KiB of header.
+    data = _jpeg(4000, 3000)
+
+    async def round_trip(client):
+        status, encrypted, key = await client.encrypt(data, key_mode=key_mode)
+        assert status == 200 and len(key) > 64 * 1024
+        status, decrypted = await client.decrypt(encrypted, key)
+        assert status == 200
+        return decrypted
+
+    decrypted = asyncio.run(_with_service(round_trip))
+    assert Image.open(io.BytesIO(decrypted)).size == (4000, 3000)
+
+
+@pytest.mark.parametrize("request_bytes, status", [
+    (b"POST /decrypt HTTP/1.1\r\nX-Encryption-Key: " + b"0" * 4096 + b"\r\n\r\n", b"431"),
+    (b"GET /healthz HTTP/1.1\r\n" + b"X-Pad: 0\r\n" * 512 + b"\r\n", b"431"),
+    (b"GET /healthz HTTP/1.1\r\nno colon here\r\n\r\n", b"400"),
+    (b"POST /decrypt HTTP/1.1\r\nContent-Length: many\r\n\r\n", b"400"),
+    (b"GARBAGE\r\n\r\n", b"400"),
+])
+def test_bad_heads_get_an_answer(request_bytes, status):
+    async def send(client):
+        return await _raw(client.port, request_bytes)
+
+    response = asyncio.run(_with_service(send, max_header=1024))
+    assert response.split(b" ", 2)[1] == status